@@ -0,0 +1,105 @@
+"""So sánh bộ nhớ giữa JSON bài hát đầy đủ của spotipy và bản ghi TrackRecord trong CatalogCache.
+
+Mỗi người dùng nhận bản sao JSON riêng (như khi mỗi lời gọi API được giải mã độc lập),
+trong khi CatalogCache chỉ giữ một bản ghi cho mỗi bài hát.
+
+    python benchmarks/bench_catalog_memory.py --tracks 5000 --users 200 --per-user 50
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "benchmark")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "benchmark")
+
+import bot  # noqa: E402
+
+MARKETS = [f"{a}{b}" for a in "ABCDEFGHIJKLM" for b in "ABCDEFGHIJKLMN"][:180]
+
+
+def fake_track(i: int) -> dict:
+    artist_id = f"artist{i % 800:018d}"
+    album_id = f"album{i // 10:019d}"
+    return {
+        'id': f"track{i:017d}",
+        'name': f"Bài hát số {i}",
+        'type': 'track',
+        'uri': f"spotify:track:track{i:017d}",
+        'href': f"https://api.spotify.com/v1/tracks/track{i:017d}",
+        'duration_ms': 180000 + i % 60000,
+        'popularity': i % 101,
+        'explicit': False,
+        'track_number': i % 12 + 1,
+        'disc_number': 1,
+        'is_local': False,
+        'preview_url': None,
+        'available_markets': MARKETS,
+        'external_ids': {'isrc': f"VN{i:010d}"},
+        'external_urls': {'spotify': f"https://open.spotify.com/track/track{i:017d}"},
+        'artists': [{
+            'id': artist_id, 'name': f"Nghệ sĩ {i % 800}", 'type': 'artist',
+            'uri': f"spotify:artist:{artist_id}",
+            'href': f"https://api.spotify.com/v1/artists/{artist_id}",
+            'external_urls': {'spotify': f"https://open.spotify.com/artist/{artist_id}"},
+        }],
+        'album': {
+            'id': album_id, 'name': f"Album {i // 10}", 'album_type': 'album', 'total_tracks': 10,
+            'release_date': '2024-01-01', 'release_date_precision': 'day',
+            'uri': f"spotify:album:{album_id}", 'available_markets': MARKETS,
+            'href': f"https://api.spotify.com/v1/albums/{album_id}",
+            'external_urls': {'spotify': f"https://open.spotify.com/album/{album_id}"},
+            'images': [{'url': f"https://i.scdn.co/image/{album_id}{size}", 'height': size, 'width': size}
+                       for size in (640, 300, 64)],
+            'artists': [{'id': artist_id, 'name': f"Nghệ sĩ {i % 800}"}],
+        },
+    }
+
+
+def measure(build) -> tuple:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    held = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return held, after - before
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--per-user', type=int, default=50)
+    args = parser.parse_args()
+
+    random.seed(0)
+    encoded = [json.dumps(fake_track(i)) for i in range(args.tracks)]
+    # Phân bố lệch: các bài phổ biến xuất hiện ở nhiều người dùng
+    libraries = [
+        [min(int((random.paretovariate(0.8) - 1) * 50), args.tracks - 1) for _ in range(args.per_user)]
+        for _ in range(args.users)
+    ]
+    total = args.users * args.per_user
+
+    raw, raw_bytes = measure(lambda: [[json.loads(encoded[i]) for i in library] for library in libraries])
+    del raw
+
+    def build_catalog():
+        cache = bot.CatalogCache()
+        ids = [[cache.add_track(json.loads(encoded[i])).id for i in library] for library in libraries]
+        return cache, ids
+
+    (cache, ids), catalog_bytes = measure(build_catalog)
+    distinct = len(cache.tracks)
+
+    print(f"users: {args.users}  track references: {total}  distinct tracks: {distinct}")
+    print(f"raw dicts:     {raw_bytes / 1024 / 1024:8.2f} MiB  {raw_bytes / total:8.0f} B/reference")
+    print(f"catalog cache: {catalog_bytes / 1024 / 1024:8.2f} MiB  {catalog_bytes / distinct:8.0f} B/track"
+          f"  {catalog_bytes / total:6.0f} B/reference")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Đo bộ nhớ đỉnh của /export với thư viện giả lập ở nhiều kích thước.
+
+Spotify giả sinh từng trang theo yêu cầu nên chỉ write_export giữ dữ liệu trong bộ nhớ;
+bộ nhớ đỉnh phải gần như không đổi khi số bài hát tăng từ vài nghìn lên 50k.
+
+    python benchmarks/bench_export_memory.py --sizes 5000 50000 --format csv
+"""
+import argparse
+import asyncio
+import gzip
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "benchmark")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "benchmark")
+
+import bot  # noqa: E402
+
+
+def fake_track(i: int) -> dict:
+    return {
+        'id': f"track{i:017d}", 'uri': f"spotify:track:track{i:017d}", 'type': 'track',
+        'name': f"Bài hát số {i}", 'duration_ms': 180000 + i % 60000,
+        'artists': [{'name': f"Nghệ sĩ {i % 800}"}], 'album': {'name': f"Album {i // 10}"},
+    }
+
+
+class FakeSpotify:
+    """Thư viện giả: `liked` bài đã thích và các playlist, mỗi playlist `per_playlist` bài."""
+
+    def __init__(self, liked: int, playlists: int, per_playlist: int):
+        self.liked = liked
+        self.playlists = playlists
+        self.per_playlist = per_playlist
+
+    @staticmethod
+    def _page(total: int, limit: int, offset: int, make) -> dict:
+        end = min(total, offset + limit)
+        return {'items': [make(i) for i in range(offset, end)], 'total': total,
+                'next': 'next' if end < total else None}
+
+    def current_user_saved_tracks(self, limit, offset):
+        return self._page(self.liked, limit, offset,
+                          lambda i: {'added_at': '2024-01-01T00:00:00Z', 'track': fake_track(i)})
+
+    def current_user_playlists(self, limit, offset):
+        return self._page(self.playlists, limit, offset, lambda i: {'id': f"pl{i}", 'name': f"Playlist {i}"})
+
+    def playlist_items(self, playlist_id, limit, offset, fields=None, additional_types=None):
+        base = int(playlist_id[2:]) * self.per_playlist
+        return self._page(self.per_playlist, limit, offset,
+                          lambda i: {'added_at': '2024-01-01T00:00:00Z', 'track': fake_track(base + i)})
+
+    def current_user_recently_played(self, limit):
+        return {'items': [{'played_at': '2024-01-01T00:00:00Z', 'track': fake_track(i)} for i in range(limit)]}
+
+
+def run(size: int, fmt: str) -> tuple:
+    # Một nửa là bài đã thích, nửa còn lại chia vào các playlist 250 bài
+    sp = FakeSpotify(size // 2, max(1, size // 2 // 250), 250)
+    fd, path = tempfile.mkstemp(suffix='.gz')
+    os.close(fd)
+    try:
+        tracemalloc.start()
+        started = time.perf_counter()
+        rows = asyncio.run(bot.write_export(sp, path, fmt))
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            lines = sum(1 for _ in f)
+        return rows, lines, os.path.getsize(path), peak, elapsed
+    finally:
+        os.remove(path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5000, 50000])
+    parser.add_argument('--format', choices=('csv', 'json'), default='csv')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        rows, lines, compressed, peak, elapsed = run(size, args.format)
+        print(f"{size:7d} tracks: {rows:7d} rows ({lines} lines)  file {compressed / 1024:8.1f} KiB  "
+              f"peak memory {peak / 1024:8.1f} KiB  {elapsed:6.2f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""Đo chỉ mục tìm kiếm thư viện (/find) với thư viện tổng hợp 20k bài hát tên tiếng Việt/tiếng Anh.
+
+Thư viện được phục vụ bởi một Spotify giả (có độ trễ mỗi trang) để đo thời gian lập chỉ mục
+tăng dần, sau đó đo bộ nhớ, độ trễ truy vấn (so với quét tuyến tính) và tỉ lệ tìm thấy bài
+đích khi truy vấn tên bài không dấu hoặc gõ sai một ký tự.
+
+    python benchmarks/bench_find.py --tracks 20000 --queries 500
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "benchmark")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "benchmark")
+
+import bot  # noqa: E402
+
+WORDS = (
+    "em anh yêu mưa nắng chiều đêm ngày nhớ thương buồn vui đường phố hà nội sài gòn biển xanh "
+    "trăng sao gió mùa thu đông xuân hạ tình đầu cuối cùng lạc trôi hãy trao cho anh chúng ta "
+    "của hiện tại muộn rồi mà sao còn đừng làm trái tim đau một nhà night love dream fire "
+    "summer heart light city lonely forever dance golden young blue wild home"
+).split()
+ARTISTS = (
+    "Sơn Tùng M-TP", "Đen Vâu", "Hoàng Thùy Linh", "Mỹ Tâm", "Đức Phúc", "Hà Anh Tuấn", "Bích Phương",
+    "Vũ", "Chillies", "Ngọt", "Trúc Nhân", "Hòa Minzy", "Taylor Swift", "The Weeknd", "Adele",
+    "Coldplay", "Ed Sheeran", "Billie Eilish", "Dua Lipa", "Bruno Mars",
+)
+
+
+def make_library(count: int) -> list:
+    rng = random.Random(0)
+    tracks = []
+    for i in range(count):
+        name = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))).capitalize()
+        artist = ARTISTS[min(int(rng.paretovariate(1.0)) - 1, len(ARTISTS) - 1)] if rng.random() < 0.5 \
+            else f"{rng.choice(ARTISTS)} {i % 500}"
+        tracks.append({
+            'id': f"track{i:017d}", 'name': name, 'duration_ms': 200000, 'popularity': 50,
+            'artists': [{'id': f"artist{hash(artist) % 10**9:017d}", 'name': artist}],
+            'album': {'id': f"album{i // 10:018d}", 'name': f"Album {i // 10}"},
+        })
+    return tracks
+
+
+class FakeSpotify:
+    def __init__(self, tracks: list, latency: float):
+        self.tracks = tracks
+        self.latency = latency
+
+    def current_user_saved_tracks(self, limit, offset):
+        time.sleep(self.latency)
+        items = [{'track': track} for track in self.tracks[offset:offset + limit]]
+        return {'items': items, 'total': len(self.tracks),
+                'next': 'more' if offset + limit < len(self.tracks) else None}
+
+    def current_user_playlists(self, limit, offset):
+        return {'items': [], 'total': 0, 'next': None}
+
+
+def strip_and_typo(text: str, rng: random.Random) -> tuple:
+    """Truy vấn kiểu người dùng gõ: không dấu, đôi khi sai một ký tự; trả về (truy vấn, có gõ sai)."""
+    query = ' '.join(bot.fold_text(text).split()[:3])
+    if rng.random() < 0.5 and len(query) > 4:
+        i = rng.randrange(1, len(query) - 1)
+        if query[i] != ' ':
+            return query[:i] + rng.choice('abcdeghiklmnoprstuvy') + query[i + 1:], True
+    return query, False
+
+
+def linear_search(tracks: list, query: str, limit: int) -> list:
+    folded = bot.fold_text(query)
+    words = folded.split()
+    matches = []
+    for track in tracks:
+        text = bot.fold_text(f"{track['name']} {track['artists'][0]['name']}")
+        if all(word in text for word in words):
+            matches.append(track['id'])
+            if len(matches) >= limit:
+                break
+    return matches
+
+
+async def build(tracks: list, latency: float) -> tuple:
+    sp = FakeSpotify(tracks, latency)
+    started = time.perf_counter()
+    task = bot.library_search.ensure(sp, 'bench')
+    first_answer = None
+    while not task.done():
+        await asyncio.sleep(0.005)
+        index = bot.library_search.get('bench')
+        if first_answer is None and index is not None and index.records:
+            first_answer = time.perf_counter() - started
+    task.result()
+    return first_answer, time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.05, help="độ trễ mỗi trang của Spotify giả (giây)")
+    args = parser.parse_args()
+
+    tracks = make_library(args.tracks)
+    tracemalloc.start()
+    first_answer, built = asyncio.run(build(tracks, args.latency))
+    index = bot.library_search.get('bench')
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"lập chỉ mục {len(index.records)} bài: {built:.2f}s "
+          f"(trả lời được từ {first_answer * 1000:.0f} ms), {len(index.postings)} trigram, "
+          f"bộ nhớ (gồm catalog) {current / 2**20:.1f} MiB")
+
+    rng = random.Random(2)
+    targets = [rng.choice(tracks) for _ in range(args.queries)]
+    queries, typos = [], []
+    for track in targets:
+        query, typo = strip_and_typo(track['name'], rng)
+        queries.append(query)
+        typos.append(typo)
+    # Truy vấn theo nghệ sĩ khớp hàng nghìn bài: chỉ dùng để đo độ trễ
+    queries += ["son tung", "den vau", "hoang thuy linh", "ha noi mua thu", "tay swift"] * 20
+
+    timings = []
+    found = {False: [0, 0], True: [0, 0]}  # có gõ sai -> [tìm thấy, tổng]
+    for i, query in enumerate(queries):
+        started = time.perf_counter()
+        records = index.search(query, bot.FIND_RESULT_LIMIT)
+        timings.append((time.perf_counter() - started) * 1000)
+        if i < len(targets):
+            target = targets[i]
+            target_text = bot.fold_text(f"{target['name']} {target['artists'][0]['name']}")
+            # Bài đích hoặc bài khác có cùng văn bản (tên trùng) đều được tính
+            found[typos[i]][1] += 1
+            found[typos[i]][0] += any(bot.fold_text(f"{r.name} {' '.join(bot.catalog.artist_names(r))}") == target_text
+                         or r.id == target['id'] for r in records)
+    timings.sort()
+    print(f"truy vấn trigram: trung vị {statistics.median(timings):.2f} ms, "
+          f"p99 {timings[int(len(timings) * 0.99) - 1]:.2f} ms")
+
+    linear = []
+    for query in queries[:100]:
+        started = time.perf_counter()
+        linear_search(tracks, query, bot.FIND_RESULT_LIMIT)
+        linear.append((time.perf_counter() - started) * 1000)
+    print(f"quét tuyến tính (không chịu lỗi gõ): trung vị {statistics.median(linear):.2f} ms")
+
+    shown = [r for r in index.search("son tung", 3)]
+    print(f"'son tung' -> {[f'{r.name} - {bot.catalog.artist_names(r)[0]}' for r in shown]}")
+    for typo, label in ((False, "không dấu"), (True, "không dấu, sai một ký tự")):
+        hits, total = found[typo]
+        print(f"tìm thấy bài đích trong top {bot.FIND_RESULT_LIMIT} ({label}): {hits}/{total} ({hits / total:.0%})")
+
+
+if __name__ == "__main__":
+    main()
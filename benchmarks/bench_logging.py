@@ -0,0 +1,117 @@
+"""Đo chi phí ghi log trong handler khi tải cao: ghi log đồng bộ so với pipeline hàng đợi của bot.
+
+Mỗi "handler" giả lập ghi vài dòng log (info, thỉnh thoảng warning) xen giữa các await, nhiều
+handler chạy đồng thời trên cùng event loop. Đích ghi là một stream chậm (mô phỏng đĩa/pipe
+bị nghẽn). Với StreamHandler đồng bộ, việc định dạng và ghi nằm ngay trong handler; với
+setup_logging() của bot, handler chỉ đưa bản ghi vào hàng đợi.
+
+    python benchmarks/bench_logging.py --handlers 2000 --concurrency 64 --write-delay 0.0002
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "benchmark")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "benchmark")
+
+
+class SlowSink:
+    """Stream giả: mỗi lần write tốn write_delay giây (chặn thread gọi)."""
+
+    def __init__(self, write_delay: float):
+        self.write_delay = write_delay
+        self.lines = 0
+
+    def write(self, text: str) -> None:
+        time.sleep(self.write_delay)
+        self.lines += text.count('\n')
+
+    def flush(self) -> None:
+        pass
+
+
+async def fake_handler(log: logging.Logger, i: int, lines: int) -> float:
+    """Trả về tổng thời gian (giây) handler bị giữ bởi các lời gọi log."""
+    spent = 0.0
+    for n in range(lines):
+        started = time.perf_counter()
+        if n == lines - 1 and i % 50 == 0:
+            log.warning("handler %d chậm: %d lời gọi Spotify", i, n)
+        else:
+            log.info("handler %d bước %d, cache %s", i, n, "hit" if n % 2 else "miss")
+        spent += time.perf_counter() - started
+        await asyncio.sleep(0)
+    return spent
+
+
+async def run_load(log: logging.Logger, handlers: int, concurrency: int, lines: int) -> tuple:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> float:
+        async with semaphore:
+            return await fake_handler(log, i, lines)
+
+    started = time.perf_counter()
+    overheads = await asyncio.gather(*(one(i) for i in range(handlers)))
+    return time.perf_counter() - started, overheads
+
+
+def report(name: str, elapsed: float, overheads: list, sink: SlowSink) -> None:
+    per_handler_ms = sorted(x * 1000 for x in overheads)
+    p99 = per_handler_ms[int(len(per_handler_ms) * 0.99) - 1]
+    print(f"{name:<10} tổng {elapsed:7.2f}s | chi phí log mỗi handler: "
+          f"trung bình {statistics.mean(per_handler_ms):7.3f} ms, p99 {p99:7.3f} ms | "
+          f"dòng đã ghi {sink.lines}")
+
+
+def reset_root() -> logging.Logger:
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    return root
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--handlers", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--lines", type=int, default=5, help="số dòng log mỗi handler")
+    parser.add_argument("--write-delay", type=float, default=0.0002, help="độ trễ mỗi lần ghi (giây)")
+    args = parser.parse_args()
+
+    import bot
+
+    log = logging.getLogger('bot.bench')
+
+    # 1) Ghi đồng bộ như logging.basicConfig trước đây
+    bot.log_listener.stop()
+    root = reset_root()
+    sink = SlowSink(args.write_delay)
+    handler = logging.StreamHandler(sink)
+    handler.setFormatter(logging.Formatter(bot.LOG_TEXT_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    elapsed, overheads = asyncio.run(run_load(log, args.handlers, args.concurrency, args.lines))
+    report("đồng bộ", elapsed, overheads, sink)
+
+    # 2) Pipeline hàng đợi (JSON, có lấy mẫu theo LOG_SAMPLED_LOGGERS)
+    for sampled in (False, True):
+        reset_root()
+        sink = SlowSink(args.write_delay)
+        bot.LOG_SAMPLED_LOGGERS = ('bot.bench',) if sampled else ()
+        listener = bot.setup_logging(sink)
+        elapsed, overheads = asyncio.run(run_load(log, args.handlers, args.concurrency, args.lines))
+        drain_started = time.perf_counter()
+        listener.stop()
+        name = "hàng đợi+mẫu" if sampled else "hàng đợi"
+        report(name, elapsed, overheads, sink)
+        print(f"{'':<10} (thread nền ghi nốt phần còn lại trong {time.perf_counter() - drain_started:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Đo thông lượng của hàng đợi gửi tin nhắn (OutboundSender) với một Bot API giả.
+
+Bot giả áp dụng giới hạn giống Telegram (30 tin/giây toàn cục, 1 tin/giây mỗi chat)
+và trả về RetryAfter khi bị vượt giới hạn.
+
+    python benchmarks/bench_outbound.py --chats 200 --messages 600
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict, deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "benchmark")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "benchmark")
+
+from telegram.error import RetryAfter  # noqa: E402
+
+import bot  # noqa: E402
+
+
+class FakeBot:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.sent = 0
+        self.rate_limited = 0
+        self._global = deque()
+        self._chat_last = defaultdict(float)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        while self._global and now - self._global[0] > 1:
+            self._global.popleft()
+        if len(self._global) >= 30 or now - self._chat_last[chat_id] < 1:
+            self.rate_limited += 1
+            raise RetryAfter(1)
+        self._global.append(now)
+        self._chat_last[chat_id] = now
+        self.sent += 1
+        return text
+
+
+async def run(chats: int, messages: int, notice_ratio: float, latency: float) -> None:
+    fake = FakeBot(latency)
+    sender = bot.OutboundSender()
+    sender.start(fake)
+    latencies = defaultdict(list)
+
+    async def timed(kind, future, started):
+        await future
+        latencies[kind].append(time.monotonic() - started)
+
+    started = time.monotonic()
+    tasks = []
+    for i in range(messages):
+        chat_id = random.randrange(1, chats + 1)
+        now = time.monotonic()
+        if random.random() < notice_ratio:
+            future = sender.notify(chat_id, f"notice {i}")
+            tasks.append(timed('notification', future, now))
+        else:
+            future = sender.submit(chat_id, 'send_message', text=f"reply {i}")
+            tasks.append(timed('interactive', future, now))
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - started
+    await sender.stop()
+
+    print(f"requested: {messages}  delivered: {fake.sent}  merged: {messages - fake.sent}")
+    print(f"elapsed: {elapsed:.2f}s  throughput: {fake.sent / elapsed:.1f} msg/s  429s: {fake.rate_limited}")
+    for kind, values in sorted(latencies.items()):
+        values.sort()
+        p95 = values[int(len(values) * 0.95) - 1]
+        print(f"{kind:>12}: n={len(values)} p50={statistics.median(values):.2f}s p95={p95:.2f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=600)
+    parser.add_argument('--notice-ratio', type=float, default=0.5)
+    parser.add_argument('--latency', type=float, default=0.03)
+    args = parser.parse_args()
+    random.seed(0)
+    asyncio.run(run(args.chats, args.messages, args.notice_ratio, args.latency))
+
+
+if __name__ == '__main__':
+    main()
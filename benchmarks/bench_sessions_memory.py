@@ -0,0 +1,98 @@
+"""Đo bộ nhớ cho N phiên người dùng: dict cũ của init_user_data so với UserSession dùng __slots__,
+và với SessionStore khi chỉ một phần nhỏ phiên còn hoạt động trong bộ nhớ.
+
+    python benchmarks/bench_sessions_memory.py --sessions 1000000 --active-ratio 0.05
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "benchmark")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "benchmark")
+
+import bot  # noqa: E402
+
+TOKEN = "BQ" + "x" * 240
+REFRESH = "AQ" + "y" * 200
+
+
+def measure(build):
+    tracemalloc.start()
+    held = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return held, size
+
+
+def build_dicts(n: int) -> dict:
+    # Mỗi token là một chuỗi riêng như khi giải mã từ JSON
+    return {
+        str(i): {
+            'token': TOKEN[:-1] + str(i % 10),
+            'refresh_token': REFRESH[:-1] + str(i % 10),
+            'amount': bot.DEFAULT_AMOUNT,
+            'last_command': None,
+            'token_expiration': datetime.now() + timedelta(seconds=3600),
+        }
+        for i in range(n)
+    }
+
+
+def build_sessions(n: int) -> dict:
+    expires_at = int(time.time()) + 3600
+    return {
+        str(i): bot.UserSession(TOKEN[:-1] + str(i % 10), REFRESH[:-1] + str(i % 10), expires_at)
+        for i in range(n)
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=1_000_000)
+    parser.add_argument('--active-ratio', type=float, default=0.05)
+    args = parser.parse_args()
+    n = args.sessions
+
+    held, dict_bytes = measure(lambda: build_dicts(n))
+    del held
+    held, slot_bytes = measure(lambda: build_sessions(n))
+
+    # Kho hai tầng: đẩy các phiên nhàn rỗi xuống SQLite
+    with tempfile.TemporaryDirectory() as directory:
+        store = bot.SessionStore(os.path.join(directory, 'sessions.db'), idle_seconds=60)
+        now = int(time.time())
+        active = int(n * args.active_ratio)
+        for i, (user_id, session) in enumerate(held.items()):
+            session.last_active = now if i < active else now - 3600
+        store._active = held
+        del held
+        started = time.perf_counter()
+        evicted = store.evict_idle(now)
+        evict_seconds = time.perf_counter() - started
+
+        tracemalloc.start()
+        store._active = dict(store._active)  # Dict mới với kích thước thực sau khi loại bỏ
+        tiered_bytes = tracemalloc.get_traced_memory()[0] + active * (slot_bytes / n)
+        tracemalloc.stop()
+        started = time.perf_counter()
+        for i in range(active, active + 1000):
+            store.get(str(i))
+        reload_seconds = time.perf_counter() - started
+        db_size = os.path.getsize(store.path)
+
+    mib = 1024 * 1024
+    print(f"sessions: {n}")
+    print(f"dict (init_user_data):    {dict_bytes / mib:8.1f} MiB  {dict_bytes / n:6.0f} B/session")
+    print(f"UserSession (__slots__):  {slot_bytes / mib:8.1f} MiB  {slot_bytes / n:6.0f} B/session")
+    print(f"SessionStore, {args.active_ratio:.0%} active: {tiered_bytes / mib:8.1f} MiB in memory, "
+          f"{db_size / mib:.1f} MiB on disk")
+    print(f"evicted {evicted} sessions in {evict_seconds:.2f}s, reload {reload_seconds:.3f} ms/session")
+
+
+if __name__ == '__main__':
+    main()
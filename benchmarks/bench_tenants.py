@@ -0,0 +1,150 @@
+"""Đo bộ nhớ của chế độ nhiều bot trong một tiến trình (TENANTS) so với chạy mỗi bot một tiến trình.
+
+Mỗi lần đo chạy một tiến trình con: nhập bot với N bot, khởi động tất cả trên Bot API giả
+(polling trả về rỗng), gửi /start và /set_amount từ cùng một người dùng tới từng bot rồi đo RSS.
+Đồng thời kiểm tra phiên được tách theo bot và mỗi bot trả lời bằng token, ứng dụng Spotify của mình.
+
+    python benchmarks/bench_tenants.py --tenants 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+CHILD_FLAG = "--child"
+USER_ID = 42
+
+
+def rss_kib() -> int:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def tenant_env(count: int) -> dict:
+    env = dict(os.environ, TENANTS=",".join(f"t{i}" for i in range(1, count)))
+    env.update({"TELEGRAM_TOKEN": "1000:bench", "SPOTIFY_CLIENT_ID": "client0", "SPOTIFY_CLIENT_SECRET": "secret0"})
+    for i in range(1, count):
+        env[f"T{i}_TELEGRAM_TOKEN"] = f"{1000 + i}:bench"
+        env[f"T{i}_SPOTIFY_CLIENT_ID"] = f"client{i}"
+        env[f"T{i}_SPOTIFY_CLIENT_SECRET"] = f"secret{i}"
+    return env
+
+
+def child() -> dict:
+    import asyncio
+    import gc
+    from collections import Counter
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from replay_traffic import FakeTelegramRequest
+    from telegram import Update
+    from telegram.ext import Application
+
+    import bot
+
+    class PollingTelegramRequest(FakeTelegramRequest):
+        """Bot API giả có getUpdates (long polling không có update mới); đếm tin nhắn theo token bot."""
+
+        def __init__(self):
+            super().__init__(0.0)
+            self.sent = Counter()
+            self.texts = []
+
+        async def do_request(self, url, method, request_data=None, **kwargs):
+            if url.endswith('/getUpdates'):
+                await asyncio.sleep(0.5)
+                return 200, b'{"ok": true, "result": []}'
+            if url.endswith('/sendMessage'):
+                self.sent[url.split('/bot', 1)[1].split('/')[0]] += 1
+                self.texts.append(json.dumps(request_data.parameters, default=str))
+            return await super().do_request(url, method, request_data, **kwargs)
+
+    def message(update_id: int, text: str) -> dict:
+        return {'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': 0, 'text': text,
+            'chat': {'id': USER_ID, 'type': 'private'},
+            'from': {'id': USER_ID, 'is_bot': False, 'first_name': 'Bench'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}],
+        }}
+
+    async def run() -> dict:
+        rss_import = rss_kib()
+        telegram = PollingTelegramRequest()
+        for tenant in bot.tenants.values():
+            builder = Application.builder().token(tenant.token).request(telegram).get_updates_request(telegram)
+            bot.build_application(builder, tenant)
+        application = bot.default_tenant.application
+        await application.initialize()
+        await application.post_init(application)
+        await application.start()
+
+        for i, tenant in enumerate(bot.tenants.values()):
+            for text in ('/start', f'/set_amount {i + 3}'):
+                update = Update.de_json(message(len(telegram.texts) + 1, text), tenant.application.bot)
+                await tenant.application.process_update(update)
+        for tenant in bot.tenants.values():
+            await tenant.outbound.flush(bot.OUTBOUND_FLUSH_TIMEOUT)
+        gc.collect()
+        rss_running = rss_kib()
+
+        isolated = all(
+            bot.sessions.get(tenant.scoped(str(USER_ID))).amount == i + 3
+            for i, tenant in enumerate(bot.tenants.values())
+        )
+        # Nút xác thực của mỗi bot dùng ứng dụng Spotify của bot đó và state gắn tên bot
+        own_oauth = all(
+            any(f"client_id=client{i}" in text and f"state={tenant.scoped(str(USER_ID))}".replace(':', '%3A') in text
+                for text in telegram.texts)
+            for i, tenant in enumerate(bot.tenants.values())
+        )
+        result = {
+            'tenants': len(bot.tenants),
+            'rss_import_kib': rss_import,
+            'rss_running_kib': rss_running,
+            'isolated_sessions': isolated,
+            'own_oauth': own_oauth,
+            'replies_per_bot': sorted(telegram.sent.values()),
+        }
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+        return result
+
+    return asyncio.run(run())
+
+
+def measure(count: int) -> dict:
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), CHILD_FLAG], env=tenant_env(count),
+        capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tenants', type=int, default=5)
+    args = parser.parse_args()
+
+    single = measure(1)
+    multi = measure(args.tenants)
+    per_extra = (multi['rss_running_kib'] - single['rss_running_kib']) / max(1, args.tenants - 1)
+    print(json.dumps(single))
+    print(json.dumps(multi))
+    print(f"Một bot/tiến trình: {single['rss_running_kib'] / 1024:.1f} MiB; "
+          f"{args.tenants} bot/tiến trình: {multi['rss_running_kib'] / 1024:.1f} MiB "
+          f"(so với {args.tenants * single['rss_running_kib'] / 1024:.1f} MiB nếu chạy riêng)")
+    print(f"Mỗi bot thêm: {per_extra / 1024:.2f} MiB = {per_extra / single['rss_running_kib']:.2%} một tiến trình riêng")
+
+
+if __name__ == '__main__':
+    if CHILD_FLAG in sys.argv:
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        print(json.dumps(child()))
+    else:
+        main()
@@ -0,0 +1,193 @@
+"""So sánh hai cách chuyển màn hình: nút bàn phím thường (mỗi lần gửi tin nhắn mới) và nút inline
+(sửa tại chỗ một tin nhắn, vẽ lại từ cache khi có thể).
+
+Mỗi người dùng giả lập bấm qua một chuỗi màn hình (kèm đổi số lượng hiển thị). Spotify và
+Bot API đều là bản giả có độ trễ; tin nhắn đi qua OutboundSender thật (giới hạn 1 tin/giây
+mỗi chat). Đo số tin nhắn mới, số lần sửa, số lời gọi Spotify và thời gian từ lúc bấm tới
+khi nội dung hiện ra.
+
+    python benchmarks/bench_views.py --users 20 --spotify-latency 0.15 --telegram-latency 0.08
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "benchmark")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "benchmark")
+
+import bot  # noqa: E402
+
+# (màn hình, số lượng): chuỗi thao tác điển hình của một người dùng
+SCRIPT = [
+    ('top', 5), ('liked', 5), ('top', 5), ('top', 10), ('recent', 10), ('stats', 10),
+    ('liked', 10), ('liked', 20), ('top', 20), ('recent', 20), ('current', 20), ('top', 20),
+]
+
+
+def fake_track(i: int) -> dict:
+    return {
+        'id': f"track{i:017d}", 'name': f"Bài hát {i}", 'duration_ms': 200000, 'popularity': 60,
+        'artists': [{'id': f"artist{i % 50:016d}", 'name': f"Nghệ sĩ {i % 50}"}],
+        'album': {'id': f"album{i:018d}", 'name': f"Album {i}", 'images': []},
+        'external_urls': {'spotify': f"https://open.spotify.com/track/{i}"},
+    }
+
+
+class FakeSpotify:
+    def __init__(self, latency: float, counter: list):
+        self.latency = latency
+        self.counter = counter
+
+    def _call(self, result):
+        time.sleep(self.latency)
+        self.counter[0] += 1
+        return result
+
+    def current_user_top_tracks(self, limit, time_range):
+        return self._call({'items': [fake_track(i) for i in range(limit)]})
+
+    def current_user_saved_tracks(self, limit=20):
+        return self._call({'items': [{'track': fake_track(i)} for i in range(limit)], 'total': 500})
+
+    def current_user_recently_played(self, limit=20):
+        return self._call({'items': [{'track': fake_track(i), 'played_at': "2026-10-19T08:00:00.000Z"}
+                                     for i in range(limit)]})
+
+    def current_user_playing_track(self):
+        return self._call({'is_playing': False, 'progress_ms': 1000, 'item': fake_track(1)})
+
+    def current_user(self):
+        return self._call({'display_name': "Người dùng", 'country': 'VN', 'email': 'x@example.com',
+                           'product': 'premium', 'external_urls': {}})
+
+    def current_user_followed_artists(self):
+        return self._call({'artists': {'total': 12}})
+
+    def current_user_playlists(self, limit=50, offset=0):
+        return self._call({'items': [], 'total': 7})
+
+    def current_user_top_artists(self, limit, time_range):
+        return self._call({'items': [{'id': f"artist{i:016d}", 'name': f"Nghệ sĩ {i}"} for i in range(limit)]})
+
+
+class FakeBot:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.sent = 0
+        self.edited = 0
+        self.next_id = 1
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+        self.next_id += 1
+        return SimpleNamespace(chat_id=chat_id, message_id=self.next_id, reply_markup=kwargs.get('reply_markup'),
+                               chat=SimpleNamespace(id=chat_id))
+
+    async def edit_message_text(self, chat_id, text, message_id, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.edited += 1
+        return True
+
+
+async def keyboard_session(user: int, args, bot_api: FakeBot) -> list:
+    """Luồng cũ: mỗi lần bấm là một tin nhắn mới; đổi số lượng phải qua /set_amount."""
+    user_obj = SimpleNamespace(id=user)
+    chat = SimpleNamespace(id=user)
+    timings = []
+    amount = None
+    for view, wanted in SCRIPT:
+        update = SimpleNamespace(effective_user=user_obj, effective_chat=chat, callback_query=None,
+                                 message=SimpleNamespace(text=bot.COMMANDS[view]))
+        started = time.perf_counter()
+        if wanted != amount:
+            amount = wanted
+            bot.get_session(str(user)).amount = amount
+            await bot.reply(update, f"*✅ Đã cập nhật số lượng hiển thị thành: {amount}*", parse_mode='Markdown')
+        await bot.handle_message(update, None)
+        timings.append(time.perf_counter() - started)
+        await asyncio.sleep(args.think)
+    return timings
+
+
+async def inline_session(user: int, args, bot_api: FakeBot) -> list:
+    """Luồng mới: tin nhắn đầu tiên từ bàn phím thường, sau đó mọi thao tác là nút inline."""
+    user_obj = SimpleNamespace(id=user)
+    chat = SimpleNamespace(id=user)
+    timings = []
+    first_view, amount = SCRIPT[0]
+    bot.get_session(str(user)).amount = amount
+    started = time.perf_counter()
+    update = SimpleNamespace(effective_user=user_obj, effective_chat=chat, callback_query=None,
+                             message=SimpleNamespace(text=bot.COMMANDS[first_view]))
+    await bot.handle_message(update, None)
+    timings.append(time.perf_counter() - started)
+    message = SimpleNamespace(chat_id=user, message_id=1, chat=chat, reply_markup=None)
+
+    async def answer(*_, **__):
+        await asyncio.sleep(bot_api.latency)
+
+    for view, amount in SCRIPT[1:]:
+        await asyncio.sleep(args.think)
+        query = SimpleNamespace(data=bot.view_callback_data(view, amount), message=message, from_user=user_obj,
+                                answer=answer)
+        update = SimpleNamespace(effective_user=user_obj, effective_chat=chat, callback_query=query, message=None)
+        started = time.perf_counter()
+        await bot.view_callback(update, None)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+async def run(flow, args) -> tuple:
+    calls = [0]
+    bot_api = FakeBot(args.telegram_latency)
+    sp = FakeSpotify(args.spotify_latency, calls)
+
+    async def get_user_spotify(update, context):
+        return sp
+
+    async def no_mood(track_ids):
+        return ""
+
+    bot.get_user_spotify = get_user_spotify
+    bot.mood_summary = no_mood  # audio features cần mạng, không liên quan tới phép đo
+    bot.PREFETCH_ENABLED = False
+    bot.default_tenant.outbound = bot.OutboundSender()
+    bot.default_tenant.outbound.start(bot_api)
+    bot.top_lists = bot.TopListCache()
+    bot.view_cache = bot.ViewCache()
+    try:
+        sessions = await asyncio.gather(*(flow(10_000 + user, args, bot_api) for user in range(args.users)))
+    finally:
+        await bot.default_tenant.outbound.stop()
+    return [t for timings in sessions for t in timings], bot_api, calls[0]
+
+
+def report(name: str, timings: list, bot_api: FakeBot, calls: int, actions: int) -> None:
+    ms = sorted(t * 1000 for t in timings)
+    print(f"{name:<12} tin nhắn mới {bot_api.sent:4d} | sửa {bot_api.edited:4d} | "
+          f"Spotify/thao tác {calls / actions:4.2f} | độ trễ trung vị {statistics.median(ms):6.0f} ms, "
+          f"p95 {ms[int(len(ms) * 0.95) - 1]:6.0f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--spotify-latency', type=float, default=0.15)
+    parser.add_argument('--telegram-latency', type=float, default=0.08)
+    parser.add_argument('--think', type=float, default=1.2, help="thời gian giữa hai lần bấm (giây)")
+    args = parser.parse_args()
+
+    actions = args.users * len(SCRIPT)
+    for name, flow in (("bàn phím", keyboard_session), ("nút inline", inline_session)):
+        timings, bot_api, calls = asyncio.run(run(flow, args))
+        report(name, timings, bot_api, calls, actions)
+
+
+if __name__ == "__main__":
+    main()
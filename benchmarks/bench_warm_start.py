@@ -0,0 +1,113 @@
+"""Đo thời gian từ lúc khởi động tiến trình tới khi phục vụ được một yêu cầu, khởi động lạnh và ấm.
+
+Tiến trình cha dựng trạng thái giả lập (catalog và top tracks của nhiều người dùng) rồi ghi
+ảnh chụp bằng StateSnapshot. Sau đó nó chạy hai tiến trình con: một tiến trình khởi động lạnh
+phải gọi Spotify giả (có độ trễ), một tiến trình nạp ảnh chụp và phục vụ thẳng từ cache.
+
+    python benchmarks/bench_warm_start.py --users 2000 --latency 0.3
+"""
+import time
+
+PROCESS_STARTED = time.time()
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import os  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "benchmark")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "benchmark")
+
+
+def fake_track(i: int) -> dict:
+    return {
+        'id': f"track{i:017d}", 'name': f"Bài hát số {i}", 'duration_ms': 200000, 'popularity': i % 101,
+        'artists': [{'id': f"artist{i % 800:017d}", 'name': f"Nghệ sĩ {i % 800}"}],
+        'album': {'id': f"album{i // 10:018d}", 'name': f"Album {i // 10}"},
+    }
+
+
+class FakeSpotify:
+    def __init__(self, user: int, latency: float):
+        self.user = user
+        self.latency = latency
+        self.calls = 0
+
+    def current_user_top_tracks(self, limit, time_range):
+        self.calls += 1
+        time.sleep(self.latency)
+        return {'items': [fake_track((self.user * 7 + i) % 20000) for i in range(limit)]}
+
+
+def build_state(bot, users: int) -> None:
+    async def fill():
+        for user in range(users):
+            await bot.top_lists.get(FakeSpotify(user, 0), str(user), 'tracks', 'short_term')
+    asyncio.run(fill())
+
+
+def child(args) -> None:
+    import bot
+    imported = time.time()
+    if args.snapshot:
+        bot.StateSnapshot(args.snapshot).load()
+    loaded = time.time()
+
+    sp = FakeSpotify(args.user, args.latency)
+
+    async def serve():
+        ids, _ = await bot.top_lists.get(sp, str(args.user), 'tracks', 'short_term')
+        return [bot.format_track_line(i, bot.catalog.get(track_id)) for i, track_id in enumerate(ids[:10], 1)]
+
+    lines = asyncio.run(serve())
+    served = time.time()
+    print(f"{PROCESS_STARTED} {imported} {loaded} {served} {sp.calls} {len(lines)}")
+
+
+def run_child(snapshot: str, args) -> list:
+    command = [sys.executable, os.path.abspath(__file__), '--child', '--user', str(args.users // 2),
+               '--latency', str(args.latency)]
+    if snapshot:
+        command += ['--snapshot', snapshot]
+    spawned = time.time()
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout.split()
+    started, imported, loaded, served = (float(value) for value in output[:4])
+    return [spawned, started, imported, loaded, served, int(output[4])]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.3, help="Độ trễ giả lập của mỗi lời gọi Spotify (giây)")
+    parser.add_argument('--child', action='store_true')
+    parser.add_argument('--snapshot')
+    parser.add_argument('--user', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    import bot
+    build_state(bot, args.users)
+    fd, path = tempfile.mkstemp(suffix='.pickle')
+    os.close(fd)
+    try:
+        started = time.perf_counter()
+        bot.StateSnapshot(path).save()
+        print(f"users: {args.users}  catalog tracks: {len(bot.catalog.tracks)}  "
+              f"snapshot {os.path.getsize(path) / 1024:.0f} KiB written in {time.perf_counter() - started:.3f}s")
+        for label, snapshot in (('cold', None), ('warm', path)):
+            spawned, started, imported, loaded, served, calls = run_child(snapshot, args)
+            print(f"{label}: import {imported - started:6.3f}s  load {loaded - imported:6.3f}s  "
+                  f"first request {served - loaded:6.3f}s  spawn-to-served {served - spawned:6.3f}s  "
+                  f"Spotify calls {calls}")
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
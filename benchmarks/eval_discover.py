@@ -0,0 +1,109 @@
+"""Đánh giá offline DiscoveryIndex (/discover) trên thư viện người dùng tổng hợp.
+
+Mỗi người dùng thuộc một nhóm gu nhạc và lấy phần lớn bài hát từ nhóm đó. 20% thư viện
+mỗi người được giữ lại để đo recall@k so với gợi ý theo độ phổ biến; ngoài ra đo thời gian
+xây chỉ mục, bộ nhớ, thời gian cập nhật tăng dần và độ trễ truy vấn.
+
+    python benchmarks/eval_discover.py --users 2000 --tracks 20000 --per-user 60
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "benchmark")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "benchmark")
+
+import bot  # noqa: E402
+
+
+def pick(rng: random.Random, pool: list) -> str:
+    # Phân bố lệch trong mỗi nhóm: vài bài rất phổ biến, đuôi dài ít người nghe
+    return pool[min(int((rng.paretovariate(1.2) - 1) * len(pool) / 20), len(pool) - 1)]
+
+
+def make_libraries(args) -> list:
+    rng = random.Random(0)
+    tracks = [f"track{i:017d}" for i in range(args.tracks)]
+    rng.shuffle(tracks)
+    size = args.tracks // args.clusters
+    clusters = [tracks[c * size:(c + 1) * size] for c in range(args.clusters)]
+    libraries = []
+    for _ in range(args.users):
+        home = clusters[rng.randrange(args.clusters)]
+        library = set()
+        while len(library) < args.per_user:
+            library.add(pick(rng, home) if rng.random() < 0.85 else rng.choice(tracks))
+        libraries.append(list(library))
+    return libraries
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--tracks', type=int, default=20000)
+    parser.add_argument('--clusters', type=int, default=20)
+    parser.add_argument('--per-user', type=int, default=60)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=500)
+    args = parser.parse_args()
+
+    libraries = make_libraries(args)
+    rng = random.Random(1)
+    train, held_out = [], []
+    for library in libraries:
+        rng.shuffle(library)
+        cut = int(len(library) * 0.8)
+        train.append(library[:cut])
+        held_out.append(set(library[cut:]))
+
+    index = bot.DiscoveryIndex()
+    tracemalloc.start()
+    started = time.perf_counter()
+    for user, library in enumerate(train):
+        index.submit(str(user), 'liked', library)
+        index.apply(str(user))
+    build_seconds = time.perf_counter() - started
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    pairs = sum(len(row) for row in index.cooccurrence.values())
+
+    # Cập nhật tăng dần: một người dùng thay 10 bài trong thư viện
+    update_times = []
+    for user in rng.sample(range(args.users), min(200, args.users)):
+        library = train[user][10:] + rng.sample(train[rng.randrange(args.users)], 10)
+        started = time.perf_counter()
+        index.submit(str(user), 'liked', library)
+        index.apply(str(user))
+        update_times.append(time.perf_counter() - started)
+        index.submit(str(user), 'liked', train[user])
+        index.apply(str(user))
+
+    popular = [track_id for track_id, _ in index.frequency.most_common(args.k + args.per_user)]
+    query_times, hits, baseline_hits = [], 0, 0
+    for user in rng.sample(range(args.users), min(args.queries, args.users)):
+        started = time.perf_counter()
+        recommended = index.recommend(str(user), args.k)
+        query_times.append(time.perf_counter() - started)
+        owned = set(train[user])
+        hits += len(held_out[user].intersection(recommended))
+        baseline_hits += len(held_out[user].intersection(
+            [track_id for track_id in popular if track_id not in owned][:args.k]))
+    relevant = sum(len(held_out[user]) for user in range(args.users)) * len(query_times) / args.users
+
+    query_times.sort()
+    print(f"users: {args.users}  tracks in index: {len(index.frequency)}  non-zero pairs: {pairs}")
+    print(f"build:  {build_seconds:8.2f} s   memory: {memory / 1024 / 1024:8.1f} MiB"
+          f"  ({memory / max(pairs, 1):.0f} B/pair)")
+    print(f"update: {statistics.mean(update_times) * 1000:8.2f} ms/user (mean)")
+    print(f"query:  {statistics.mean(query_times) * 1000:8.2f} ms mean"
+          f"  {query_times[int(len(query_times) * 0.95)] * 1000:8.2f} ms p95")
+    print(f"recall@{args.k}: co-occurrence {hits / relevant:.3f}   popularity {baseline_hits / relevant:.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""Dịch vụ accounts.spotify.com giả để thử đăng nhập qua máy chủ callback OAuth của bot trên máy local.
+
+/authorize chuyển hướng ngay về redirect_uri kèm code (như khi người dùng bấm "Đồng ý"),
+/api/token đổi code (chỉ dùng được một lần) lấy token giả, có thể thêm độ trễ.
+
+Chạy kịch bản kiểm tra (callback hợp lệ, tải lại trang, state giả mạo/hết hạn, người dùng hủy,
+code sai, và nhiều lượt đăng nhập cùng lúc trong khi đo độ trễ của event loop):
+
+    python benchmarks/fake_accounts_server.py --check
+
+Hoặc chạy dịch vụ giả rồi chạy bot trỏ vào nó; mở liên kết xác thực của bot sau khi đổi
+https://accounts.spotify.com thành địa chỉ dịch vụ giả:
+
+    python benchmarks/fake_accounts_server.py --port 8902 --delay 0.3
+    SPOTIFY_ACCOUNTS_URL=http://127.0.0.1:8902 OAUTH_CALLBACK_PORT=8080 \\
+        SPOTIFY_REDIRECT_URI=http://127.0.0.1:8080/callback python bot.py
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+
+class Accounts:
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.issued = set()
+        self.exchanges = 0
+        self.clients = set()
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def issue(self) -> str:
+        with self._lock:
+            self._next += 1
+            code = f"code{self._next}"
+            self.issued.add(code)
+        return code
+
+    def redeem(self, code: str) -> bool:
+        with self._lock:
+            self.exchanges += 1
+            if code not in self.issued:
+                return False
+            self.issued.discard(code)
+            return True
+
+
+def make_handler(accounts: Accounts):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status: int, body: dict = None, headers: dict = None) -> None:
+            data = json.dumps(body or {}).encode()
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path != '/authorize':
+                self._send(404)
+                return
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            query = {'code': accounts.issue(), 'state': params.get('state', '')}
+            self._send(302, headers={'Location': params['redirect_uri'] + '?' + urlencode(query)})
+
+        def do_POST(self):
+            if self.path != '/api/token':
+                self._send(404)
+                return
+            form = {key: values[0] for key, values in
+                    parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()).items()}
+            auth = self.headers.get('Authorization', '')
+            if not auth.startswith('Basic '):
+                self._send(401, {'error': 'invalid_client'})
+                return
+            accounts.clients.add(base64.b64decode(auth[6:]).decode().split(':')[0])
+            time.sleep(accounts.delay)
+            if form.get('grant_type') != 'authorization_code' or not accounts.redeem(form.get('code', '')):
+                self._send(400, {'error': 'invalid_grant', 'error_description': 'Invalid authorization code'})
+                return
+            self._send(200, {'access_token': 'access-' + form['code'], 'token_type': 'Bearer',
+                             'refresh_token': 'refresh-' + form['code'], 'expires_in': 3600,
+                             'scope': 'user-read-private'})
+
+    return Handler
+
+
+def serve(port: int, accounts: Accounts) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(accounts))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class FakeBot:
+    """Bot API giả cho hàng đợi gửi tin nhắn: ghi lại tin nhắn gửi tới từng chat."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, **kwargs):
+        self.sent.append((chat_id, kwargs['text']))
+
+
+async def check() -> bool:
+    accounts = Accounts()
+    server = serve(0, accounts)
+    callback_port = free_port()
+    # Cấu hình phải có trước khi nhập bot
+    os.environ.update({
+        'CACHE_DIR': tempfile.mkdtemp(prefix='oauth_check_'), 'LOG_LEVEL': 'CRITICAL',
+        'SPOTIFY_CLIENT_ID': 'client0', 'SPOTIFY_CLIENT_SECRET': 'secret0',
+        'SPOTIFY_ACCOUNTS_URL': f"http://127.0.0.1:{server.server_address[1]}",
+        'OAUTH_CALLBACK_PORT': str(callback_port),
+        'SPOTIFY_REDIRECT_URI': f"http://127.0.0.1:{callback_port}/callback",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import httpx
+    import bot
+
+    telegram = FakeBot()
+    bot.default_tenant.outbound.start(telegram)
+    await bot.oauth_callback.start()
+    client = httpx.AsyncClient(follow_redirects=True, timeout=30)
+    accounts_url = os.environ['SPOTIFY_ACCOUNTS_URL']
+    results = []
+
+    def expect(name: str, ok: bool, detail: str) -> None:
+        results.append(ok)
+        print(f"[{'PASS' if ok else 'FAIL'}] {name}: {detail}")
+
+    async def login(user_id: str) -> httpx.Response:
+        # Như trình duyệt: mở liên kết xác thực (trên dịch vụ giả) và đi theo chuyển hướng về callback
+        url = urlsplit(bot.authorize_url(user_id))
+        return await client.get(f"{accounts_url}/authorize?{url.query}")
+
+    def token(user_id: str):
+        session = bot.sessions.peek(user_id)
+        return session.token if session else None
+
+    started = time.perf_counter()
+    response = await login('42')
+    elapsed = time.perf_counter() - started
+    await bot.default_tenant.outbound.flush(5)
+    expect("callback activates session", response.status_code == 200 and (token('42') or '').startswith('access-'),
+           f"{response.status_code} in {elapsed * 1000:.0f} ms, token={token('42')}")
+    expect("user notified in Telegram", any(chat_id == 42 for chat_id, _ in telegram.sent), f"{telegram.sent[-1:]}")
+    expect("exchange uses bot's Spotify app", accounts.clients == {'client0'}, f"{sorted(accounts.clients)}")
+
+    exchanges = accounts.exchanges
+    response = await client.get(str(response.url))
+    expect("reload does not exchange again", response.status_code == 200 and accounts.exchanges == exchanges,
+           f"{response.status_code}, {accounts.exchanges} exchanges")
+
+    state = parse_qs(urlsplit(bot.authorize_url('42')).query)['state'][0]
+    forged = '43' + state[2:]
+    response = await client.get(f"http://127.0.0.1:{callback_port}/callback?code={accounts.issue()}&state={forged}")
+    expect("forged state rejected", response.status_code == 400 and token('43') is None, f"{response.status_code}")
+
+    ttl, bot.OAUTH_STATE_TTL = bot.OAUTH_STATE_TTL, -1
+    response = await login('44')
+    bot.OAUTH_STATE_TTL = ttl
+    expect("expired state rejected", response.status_code == 400 and token('44') is None, f"{response.status_code}")
+
+    state = parse_qs(urlsplit(bot.authorize_url('45')).query)['state'][0]
+    exchanges = accounts.exchanges
+    response = await client.get(f"http://127.0.0.1:{callback_port}/callback?error=access_denied&state={state}")
+    expect("user cancel handled", response.status_code == 200 and accounts.exchanges == exchanges,
+           f"{response.status_code}")
+
+    state = parse_qs(urlsplit(bot.authorize_url('46')).query)['state'][0]
+    response = await client.get(f"http://127.0.0.1:{callback_port}/callback?code=bogus&state={state}")
+    expect("invalid code reported", response.status_code == 502 and token('46') is None, f"{response.status_code}")
+
+    response = await client.get(f"http://127.0.0.1:{callback_port}/other")
+    expect("unknown path", response.status_code == 404, f"{response.status_code}")
+
+    # Dịch vụ accounts chậm: các lượt đăng nhập chạy song song và event loop vẫn thông suốt
+    accounts.delay = 0.5
+    lags = []
+    stop = asyncio.Event()
+
+    async def ticker() -> None:
+        while not stop.is_set():
+            before = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - before - 0.01)
+
+    ticking = asyncio.create_task(ticker())
+    users = [str(1000 + i) for i in range(20)]
+    started = time.perf_counter()
+    responses = await asyncio.gather(*(login(user_id) for user_id in users))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticking
+    expect("20 concurrent logins with 0.5s exchange",
+           all(r.status_code == 200 for r in responses) and all(token(u) for u in users) and elapsed < 2,
+           f"{elapsed:.2f}s total, max event loop lag {max(lags) * 1000:.1f} ms")
+
+    await client.aclose()
+    await bot.oauth_callback.stop()
+    await bot.default_tenant.outbound.flush(5)
+    await bot.default_tenant.outbound.stop()
+    server.shutdown()
+    return all(results)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8902)
+    parser.add_argument('--delay', type=float, default=0.0, help="Độ trễ (giây) của mỗi lần đổi code")
+    parser.add_argument('--check', action='store_true', help="Chạy kịch bản kiểm tra máy chủ callback của bot")
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if asyncio.run(check()) else 1)
+
+    server = serve(args.port, Accounts(args.delay))
+    print(f"Fake Spotify accounts listening on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""Máy chủ Spotify giả có thể treo hoặc trả lỗi 5xx theo endpoint, dùng để kiểm tra bộ ngắt mạch.
+
+Chạy kịch bản kiểm tra (khởi động máy chủ, trỏ spotipy vào đó qua thuộc tính `prefix`):
+
+    python benchmarks/fake_spotify_server.py --check
+
+Hoặc chỉ chạy máy chủ, lỗi được đổi lúc chạy qua POST /_faults:
+
+    python benchmarks/fake_spotify_server.py --port 8901 --hang /v1/me/following --fail /v1/me/tracks
+    curl -X POST localhost:8901/_faults -d '{"hang": [], "fail": []}'
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "benchmark")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "benchmark")
+
+import bot  # noqa: E402
+
+TRACK = {'id': 'track0', 'name': 'Bài hát', 'type': 'track', 'duration_ms': 200000, 'popularity': 50,
+         'artists': [{'id': 'artist0', 'name': 'Nghệ sĩ'}], 'album': {'id': 'album0', 'name': 'Album'}}
+
+RESPONSES = {
+    '/v1/me': {'display_name': 'Người dùng thử', 'country': 'VN', 'email': 'test@example.com',
+               'product': 'premium', 'external_urls': {}},
+    '/v1/me/following': {'artists': {'items': [], 'total': 12, 'next': None, 'cursors': {}}},
+    '/v1/me/playlists': {'items': [], 'total': 3, 'next': None},
+    '/v1/me/tracks': {'items': [], 'total': 42, 'next': None},
+    '/v1/me/top/artists': {'items': [{'name': 'Nghệ sĩ'}], 'total': 1, 'next': None},
+    '/v1/me/player/recently-played': {'items': [{'played_at': '2024-01-01T00:00:00Z', 'track': TRACK}]},
+}
+
+
+class Faults:
+    def __init__(self, hang=(), fail=(), hang_seconds: float = 30):
+        self.hang = set(hang)
+        self.fail = set(fail)
+        self.hang_seconds = hang_seconds
+        self.requests = 0
+
+
+def make_handler(faults: Faults):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status: int, body: dict) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            try:
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # Client đã bỏ cuộc vì hết thời gian chờ
+
+        def do_GET(self):
+            faults.requests += 1
+            path = self.path.split('?')[0].rstrip('/')
+            if path in faults.hang:
+                time.sleep(faults.hang_seconds)
+            if path in faults.fail:
+                self._send(503, {'error': {'status': 503, 'message': 'Service unavailable'}})
+            elif path in RESPONSES:
+                self._send(200, RESPONSES[path])
+            else:
+                self._send(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+        def do_POST(self):
+            if self.path == '/_faults':
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                faults.hang = set(body.get('hang', faults.hang))
+                faults.fail = set(body.get('fail', faults.fail))
+                self._send(200, {'hang': sorted(faults.hang), 'fail': sorted(faults.fail)})
+            else:
+                self._send(404, {})
+
+    return Handler
+
+
+def serve(port: int, faults: Faults) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(faults))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class FakeMessage:
+    def __init__(self):
+        self.texts = []
+
+    async def reply_text(self, text, **kwargs):
+        self.texts.append(text)
+
+
+class FakeUser:
+    id = 1
+
+
+class FakeUpdate:
+    """Chỉ đủ thuộc tính cho get_stats: người gửi, tin nhắn để trả lời, không phải nút inline."""
+
+    def __init__(self):
+        self.message = FakeMessage()
+        self.effective_user = FakeUser()
+        self.callback_query = None
+
+
+async def timed(coro) -> tuple:
+    started = time.perf_counter()
+    try:
+        result = await coro
+    except Exception as e:
+        result = e
+    return result, time.perf_counter() - started
+
+
+async def check(port: int) -> bool:
+    faults = Faults(hang_seconds=3)
+    server = serve(port, faults)
+    sp = bot.spotify_client('fake-token')
+    sp.prefix = f"http://127.0.0.1:{server.server_address[1]}/v1/"
+    sp.requests_timeout = 4
+    # Rút ngắn ngưỡng và thời gian nghỉ để kịch bản chạy nhanh
+    bot.SPOTIFY_TIMEOUTS['current_user_followed_artists'] = 1
+    for endpoint in ('current_user_followed_artists', 'current_user_saved_tracks'):
+        bot.spotify_breakers[endpoint] = bot.CircuitBreaker(threshold=3, cooldown=2)
+
+    results = []
+
+    def expect(name: str, ok: bool, detail: str) -> None:
+        results.append(ok)
+        print(f"[{'PASS' if ok else 'FAIL'}] {name}: {detail}")
+
+    result, elapsed = await timed(bot.sp_call(sp.current_user_followed_artists))
+    expect("healthy call", isinstance(result, dict), f"{elapsed * 1000:.0f} ms")
+
+    faults.hang = {'/v1/me/following'}
+    for i in range(3):
+        result, elapsed = await timed(bot.sp_call(sp.current_user_followed_artists))
+        expect(f"hang #{i + 1} times out", isinstance(result, bot.SpotifyUnavailable) and elapsed < 1.5,
+               f"{type(result).__name__} after {elapsed:.2f}s")
+    result, elapsed = await timed(bot.sp_call(sp.current_user_followed_artists))
+    expect("open circuit fails fast", isinstance(result, bot.SpotifyUnavailable) and elapsed < 0.05,
+           f"{elapsed * 1000:.2f} ms, state={bot.spotify_breakers['current_user_followed_artists'].state}")
+
+    result, elapsed = await timed(bot.sp_call(sp.current_user))
+    expect("other endpoints unaffected", isinstance(result, dict), f"{elapsed * 1000:.0f} ms")
+
+    update = FakeUpdate()
+    _, elapsed = await timed(bot.get_stats(update, sp))
+    text = update.message.texts[-1]
+    expect("get_stats degrades instead of failing", "tạm thời không lấy được" in text and "42" in text,
+           f"{elapsed * 1000:.0f} ms")
+
+    faults.fail = {'/v1/me/tracks'}
+    for i in range(3):
+        await timed(bot.sp_call(sp.current_user_saved_tracks))
+    result, elapsed = await timed(bot.sp_call(sp.current_user_saved_tracks))
+    expect("repeated 5xx opens circuit", isinstance(result, bot.SpotifyUnavailable) and elapsed < 0.05,
+           f"{type(result).__name__} after {elapsed * 1000:.2f} ms")
+    expect("degraded user message", "thử lại" in bot.spotify_error_text(result, ""), bot.spotify_error_text(result, ""))
+
+    faults.hang, faults.fail = set(), set()
+    await asyncio.sleep(2.1)
+    result, elapsed = await timed(bot.sp_call(sp.current_user_followed_artists))
+    breaker = bot.spotify_breakers['current_user_followed_artists']
+    expect("probe after cooldown closes circuit", isinstance(result, dict) and breaker.state == 'closed',
+           f"state={breaker.state}")
+    result, _ = await timed(bot.sp_call(sp.current_user_saved_tracks))
+    expect("5xx endpoint recovers", isinstance(result, dict), f"{faults.requests} requests served in total")
+
+    server.shutdown()
+    return all(results)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--hang', action='append', default=[], help="Đường dẫn bị treo, ví dụ /v1/me/following")
+    parser.add_argument('--fail', action='append', default=[], help="Đường dẫn luôn trả về 503")
+    parser.add_argument('--hang-seconds', type=float, default=30)
+    parser.add_argument('--check', action='store_true', help="Chạy kịch bản kiểm tra bộ ngắt mạch")
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if asyncio.run(check(args.port)) else 1)
+
+    server = serve(args.port, Faults(args.hang, args.fail, args.hang_seconds))
+    print(f"Fake Spotify listening on http://127.0.0.1:{server.server_address[1]}/v1/")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
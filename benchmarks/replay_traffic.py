@@ -0,0 +1,470 @@
+"""Phát lại lưu lượng đã ghi vào bot với Bot API và Spotify giả; đo thông lượng, độ trễ và số lời gọi Spotify.
+
+Ghi lưu lượng thật bằng cách chạy bot với TRAFFIC_RECORD_PATH (id người dùng được ẩn danh,
+token và nội dung tin nhắn tự do bị loại bỏ):
+
+    TRAFFIC_RECORD_PATH=traffic.jsonl.gz python bot.py
+
+Hoặc tạo bản ghi tổng hợp (chạy bot thật với Spotify giả, theo thời gian thực):
+
+    python benchmarks/replay_traffic.py synth traffic.jsonl.gz --users 50 --duration 30
+
+Phát lại ở tốc độ gốc (1), nhanh gấp 10 lần (10) hoặc nhanh nhất có thể (max), lưu mốc rồi
+kiểm tra hồi quy: mã thoát 1 nếu p95 hoặc số lời gọi Spotify mỗi update vượt ngưỡng so với mốc.
+
+    python benchmarks/replay_traffic.py replay traffic.jsonl.gz --speed max --save-baseline baseline.json
+    python benchmarks/replay_traffic.py replay traffic.jsonl.gz --speed max --baseline baseline.json
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "benchmark")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "benchmark")
+# Phiên, cache và ảnh chụp của lần chạy nằm trong thư mục tạm, không đụng tới dữ liệu thật
+os.environ["CACHE_DIR"] = tempfile.mkdtemp(prefix="replay_")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import requests  # noqa: E402
+import spotipy  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import bot  # noqa: E402
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'ReplayBot', 'username': 'replay_bot'}
+MESSAGE_METHODS = ('sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText')
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Bot API giả ở tầng HTTP của python-telegram-bot: trả lời thành công sau một độ trễ cố định."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_id = 1000
+        self._open = False
+
+    async def initialize(self) -> None:
+        self._open = True
+
+    async def shutdown(self) -> None:
+        # Như HTTPXRequest: sau shutdown không gửi được nữa, để lộ tin nhắn gửi sau khi bot đã đóng
+        self._open = False
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if not self._open:
+            raise RuntimeError("This FakeTelegramRequest is not initialized!")
+        name = url.rsplit('/', 1)[-1]
+        self.calls[name] += 1
+        params = request_data.parameters if request_data is not None else {}
+        if name == 'getMe':
+            result = BOT_USER
+        else:
+            await asyncio.sleep(self.latency)
+            if name in MESSAGE_METHODS:
+                self._message_id += 1
+                chat_id = int(params.get('chat_id', 0))
+                result = {'message_id': int(params.get('message_id', self._message_id)), 'date': int(time.time()),
+                          'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+                          'from': BOT_USER, 'text': params.get('text', '')}
+            else:
+                result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class RecordedSpotify:
+    """Spotify giả trả lời bằng phản hồi đã ghi, với độ trễ đã ghi.
+
+    Ưu tiên khớp đúng (người dùng, endpoint, tham số); nếu phiên bản bot mới gọi với tham số khác
+    thì dùng phản hồi cùng endpoint của người dùng đó, rồi của bất kỳ ai.
+    """
+
+    def __init__(self, latency_scale: float):
+        self.latency_scale = latency_scale
+        self.exact = defaultdict(list)
+        self.by_user = defaultdict(list)
+        self.by_endpoint = defaultdict(list)
+        self._cursors = Counter()
+        self._lock = threading.Lock()
+        self.calls = 0  # Lời gọi phát sinh từ việc xử lý update
+        self.background_calls = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(user, endpoint: str, args, kwargs) -> tuple:
+        return user, endpoint, json.dumps([list(args), kwargs], sort_keys=True, default=str)
+
+    def add(self, record: dict) -> None:
+        user, endpoint = record['user'], record['spotify']
+        self.exact[self.key(user, endpoint, record['args'], record['kwargs'])].append(record)
+        self.by_user[(user, endpoint)].append(record)
+        self.by_endpoint[endpoint].append(record)
+
+    def _pick(self, table: dict, key):
+        records = table.get(key)
+        if not records:
+            return None
+        with self._lock:
+            cursor = self._cursors[(id(table), key)]
+            self._cursors[(id(table), key)] += 1
+        # Dùng lần lượt các phản hồi đã ghi, hết thì lặp lại phản hồi cuối
+        return records[min(cursor, len(records) - 1)]
+
+    def respond(self, endpoint: str, args, kwargs):
+        context = bot.log_context.get()
+        user_id = context.get('user_id')
+        user = int(user_id) if user_id else None
+        record = self._pick(self.exact, self.key(user, endpoint, args, kwargs)) \
+            or self._pick(self.by_user, (user, endpoint)) or self._pick(self.by_endpoint, endpoint)
+        with self._lock:
+            if 'handler' in context:
+                self.calls += 1
+            else:
+                self.background_calls += 1
+            if record is None:
+                self.misses += 1
+        if record is None:
+            raise spotipy.SpotifyException(404, -1, f"{endpoint} not recorded")
+        time.sleep(record['latency'] * self.latency_scale)
+        error = record.get('error')
+        if error is None:
+            return record['result']
+        if 'http_status' in error:
+            raise spotipy.SpotifyException(error['http_status'], error['code'], error['msg'])
+        raise requests.exceptions.ConnectionError(error['type'])
+
+    def __getattr__(self, endpoint: str):
+        if endpoint.startswith('_'):
+            raise AttributeError(endpoint)
+
+        def call(*args, **kwargs):
+            return self.respond(endpoint, args, kwargs)
+
+        call.__name__ = endpoint
+        return call
+
+
+def read_log(path: str) -> tuple:
+    updates, spotify = [], []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            (updates if 'update' in record else spotify).append(record)
+    updates.sort(key=lambda record: record['t'])
+    return updates, spotify
+
+
+def update_user(data: dict):
+    for kind in ('message', 'callback_query', 'inline_query'):
+        if kind in data and 'from' in data[kind]:
+            return data[kind]['from']['id']
+    return None
+
+
+def login(user_ids) -> None:
+    """Mọi người dùng trong bản ghi được coi là đã đăng nhập với token còn hạn."""
+    for user_id in user_ids:
+        bot.get_session(str(user_id)).set_token_info({'access_token': 'replay', 'expires_in': 30 * 24 * 3600})
+
+
+async def start_app(telegram: FakeTelegramRequest) -> Application:
+    builder = Application.builder().token("1:replay").request(telegram).get_updates_request(telegram)
+    application = bot.build_application(builder)
+    await application.initialize()
+    await application.post_init(application)
+    # start() chỉ chạy vòng xử lý hàng đợi update (không polling), để task nền của handler được chờ khi dừng
+    await application.start()
+    return application
+
+
+async def stop_app(application: Application) -> None:
+    # Cùng thứ tự với run_polling
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))] if ordered else 0.0
+
+
+async def replay(args) -> dict:
+    updates, records = read_log(args.log)
+    spotify = RecordedSpotify(args.spotify_latency_scale)
+    for record in records:
+        spotify.add(record)
+    bot.spotify_client = lambda token: spotify
+    bot.app_sp = spotify
+    login({update_user(record['update']) for record in updates} - {None})
+
+    telegram = FakeTelegramRequest(args.telegram_latency)
+    application = await start_app(telegram)
+    if args.unthrottled:
+        # Bỏ giới hạn tốc độ gửi của Telegram để chỉ đo phần xử lý của bot
+        outbound = bot.default_tenant.outbound
+        outbound.global_rate = outbound.burst = 1e9
+        outbound.chat_interval = outbound.group_interval = 0.0
+    errors = []
+
+    async def on_error(update, context):
+        errors.append(context.error)
+
+    application.add_error_handler(on_error)
+    speed = float('inf') if args.speed == 'max' else float(args.speed)
+    slots = asyncio.Semaphore(bot.MAX_CONCURRENT_UPDATES)
+    latencies = []
+    tasks = []
+
+    async def process(update: Update) -> None:
+        started = time.perf_counter()
+        try:
+            await application.process_update(update)
+        finally:
+            latencies.append((time.perf_counter() - started) * 1000)
+            slots.release()
+
+    first = updates[0]['t'] if updates else 0
+    started = time.perf_counter()
+    for record in updates:
+        if speed != float('inf'):
+            delay = (record['t'] - first) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await slots.acquire()
+        tasks.append(asyncio.create_task(process(Update.de_json(record['update'], application.bot))))
+    await asyncio.gather(*tasks)
+    # Chờ các handler chạy nền (ví dụ inline query) và hàng đợi gửi tin nhắn
+    await asyncio.sleep(0)
+    await bot.default_tenant.outbound.flush(bot.OUTBOUND_FLUSH_TIMEOUT)
+    wall = time.perf_counter() - started
+    await stop_app(application)
+
+    count = len(updates)
+    return {
+        'updates': count,
+        'speed': args.speed,
+        'wall_seconds': round(wall, 2),
+        'throughput': round(count / wall, 1) if wall else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50), 1),
+        'p95_ms': round(percentile(latencies, 0.95), 1),
+        'p99_ms': round(percentile(latencies, 0.99), 1),
+        'spotify_calls_per_update': round(spotify.calls / count, 3) if count else 0.0,
+        'spotify_background_calls': spotify.background_calls,
+        'spotify_unmatched': spotify.misses,
+        'telegram_messages': sum(telegram.calls[name] for name in MESSAGE_METHODS),
+        'errors': len(errors),
+    }
+
+
+def check_regression(result: dict, baseline: dict, args) -> list:
+    problems = []
+    p95_limit = baseline['p95_ms'] * (1 + args.max_p95_regression)
+    if result['p95_ms'] > p95_limit:
+        problems.append(f"p95 {result['p95_ms']} ms > {p95_limit:.1f} ms (mốc {baseline['p95_ms']} ms)")
+    calls_limit = baseline['spotify_calls_per_update'] * (1 + args.max_calls_regression)
+    if result['spotify_calls_per_update'] > calls_limit + 1e-9:
+        problems.append(f"Spotify/update {result['spotify_calls_per_update']} > {calls_limit:.3f} "
+                        f"(mốc {baseline['spotify_calls_per_update']})")
+    return problems
+
+
+# --- Tạo bản ghi tổng hợp ---
+
+def synthetic_track(i: int) -> dict:
+    return {
+        'id': f"track{i:017d}", 'name': f"Bài hát {i}", 'type': 'track', 'duration_ms': 180000 + i % 60000,
+        'popularity': i % 101, 'uri': f"spotify:track:track{i:017d}",
+        'artists': [{'id': f"artist{i % 300:016d}", 'name': f"Nghệ sĩ {i % 300}"}],
+        'album': {'id': f"album{i // 8:017d}", 'name': f"Album {i // 8}", 'images': [],
+                  'available_markets': ['VN', 'US']},
+        'external_urls': {'spotify': f"https://open.spotify.com/track/track{i:017d}"},
+        'available_markets': ['VN', 'US'],
+    }
+
+
+class SyntheticSpotify:
+    """Spotify giả sinh dữ liệu theo người dùng, độ trễ ngẫu nhiên như mạng thật."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def _user(self) -> int:
+        return int(bot.log_context.get().get('user_id') or 0)
+
+    def _wait(self) -> None:
+        time.sleep(random.uniform(0.5, 1.5) * self.latency)
+
+    def _tracks(self, count: int, offset: int = 0) -> list:
+        base = self._user() % 5000
+        return [synthetic_track(base + i) for i in range(offset, offset + count)]
+
+    def current_user(self):
+        self._wait()
+        return {'type': 'user', 'id': f"spotify{self._user()}", 'display_name': 'Tên thật', 'email': 'x@example.com',
+                'country': 'VN', 'product': 'premium', 'external_urls': {}}
+
+    def current_user_top_tracks(self, limit=20, offset=0, time_range='medium_term'):
+        self._wait()
+        return {'items': self._tracks(limit), 'total': limit, 'next': None}
+
+    def current_user_top_artists(self, limit=20, offset=0, time_range='medium_term'):
+        self._wait()
+        return {'items': [{'id': f"artist{i:016d}", 'name': f"Nghệ sĩ {i}"} for i in range(limit)], 'next': None}
+
+    def current_user_saved_tracks(self, limit=20, offset=0):
+        self._wait()
+        total = 300
+        items = [{'added_at': "2026-10-01T00:00:00Z", 'track': track}
+                 for track in self._tracks(max(0, min(limit, total - offset)), offset)]
+        return {'items': items, 'total': total, 'next': 'more' if offset + limit < total else None}
+
+    def current_user_recently_played(self, limit=50):
+        self._wait()
+        return {'items': [{'track': track, 'played_at': "2026-10-19T08:00:00.000Z"} for track in self._tracks(limit)]}
+
+    def current_user_playing_track(self):
+        self._wait()
+        return {'is_playing': False, 'progress_ms': 1000, 'item': self._tracks(1)[0]}
+
+    def current_user_followed_artists(self, limit=20, after=None):
+        self._wait()
+        return {'artists': {'items': [], 'total': 12, 'next': None, 'cursors': {}}}
+
+    def current_user_playlists(self, limit=50, offset=0):
+        self._wait()
+        owner = {'type': 'user', 'id': f"spotify{self._user()}", 'display_name': 'Tên thật'}
+        items = [{'id': f"pl{self._user()}_{i}", 'name': f"Playlist {i}", 'snapshot_id': 's1', 'owner': owner,
+                  'tracks': {'total': 30}} for i in range(offset, min(offset + limit, 4))]
+        return {'items': items, 'total': 4, 'next': None}
+
+    def playlist_items(self, playlist_id, limit=100, offset=0, fields=None, additional_types=None, **kwargs):
+        self._wait()
+        return {'items': [{'track': track} for track in self._tracks(min(limit, 30 - offset), offset + 40)],
+                'total': 30, 'next': None}
+
+    def search(self, q, limit=10, type='track', **kwargs):
+        self._wait()
+        return {'tracks': {'items': self._tracks(limit, len(q) * 7), 'total': 500}}
+
+    def audio_features(self, tracks):
+        self._wait()
+        return [{'id': track_id, 'energy': 0.5, 'valence': 0.5, 'danceability': 0.5, 'acousticness': 0.2,
+                 'tempo': 120.0} for track_id in tracks]
+
+
+def synthetic_update(update_id: int, user_id: int, rng: random.Random) -> dict:
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'Tên thật', 'username': f"user{user_id}"}
+    chat = {'id': user_id, 'type': 'private', 'first_name': 'Tên thật'}
+    message = {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': user}
+    roll = rng.random()
+    if roll < 0.5:
+        message['text'] = bot.COMMANDS[rng.choice(('current', 'top', 'liked', 'recent', 'stats', 'playlists'))]
+    elif roll < 0.75:
+        view = rng.choice(list(bot.VIEW_LABELS))
+        data = bot.view_callback_data(view, rng.choice(bot.VIEW_AMOUNT_STEPS), rng.choice(list(bot.TOP_RANGE_LABELS)))
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'from': user, 'chat_instance': '1', 'data': data,
+            'message': {'message_id': 1, 'date': int(time.time()), 'chat': chat, 'from': BOT_USER, 'text': '…'}}}
+    elif roll < 0.85:
+        return {'update_id': update_id, 'inline_query': {
+            'id': str(update_id), 'from': user, 'query': rng.choice(("son tung", "den", "lofi chill", "adele")),
+            'offset': ''}}
+    else:
+        command = rng.choice(("/menu", "/top_all", "/find bai hat 1", "/settings", "/set_token {\"access_token\": \"secret\", \"expires_in\": 3600}"))
+        message['text'] = command
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+async def synthesize(args) -> None:
+    if os.path.exists(args.log):
+        os.remove(args.log)
+    bot.traffic_recorder = bot.TrafficRecorder(args.log)
+    spotify = SyntheticSpotify(args.spotify_latency)
+    bot.spotify_client = lambda token: spotify
+    bot.app_sp = spotify
+    rng = random.Random(args.seed)
+    users = [10_000 + i for i in range(args.users)]
+    login(users)
+    application = await start_app(FakeTelegramRequest(args.telegram_latency))
+    tasks = []
+    deadline = time.monotonic() + args.duration
+    rate = args.users * args.actions_per_minute / 60
+    update_id = 0
+    while time.monotonic() < deadline:
+        await asyncio.sleep(rng.expovariate(rate))
+        update_id += 1
+        data = synthetic_update(update_id, rng.choice(users), rng)
+        tasks.append(asyncio.create_task(application.process_update(Update.de_json(data, application.bot))))
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await bot.default_tenant.outbound.flush(bot.OUTBOUND_FLUSH_TIMEOUT)
+    await stop_app(application)
+    print(f"đã ghi {update_id} update vào {args.log} ({os.path.getsize(args.log) / 1024:.0f} KiB)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    play = commands.add_parser('replay', help="phát lại một bản ghi")
+    play.add_argument('log')
+    play.add_argument('--speed', default='1', help="1, 10, ... hoặc max")
+    play.add_argument('--telegram-latency', type=float, default=0.05)
+    play.add_argument('--spotify-latency-scale', type=float, default=1.0,
+                      help="nhân độ trễ Spotify đã ghi (0 để bỏ qua)")
+    play.add_argument('--unthrottled', action='store_true',
+                      help="bỏ giới hạn tin nhắn/giây của Telegram trong hàng đợi gửi")
+    play.add_argument('--save-baseline', help="ghi kết quả làm mốc")
+    play.add_argument('--baseline', help="so sánh với mốc; mã thoát 1 nếu hồi quy")
+    play.add_argument('--max-p95-regression', type=float, default=0.2, help="p95 được phép tăng (tỉ lệ)")
+    play.add_argument('--max-calls-regression', type=float, default=0.1,
+                      help="số lời gọi Spotify mỗi update được phép tăng (tỉ lệ)")
+
+    synth = commands.add_parser('synth', help="tạo bản ghi tổng hợp")
+    synth.add_argument('log')
+    synth.add_argument('--users', type=int, default=50)
+    synth.add_argument('--duration', type=float, default=30, help="số giây ghi")
+    synth.add_argument('--actions-per-minute', type=float, default=6, help="thao tác mỗi người dùng mỗi phút")
+    synth.add_argument('--spotify-latency', type=float, default=0.15)
+    synth.add_argument('--telegram-latency', type=float, default=0.05)
+    synth.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == 'synth':
+        asyncio.run(synthesize(args))
+        return
+
+    result = asyncio.run(replay(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            problems = check_regression(result, json.load(f), args)
+        if problems:
+            print("HỒI QUY HIỆU NĂNG:\n  " + "\n  ".join(problems))
+            sys.exit(1)
+        print("Không có hồi quy so với mốc.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,143 @@
 import os
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
+import sys
+import asyncio
+import sqlite3
+import heapq
+import math
+import time
+import hashlib
+import hmac
+import io
+import atexit
+import contextvars
+import queue
+import random
+import pickle
+import signal
+import threading
+import csv
+import gzip
+import tempfile
+import unicodedata
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+import httpx
+from telegram import (
+    Update, Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup,
+    InlineQueryResultArticle, InputTextMessageContent
+)
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
+from telegram.ext import (
+    Application, CallbackQueryHandler, CommandHandler, InlineQueryHandler, MessageHandler, TypeHandler,
+    ContextTypes, filters
+)
 import spotipy
-from spotipy.oauth2 import SpotifyOAuth
+from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import json
 from datetime import datetime, timedelta
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# Thiết lập logging
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:  # Pillow là tùy chọn: không có thì gửi ảnh bìa gốc thay cho thẻ
+    Image = ImageDraw = ImageFont = None
+
+# Thiết lập logging: handler chỉ đưa bản ghi vào hàng đợi, một thread nền định dạng và ghi ra stderr
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json hoặc text
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))  # Tỉ lệ giữ lại log INFO khối lượng lớn
+LOG_SAMPLED_LOGGERS = ('httpx', 'bot.updates')  # httpx ghi một dòng cho mỗi request tới Telegram
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_SLOW_UPDATE_MS = 2000  # Update xử lý lâu hơn mức này luôn được ghi log (không lấy mẫu)
+
+# Ngữ cảnh của update đang xử lý; asyncio.to_thread sao chép ngữ cảnh nên log trong thread cũng có
+log_context = contextvars.ContextVar('log_context', default={})
+
+class JsonFormatter(logging.Formatter):
+    """Định dạng bản ghi thành một dòng JSON, kèm user_id/handler/latency_ms nếu có."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in ('user_id', 'handler', 'latency_ms'):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class ContextFilter(logging.Filter):
+    """Gắn ngữ cảnh update vào bản ghi và lấy mẫu log INFO của các logger nhiều log.
+
+    Chạy ở luồng gọi log (trước khi vào hàng đợi) nên bản ghi bị bỏ không tốn gì thêm.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING and record.name in LOG_SAMPLED_LOGGERS \
+                and random.random() >= LOG_SAMPLE_RATE:
+            return False
+        for field, value in log_context.get().items():
+            if not hasattr(record, field):
+                setattr(record, field, value)
+        return True
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler không định dạng trước: việc ghép chuỗi %-format diễn ra ở thread nền."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def setup_logging(stream=None) -> QueueListener:
+    """Cấu hình root logger dùng hàng đợi; trả về QueueListener (đã chạy) để dừng khi thoát."""
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(LOG_TEXT_FORMAT))
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+
+    def stop():
+        # QueueListener.stop() lỗi nếu gọi hai lần (Python < 3.12)
+        if listener._thread is not None:
+            listener.stop()
+
+    atexit.register(stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
+update_logger = logging.getLogger('bot.updates')  # Một dòng cho mỗi update (được lấy mẫu)
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
-SPOTIFY_REDIRECT_URI = "https://tanbaycu-first.vercel.app/spotify_auth"
+SPOTIFY_REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI", "https://tanbaycu-first.vercel.app/spotify_auth")
+# Nhiều bot trong một tiến trình: TENANTS=brand2,brand3 kèm BRAND2_TELEGRAM_TOKEN, BRAND2_SPOTIFY_CLIENT_ID,
+# BRAND2_SPOTIFY_CLIENT_SECRET (và BRAND2_SPOTIFY_REDIRECT_URI nếu khác) cho từng bot thêm vào
+DEFAULT_TENANT = "default"  # Bot chạy bằng TELEGRAM_TOKEN, giữ nguyên khóa user_id cũ
+TENANT_NAMES = [name.strip() for name in os.getenv("TENANTS", "").split(",") if name.strip()]
 EMAIL_HOST = "smtp.gmail.com"
 EMAIL_PORT = 587
 EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER")
@@ -25,12 +145,62 @@ EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
 
 SPOTIFY_SCOPE = "user-read-currently-playing user-top-read user-read-recently-played playlist-read-private user-library-read user-read-email user-read-private user-follow-read"
 
-# Lưu trữ token và cài đặt người dùng
-user_data = {}
+# Cài đặt người dùng (phiên được lưu trong SessionStore)
 DEFAULT_AMOUNT = 5
 MAX_AMOUNT = 50  # Giới hạn tối đa để tránh spam và lỗi API
 
-sp_oauth = SpotifyOAuth(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_REDIRECT_URI, scope=SPOTIFY_SCOPE)
+# Giới hạn thời gian cho lời gọi Spotify. requests_timeout chặn thời gian một thread bị giữ bởi
+# kết nối treo; thời gian chờ theo endpoint (ngắn hơn) quyết định khi nào người dùng nhận phản hồi.
+SPOTIFY_REQUEST_TIMEOUT = 10
+SPOTIFY_HTTP_RETRIES = 1  # spotipy mặc định thử lại 3 lần với backoff, quá lâu khi endpoint đang treo
+SPOTIFY_HTTP_POOL_SIZE = 32  # Kết nối giữ sẵn tới Spotify, dùng chung cho mọi client và mọi bot
+TELEGRAM_POOL_SIZE = 256  # Pool kết nối tới Bot API dùng chung cho mọi bot (bằng mặc định của PTB)
+SPOTIFY_DEFAULT_TIMEOUT = 8
+SPOTIFY_TIMEOUTS = {
+    'current_user_playing_track': 4,
+    'search': 4,
+    'current_user': 5,
+    'current_user_followed_artists': 5,
+    'current_user_recently_played': 6,
+    'playlist_items': 15,
+    'audio_features': 15,
+    'refresh_access_token': 10,
+}
+SPOTIFY_BREAKER_THRESHOLD = 5  # Số lỗi liên tiếp để ngắt mạch một endpoint
+SPOTIFY_BREAKER_COOLDOWN = 30
+SPOTIFY_BREAKER_MAX_COOLDOWN = 300
+
+class SharedHTTPSession(requests.Session):
+    """Session requests dùng chung cho mọi client spotipy để tái sử dụng kết nối (không bắt tay TLS mỗi lần).
+
+    spotipy đóng session trong __del__ của từng client, nên close() ở đây không làm gì;
+    pool chỉ được đóng thật bằng shutdown() khi tắt bot.
+    """
+
+    def __init__(self, retries: int = SPOTIFY_HTTP_RETRIES, pool_size: int = SPOTIFY_HTTP_POOL_SIZE):
+        super().__init__()
+        # Cùng chính sách thử lại như session spotipy tự tạo
+        retry = Retry(total=retries, connect=None, read=False, allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+                      status=retries, backoff_factor=0.3, status_forcelist=spotipy.Spotify.default_retry_codes)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def close(self) -> None:
+        pass
+
+    def shutdown(self) -> None:
+        super().close()
+
+spotify_http = SharedHTTPSession()
+
+# Client dùng token của ứng dụng (client credentials) cho các truy vấn danh mục chung như tìm kiếm,
+# không tiêu tốn token của từng người dùng
+app_sp = spotipy.Spotify(
+    client_credentials_manager=SpotifyClientCredentials(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET,
+                                                        requests_session=spotify_http),
+    requests_session=spotify_http, requests_timeout=SPOTIFY_REQUEST_TIMEOUT
+)
 
 # Định nghĩa các lệnh và nút tương ứng
 COMMANDS = {
@@ -46,41 +216,1101 @@ COMMANDS = {
 
 # Thêm hằng số cho thời gian hết hạn token
 TOKEN_EXPIRATION_TIME = 3600  # 1 giờ, điều chỉnh theo thực tế của Spotify API
+TOKEN_REFRESH_MARGIN = 60  # Tác vụ nền làm mới token sắp hết hạn trong khoảng này trước khi gọi Spotify
+
+# Máy chủ nhận callback OAuth (đặt OAUTH_CALLBACK_PORT để bật): SPOTIFY_REDIRECT_URI phải trỏ tới máy chủ này,
+# thường qua reverse proxy HTTPS, và được khai báo trong Spotify Developer Dashboard
+OAUTH_CALLBACK_HOST = os.getenv("OAUTH_CALLBACK_HOST", "127.0.0.1")
+OAUTH_CALLBACK_PORT = int(os.getenv("OAUTH_CALLBACK_PORT", "0"))
+SPOTIFY_ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com").rstrip('/')
+OAUTH_STATE_SECRET = os.getenv("OAUTH_STATE_SECRET", "").encode() or os.urandom(32)
+OAUTH_STATE_TTL = 900  # Liên kết xác thực dùng được trong 15 phút
+OAUTH_EXCHANGE_TIMEOUT = 10
+OAUTH_READ_TIMEOUT = 10  # Thời gian chờ tối đa để đọc request từ trình duyệt
+OAUTH_MAX_HEADERS = 100
+OAUTH_LOGIN_PRUNE_SIZE = 1000  # Số state đã dùng giữ lại trước khi dọn các state hết hạn
+
+# Kho phiên người dùng
+SESSION_DB_PATH = os.path.join(os.getenv("CACHE_DIR", "cache"), "sessions.db")
+SESSION_IDLE_SECONDS = 1800  # Phiên không hoạt động 30 phút sẽ được đẩy xuống đĩa
+SESSION_EVICT_INTERVAL = 300
+# Bit 1 từng dùng cho cờ "đã gửi email sắp hết hạn", nay do NotificationLedger đảm nhiệm
+FLAG_RELEASE_WATCH = 2  # Nhận thông báo bản phát hành mới
+FLAG_WEEKLY_DIGEST = 4  # Nhận bản tin tuần
+FLAG_DIGEST_EMAIL = 8  # Gửi thêm bản tin tuần qua email
+
+# Dừng nhẹ nhàng và khởi động ấm
+MAX_CONCURRENT_UPDATES = 64  # Mỗi update chạy trong task riêng để handler chậm không chặn người khác
+SHUTDOWN_DRAIN_TIMEOUT = 20
+SNAPSHOT_PATH = os.path.join(os.getenv("CACHE_DIR", "cache"), "state.pickle")
+SNAPSHOT_VERSION = 1
+SNAPSHOT_MAX_AGE = 24 * 3600
+
+# Tải trước màn hình sau khi hiện menu (đặt PREFETCH_ENABLED=0 để tắt)
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_VIEWS = 2  # Số màn hình được tải trước mỗi lần hiện menu
+PREFETCH_TTL = {'current': 20, 'top': 3600, 'liked': 300, 'recent': 120}  # Dữ liệu tải trước dùng được bao lâu
+PREFETCH_DEFAULT_ORDER = ('current', 'top', 'liked', 'recent')
+PREFETCH_WARMUP_WINDOW = 6 * 3600  # Người dùng hoạt động trong khoảng này được làm ấm cache khi khởi động
+PREFETCH_WARMUP_USERS = 200
+PREFETCH_REPORT_INTERVAL = 3600
+
+# Thông báo về phiên đăng nhập: thời gian chờ theo loại, gộp các thông báo đến cùng lúc
+NOTICE_COALESCE_SECONDS = 3
+NOTICE_COOLDOWNS = {'expiring': 45 * 60, 'refreshed': 6 * 3600, 'expired': 3600}
+NOTICE_SUPERSEDES = {'refreshed': ('expiring',), 'expired': ('expiring', 'refreshed')}
+NOTICE_ORDER = ('expired', 'refreshed', 'expiring')  # Thứ tự trong tin nhắn gộp
+
+# Ngân sách gọi Spotify cho các tác vụ nền (để dành phần còn lại cho thao tác của người dùng)
+SPOTIFY_BACKGROUND_RATE = 5  # lời gọi/giây
+SPOTIFY_BACKGROUND_BURST = 10
+
+# Cấu hình chế độ "đang phát" trực tiếp (/live)
+LIVE_TICK_SECONDS = 1.0
+LIVE_BATCH_SIZE = 200  # Số người dùng tối đa được poll trong một tick
+LIVE_MAX_CONCURRENCY = 20  # Số lời gọi Spotify chạy song song
+LIVE_MIN_INTERVAL = 3
+LIVE_MAX_INTERVAL = 15
+LIVE_PAUSED_INTERVAL = 30  # Khi không phát nhạc thì poll thưa hơn
+LIVE_EDIT_INTERVAL = 5  # Khoảng cách tối thiểu giữa hai lần sửa cùng một tin nhắn
+LIVE_MAX_DURATION = 3600  # Tự động tắt sau 1 giờ
+
+# Hàng đợi gửi tin nhắn (giới hạn của Telegram: ~30 tin/giây, 1 tin/giây mỗi chat, 20 tin/phút mỗi nhóm)
+OUTBOUND_GLOBAL_RATE = 28  # Chừa khoảng an toàn dưới giới hạn 30
+OUTBOUND_GLOBAL_BURST = 5  # Bucket nhỏ để không vượt 30 tin trong bất kỳ cửa sổ 1 giây nào
+OUTBOUND_CHAT_INTERVAL = 1.05
+OUTBOUND_GROUP_INTERVAL = 3.0
+OUTBOUND_MAX_INFLIGHT = 32
+OUTBOUND_MAX_RETRIES = 3
+OUTBOUND_SCAN_LIMIT = 1000
+OUTBOUND_IDLE_WAIT = 1.0
+OUTBOUND_CHAT_STATE_LIMIT = 10000
+OUTBOUND_FLUSH_TIMEOUT = 10
+OUTBOUND_GLOBAL_PAUSE_THRESHOLD = 5
+PRIORITY_INTERACTIVE = 0  # Phản hồi trực tiếp cho người dùng
+PRIORITY_NOTIFICATION = 1  # Thông báo do bot tự gửi
+PRIORITY_LIVE = 2  # Cập nhật tin nhắn live, có thể bị thay thế
+
+# Tìm kiếm inline (@bot <từ khóa>)
+SEARCH_LIMIT = 20
+SEARCH_CACHE_SIZE = 5000
+SEARCH_CACHE_TTL = 3600
+INLINE_DEBOUNCE = 0.25  # Chờ người dùng ngừng gõ trước khi gọi Spotify
+INLINE_CACHE_TIME = 300  # Telegram cache kết quả phía server
+
+# Thẻ ảnh "đang phát"
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+ART_CACHE_DIR = os.path.join(CACHE_DIR, "art")
+ART_DOWNLOAD_TIMEOUT = 10
+ART_INDEX_LIMIT = 20000  # Số URL tối đa giữ trong chỉ mục ảnh bìa (bỏ URL dùng lâu nhất)
+CARD_COVER_SIZE = 640
+CARD_TEXT_HEIGHT = 160
+CARD_FONT = "DejaVuSans.ttf"
+CARD_CACHE_SIZE = 128  # Số thẻ đã vẽ giữ trong bộ nhớ
+CARD_FILE_ID_LIMIT = 100000
+CARD_RENDER_WORKERS = 2
+
+# Cache danh mục bài hát dùng chung
+CATALOG_MAX_TRACKS = 200000
+
+# Audio features (không đổi theo thời gian nên cache vĩnh viễn trên đĩa)
+AUDIO_FEATURES_DB_PATH = os.path.join(CACHE_DIR, "audio_features.db")
+AUDIO_FEATURES_BATCH_SIZE = 100  # Giới hạn id của một lời gọi audio_features
+AUDIO_FEATURES_MEMORY_SIZE = 20000
+AUDIO_FEATURES_RETRY_AFTER = 6 * 3600  # Thử lại sau khi endpoint trả về 403/404
+AUDIO_FEATURE_FIELDS = ('energy', 'valence', 'danceability', 'acousticness', 'tempo')
+
+# Bảng xếp hạng theo khoảng thời gian; dữ liệu dài hạn ít thay đổi nên cache lâu hơn
+TOP_RANGE_TTL = {'short_term': 3600, 'medium_term': 6 * 3600, 'long_term': 24 * 3600}
+TOP_RANGE_LABELS = {'short_term': '4 tuần qua', 'medium_term': '6 tháng qua', 'long_term': 'Mọi thời điểm'}
+TOP_FETCH_LIMIT = 50  # Luôn lấy tối đa (cùng một lời gọi API) rồi cắt theo số lượng hiển thị
+TOP_ALL_LIMIT = 10  # Giới hạn mỗi danh sách trong /top_all để tin nhắn không quá dài
+
+# Phân tích playlist
+PLAYLIST_PAGE_SIZE = 50
+PLAYLIST_ITEMS_PAGE_SIZE = 100
+PLAYLIST_FETCH_CONCURRENCY = 8  # Số trang được tải song song cho một người dùng
+PLAYLIST_CACHE_SIZE = 20000
+PLAYLIST_REPORT_LIMIT = 5
+PLAYLIST_INDEX_TTL = 600  # Danh sách playlist được dùng lại trong 10 phút
+PLAYLIST_CHANGES_MAX_AGE = 60
+
+# Xuất thư viện (/export)
+EXPORT_PAGE_SIZE = 50
+EXPORT_PLAYLIST_PAGE_SIZE = 100
+EXPORT_ITEM_FIELDS = "next,items(added_at,track(id,uri,type,name,duration_ms,artists(name),album(name)))"
+EXPORT_FIELDS = ('section', 'playlist', 'track_id', 'name', 'artists', 'album', 'duration_ms', 'timestamp')
+
+# Theo dõi bản phát hành mới
+RELEASE_TICK_SECONDS = 10
+RELEASE_POLL_INTERVAL = 6 * 3600  # Mỗi nghệ sĩ được kiểm tra một lần trong chu kỳ này
+RELEASE_FOLLOW_REFRESH = 12 * 3600  # Lấy lại danh sách nghệ sĩ đang theo dõi
+RELEASE_RETRY_INTERVAL = 3600  # Chờ trước khi thử lại khi lấy danh sách theo dõi thất bại
+RELEASE_USERS_PER_TICK = 5
+RELEASE_PAGE_SIZE = 10  # Số bản phát hành mới nhất lấy cho mỗi nhóm
+RELEASE_GROUPS = ('album', 'single')  # Poll riêng từng nhóm: Spotify trả album trước rồi mới tới single
+RELEASE_MAX_AGE_DAYS = 14  # Bỏ qua các album cũ mới được thêm vào danh mục
+
+# Bản tin tuần: chạy vào giờ thấp điểm, rải lời gọi Spotify trong cả khung giờ
+DIGEST_WEEKDAY = 0  # Thứ Hai
+DIGEST_START_HOUR = 2
+DIGEST_WINDOW_HOURS = 4
+DIGEST_CHECK_INTERVAL = 600
+DIGEST_MAX_ATTEMPTS = 3  # Số lần thử tối đa cho mỗi người dùng trong một tuần
+DIGEST_CHECKPOINT_PATH = os.path.join(CACHE_DIR, "digest_checkpoint.jsonl")
+DIGEST_RENDER_WORKERS = 2
+DIGEST_TOP_LIMIT = 10
+DIGEST_NEW_LIMIT = 10
+
+# Bảng xếp hạng nhóm
+GROUP_TIME_RANGE = 'medium_term'
+GROUP_REFRESH_TICK = 60
+GROUP_REFRESH_PER_TICK = 20
+GROUP_RETRY_INTERVAL = 3600  # Chờ trước khi làm mới lại thành viên có token hết hạn/lỗi
+GROUP_BOARD_LIMIT = 10
+GROUP_PAIR_LIMIT = 10
+
+# Gợi ý bài hát (/discover)
+DISCOVER_ITEMS_PER_USER = 100  # Giới hạn số bài mỗi người dùng để số cặp không tăng quá nhanh
+DISCOVER_APPLY_INTERVAL = 30
+
+# Giao diện nút bấm inline: một tin nhắn được sửa tại chỗ khi chuyển màn hình, khoảng thời gian hoặc số lượng
+VIEW_FETCH_LIMIT = 50  # Luôn lấy tối đa (cùng một lời gọi API) rồi cắt, để đổi số lượng không phải gọi lại
+VIEW_CACHE_TTL = {'current': 15, 'liked': 300, 'recent': 60, 'stats': 300}
+VIEW_CACHE_PRUNE_SIZE = 1000
+VIEW_AMOUNT_STEPS = (5, 10, 20, 30, 50)
+VIEW_LABELS = {
+    'current': "🎵 Đang phát",
+    'top': "🏆 Top",
+    'liked': "❤️ Yêu thích",
+    'recent': "🔄 Gần đây",
+    'stats': "📊 Thống kê",
+    'playlists': "📋 Playlist",
+}
+VIEW_AMOUNT_VIEWS = ('top', 'liked', 'recent', 'playlists')  # Màn hình có nút đổi số lượng
+
+# Ghi lại lưu lượng (update Telegram + phản hồi Spotify) để phát lại khi đo hiệu năng; đặt đường dẫn để bật
+TRAFFIC_RECORD_PATH = os.getenv("TRAFFIC_RECORD_PATH", "")
+TRAFFIC_RECORD_SALT = os.getenv("TRAFFIC_RECORD_SALT", "")  # Giữ nguyên id ẩn danh qua các lần khởi động
+TRAFFIC_QUEUE_LIMIT = 10000  # Quá giới hạn thì bỏ bản ghi thay vì làm chậm bot
+TRAFFIC_FLUSH_EVERY = 200
+TRAFFIC_SKIP_ENDPOINTS = ('refresh_access_token', 'get_access_token')  # Phản hồi chứa token
+TRAFFIC_DROP_KEYS = frozenset(('available_markets', 'email', 'birthdate'))
+TRAFFIC_SECRET_COMMANDS = ('/set_token',)
+
+# Tìm kiếm trong thư viện (/find)
+LIBRARY_PAGE_SIZE = 50
+LIBRARY_REFRESH_INTERVAL = 600  # Sau khoảng này /find bổ sung bài mới trong nền
+LIBRARY_REBUILD_INTERVAL = 24 * 3600  # Lập lại toàn bộ để loại bài đã bỏ thích hoặc bị xóa khỏi playlist
+LIBRARY_MAX_USERS = 500
+FIND_RESULT_LIMIT = 10
+FIND_MIN_SCORE = 0.5  # Tỉ lệ trigram của truy vấn phải có trong bài hát
+FIND_BUILD_WAIT = 5  # Thời gian chờ tối đa khi chỉ mục còn trống
+# Chỉ lấy các trường cần thiết để giảm dung lượng phản hồi
+PLAYLIST_ITEM_FIELDS = "total,items(track(id,uri,type,name,duration_ms,popularity,artists(id,name),album(id,name)))"
 
 def get_main_keyboard():
     keyboard = [[KeyboardButton(text)] for text in COMMANDS.values()]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
-def init_user_data(user_id: str) -> None:
-    """Khởi tạo dữ liệu người dùng nếu chưa tồn tại"""
-    if user_id not in user_data:
-        user_data[user_id] = {
-            'token': None,
-            'refresh_token': None,
-            'amount': DEFAULT_AMOUNT,
-            'last_command': None,
-            'token_expiration': None
-        }
+class UserSession:
+    """Phiên của một người dùng; dùng __slots__ để mỗi phiên chỉ tốn vài chục byte."""
+    __slots__ = ('token', 'refresh_token', 'expires_at', 'amount', 'flags', 'last_active')
+
+    def __init__(self, token=None, refresh_token=None, expires_at: int = 0, amount: int = DEFAULT_AMOUNT,
+                 flags: int = 0, last_active: int = 0):
+        self.token = token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at  # epoch (giây), 0 nếu chưa biết
+        self.amount = amount
+        self.flags = flags
+        self.last_active = last_active
+
+    def set_token_info(self, token_info: dict) -> None:
+        self.token = token_info['access_token']
+        self.refresh_token = token_info.get('refresh_token', self.refresh_token)
+        self.expires_at = int(time.time()) + int(token_info.get('expires_in', TOKEN_EXPIRATION_TIME))
+
+    def has_flag(self, flag: int) -> bool:
+        return bool(self.flags & flag)
+
+    def is_default(self) -> bool:
+        """Phiên không có gì đáng lưu (chưa đăng nhập, cài đặt mặc định)."""
+        return not self.token and not self.refresh_token and self.amount == DEFAULT_AMOUNT and not self.flags
+
+class SessionStore:
+    """Kho phiên hai tầng: phiên đang hoạt động nằm trong bộ nhớ, phiên nhàn rỗi được đẩy xuống SQLite.
+
+    Phiên bị đẩy xuống đĩa được nạp lại trong suốt ở tin nhắn tiếp theo của người dùng.
+    Phiên mặc định (chưa đăng nhập) không được ghi xuống đĩa mà bỏ đi luôn.
+    """
+
+    def __init__(self, path: str = SESSION_DB_PATH, idle_seconds: int = SESSION_IDLE_SECONDS):
+        self.path = path
+        self.idle_seconds = idle_seconds
+        self._active = {}  # user_id -> UserSession
+        self._db = None
+        self._task = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path)
+            os.chmod(self.path, 0o600)  # File chứa token, chỉ chủ sở hữu được đọc
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "user_id TEXT PRIMARY KEY, token TEXT, refresh_token TEXT, expires_at INTEGER, "
+                "amount INTEGER, flags INTEGER, last_active INTEGER)"
+            )
+        return self._db
+
+    def get(self, user_id: str):
+        """Lấy phiên (nạp từ đĩa nếu cần), trả về None nếu người dùng chưa có phiên."""
+        session = self._active.get(user_id)
+        if session is None:
+            session = self.peek(user_id)
+            if session is None:
+                return None
+            self._active[user_id] = session
+        session.last_active = int(time.time())
+        return session
+
+    def peek(self, user_id: str):
+        """Đọc phiên cho tác vụ nền: không cập nhật last_active và không nạp phiên vào bộ nhớ."""
+        session = self._active.get(user_id)
+        if session is None:
+            row = self._connection().execute(
+                "SELECT token, refresh_token, expires_at, amount, flags, last_active FROM sessions WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()
+            if row is not None:
+                session = UserSession(*row)
+        return session
+
+    def flagged(self, flag: int) -> list:
+        """Danh sách user_id có bật cờ, cả trong bộ nhớ lẫn trên đĩa."""
+        user_ids = {user_id for user_id, s in self._active.items() if s.flags & flag}
+        user_ids.update(
+            row[0] for row in self._connection().execute("SELECT user_id FROM sessions WHERE flags & ?", (flag,))
+            if row[0] not in self._active
+        )
+        return sorted(user_ids)
+
+    def recent(self, since: float, limit: int) -> list:
+        """user_id hoạt động gần đây nhất (sau `since`), cả trong bộ nhớ lẫn trên đĩa."""
+        active = {user_id: s.last_active for user_id, s in self._active.items() if s.last_active >= since}
+        for user_id, last_active in self._connection().execute(
+                "SELECT user_id, last_active FROM sessions WHERE last_active >= ? ORDER BY last_active DESC LIMIT ?",
+                (int(since), limit)):
+            active.setdefault(user_id, last_active)
+        return sorted(active, key=active.get, reverse=True)[:limit]
+
+    def update_token(self, user_id: str, session: UserSession) -> None:
+        """Lưu token mới của phiên đọc bằng peek mà không nạp phiên vào bộ nhớ."""
+        active = self._active.get(user_id)
+        if active is None:
+            self._write([(user_id, session)])
+        elif active is not session:
+            active.token, active.refresh_token, active.expires_at = \
+                session.token, session.refresh_token, session.expires_at
+
+    def get_or_create(self, user_id: str) -> UserSession:
+        session = self.get(user_id)
+        if session is None:
+            session = UserSession(last_active=int(time.time()))
+            self._active[user_id] = session
+        return session
+
+    def active_count(self) -> int:
+        return len(self._active)
 
-async def refresh_token(user_id: str) -> bool:
+    def _write(self, items) -> None:
+        db = self._connection()
+        with db:
+            db.executemany(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(user_id, s.token, s.refresh_token, s.expires_at, s.amount, s.flags, s.last_active)
+                 for user_id, s in items]
+            )
+
+    def _delete(self, user_ids) -> None:
+        db = self._connection()
+        with db:
+            db.executemany("DELETE FROM sessions WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+
+    def evict_idle(self, now: int = None) -> int:
+        """Đẩy các phiên nhàn rỗi xuống đĩa và giải phóng khỏi bộ nhớ."""
+        cutoff = (now or int(time.time())) - self.idle_seconds
+        idle = [(user_id, s) for user_id, s in self._active.items() if s.last_active < cutoff]
+        if not idle:
+            return 0
+        self._write([(user_id, s) for user_id, s in idle if not s.is_default()])
+        self._delete([user_id for user_id, s in idle if s.is_default()])
+        for user_id, _ in idle:
+            del self._active[user_id]
+        return len(idle)
+
+    def flush(self) -> None:
+        """Ghi toàn bộ phiên đang hoạt động xuống đĩa (khi tắt bot)."""
+        self._write([(user_id, s) for user_id, s in self._active.items() if not s.is_default()])
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(SESSION_EVICT_INTERVAL)
+            try:
+                evicted = self.evict_idle()
+                if evicted:
+                    logger.info("Evicted %s idle sessions, %s active", evicted, len(self._active))
+            except Exception as e:
+                logger.error("Error evicting sessions: %s", e)
+
+sessions = SessionStore()
+
+def get_session(user_id: str) -> UserSession:
+    """Lấy phiên của người dùng, tạo mới nếu chưa tồn tại"""
+    return sessions.get_or_create(user_id)
+
+async def refresh_token(user_id: str, session: UserSession = None) -> bool:
+    """Làm mới token; tác vụ nền truyền phiên đọc bằng peek để không nạp phiên vào bộ nhớ."""
     try:
-        token_info = sp_oauth.refresh_access_token(user_data[user_id]['refresh_token'])
-        user_data[user_id]['token'] = token_info['access_token']
-        user_data[user_id]['refresh_token'] = token_info['refresh_token']
-        
-        # Cập nhật thời gian hết hạn
-        expires_in = token_info.get('expires_in', TOKEN_EXPIRATION_TIME)
-        user_data[user_id]['token_expiration'] = datetime.now() + timedelta(seconds=expires_in)
-        
+        peeked = session is not None
+        session = session or get_session(user_id)
+        token_info = await sp_call(tenant_of(user_id).oauth.refresh_access_token, session.refresh_token)
+        # Cập nhật token và thời gian hết hạn
+        session.set_token_info(token_info)
+        if peeked:
+            sessions.update_token(user_id, session)
         return True
     except Exception as e:
-        logger.error(f"Error refreshing token: {e}")
+        logger.error("Error refreshing token: %s", e)
+        return False
+
+def token_expired(session: UserSession) -> bool:
+    """Token đã hoặc sắp hết hạn (expires_at = 0 nghĩa là chưa biết, coi như còn hạn)."""
+    return bool(session.expires_at) and session.expires_at - TOKEN_REFRESH_MARGIN <= time.time()
+
+async def background_token(user_id: str):
+    """Token dùng được cho tác vụ nền: đọc phiên bằng peek, làm mới nếu đã/sắp hết hạn (tính vào
+    ngân sách gọi Spotify nền). Trả về None nếu người dùng chưa đăng nhập hoặc không làm mới được."""
+    session = sessions.peek(user_id)
+    if session is None or not session.token:
+        return None
+    if token_expired(session):
+        if not session.refresh_token:
+            return None
+        await spotify_budget.acquire()
+        if not await refresh_token(user_id, session):
+            return None
+    return session.token
+
+class SpotifyUnavailable(Exception):
+    """Endpoint Spotify đang treo hoặc lỗi liên tục: lời gọi bị hết thời gian chờ hoặc bị ngắt mạch."""
+
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(f"{endpoint} unavailable, retry in {retry_after:.0f}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Bộ ngắt mạch cho một endpoint Spotify.
+
+    Sau `threshold` lỗi liên tiếp (hết thời gian chờ, lỗi 5xx/mạng) mạch mở và mọi lời gọi
+    thất bại ngay trong thời gian nghỉ. Hết thời gian nghỉ, đúng một lời gọi được cho đi thử:
+    thành công thì đóng mạch, thất bại thì mở lại với thời gian nghỉ gấp đôi (có giới hạn).
+    """
+
+    def __init__(self, threshold: int = SPOTIFY_BREAKER_THRESHOLD, cooldown: float = SPOTIFY_BREAKER_COOLDOWN,
+                 max_cooldown: float = SPOTIFY_BREAKER_MAX_COOLDOWN):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.failures < self.threshold:
+            return 'closed'
+        return 'half_open' if time.monotonic() >= self.open_until else 'open'
+
+    def retry_after(self) -> float:
+        return max(0.0, self.open_until - time.monotonic())
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self.probing:
+            self.probing = True
+            return True
         return False
 
+    def record_success(self) -> None:
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.probing:
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+        if self.failures >= self.threshold:
+            self.open_until = time.monotonic() + self.cooldown
+        self.probing = False
+
+    def release(self) -> None:
+        """Lời gọi thử bị hủy giữa chừng: cho phép lời gọi khác thử lại."""
+        self.probing = False
+
+spotify_breakers = {}  # tên endpoint -> CircuitBreaker
+
+def spotify_breaker(endpoint: str) -> CircuitBreaker:
+    breaker = spotify_breakers.get(endpoint)
+    if breaker is None:
+        breaker = spotify_breakers[endpoint] = CircuitBreaker()
+    return breaker
+
+def is_spotify_outage(error: Exception) -> bool:
+    """Lỗi cho thấy endpoint đang có sự cố (khác với lỗi do yêu cầu như 401/404)."""
+    if isinstance(error, spotipy.SpotifyException):
+        # spotipy báo hết lượt thử lại (sau chuỗi 5xx/429) bằng mã 429 kèm "Max Retries"
+        return error.http_status >= 500 or 'Max Retries' in str(error.msg)
+    return isinstance(error, requests.exceptions.RequestException)
+
+class TrafficRecorder:
+    """Ghi update Telegram và phản hồi Spotify vào file JSON lines nén gzip để phát lại khi đo hiệu năng.
+
+    Event loop chỉ đưa bản ghi vào hàng đợi; một thread nền làm sạch (id người dùng được thay
+    bằng id ẩn danh ổn định, bỏ tên, email, token và nội dung tin nhắn tự do), chuyển JSON và ghi file.
+    """
+
+    def __init__(self, path: str = TRAFFIC_RECORD_PATH):
+        self.path = path
+        self.enabled = bool(path)
+        self.dropped = 0
+        self._salt = (TRAFFIC_RECORD_SALT or os.urandom(16).hex()).encode()
+        self._queue = queue.Queue(TRAFFIC_QUEUE_LIMIT)
+        self._thread = None
+
+    def start(self) -> None:
+        if self.enabled and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='traffic-recorder', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            if self.dropped:
+                logger.warning("Traffic recorder dropped %s records (queue full)", self.dropped)
+
+    def _put(self, record: tuple) -> None:
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def update(self, data: dict) -> None:
+        if self.enabled:
+            self._put(('update', time.time(), data))
+
+    def wrap(self, func, endpoint: str):
+        """Bọc lời gọi spotipy (chạy trong thread) để ghi lại phản hồi hoặc lỗi cùng độ trễ thực tế."""
+        if endpoint in TRAFFIC_SKIP_ENDPOINTS:
+            return func
+        user_id = log_context.get().get('user_id')
+
+        def recorded(*args, **kwargs):
+            started = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self._put(('spotify', started, (user_id, endpoint, args, kwargs, time.time() - started, None, e)))
+                raise
+            self._put(('spotify', started, (user_id, endpoint, args, kwargs, time.time() - started, result, None)))
+            return result
+
+        return recorded
+
+    def pseudonym(self, value) -> int:
+        """Id ẩn danh ổn định cho id Telegram hoặc Spotify (giữ dấu âm của chat nhóm)."""
+        text = str(value)
+        digest = hashlib.sha256(self._salt + text.lstrip('-').encode()).hexdigest()
+        pseudo = int(digest[:12], 16) % 10 ** 10 + 1
+        return -pseudo if text.startswith('-') else pseudo
+
+    def _scrub_user(self, user: dict) -> dict:
+        return {'id': self.pseudonym(user['id']), 'is_bot': user.get('is_bot', False), 'first_name': 'user'}
+
+    def _scrub_chat(self, chat: dict) -> dict:
+        return {'id': self.pseudonym(chat['id']), 'type': chat['type']}
+
+    def _scrub_text(self, text: str) -> str:
+        if not text or text in COMMANDS.values():
+            return text
+        if text.startswith('/'):
+            command, _, args = text.partition(' ')
+            if command.split('@')[0] in TRAFFIC_SECRET_COMMANDS:
+                return command + (' <redacted>' if args else '')
+            return text
+        return '<redacted>'
+
+    def _scrub_message(self, message: dict) -> dict:
+        scrubbed = {'message_id': message['message_id'], 'date': message['date'],
+                    'chat': self._scrub_chat(message['chat'])}
+        if 'from' in message:
+            scrubbed['from'] = self._scrub_user(message['from'])
+        if 'text' in message:
+            scrubbed['text'] = self._scrub_text(message['text'])
+            entities = [entity for entity in message.get('entities', []) if entity['type'] == 'bot_command']
+            if entities:
+                scrubbed['entities'] = entities
+        return scrubbed
+
+    def scrub_update(self, data: dict):
+        """Chỉ giữ các trường bot dùng tới; None với loại update không được ghi."""
+        scrubbed = {'update_id': data['update_id']}
+        if 'message' in data:
+            scrubbed['message'] = self._scrub_message(data['message'])
+        elif 'callback_query' in data:
+            query = data['callback_query']
+            scrubbed['callback_query'] = {
+                'id': query['id'], 'chat_instance': query.get('chat_instance', ''), 'data': query.get('data'),
+                'from': self._scrub_user(query['from']),
+            }
+            if 'message' in query:
+                scrubbed['callback_query']['message'] = self._scrub_message(query['message'])
+        elif 'inline_query' in data:
+            query = data['inline_query']
+            scrubbed['inline_query'] = {'id': query['id'], 'from': self._scrub_user(query['from']),
+                                        'query': query['query'], 'offset': query.get('offset', '')}
+        else:
+            return None
+        return scrubbed
+
+    def scrub_spotify(self, value):
+        if isinstance(value, dict):
+            if value.get('type') == 'user':
+                # Hồ sơ người dùng Spotify (chính họ hoặc chủ playlist)
+                user = {'type': 'user', 'id': str(self.pseudonym(value.get('id'))), 'display_name': 'user'}
+                for key in ('product', 'country'):
+                    if key in value:
+                        user[key] = value[key]
+                return user
+            return {key: self.scrub_spotify(item) for key, item in value.items() if key not in TRAFFIC_DROP_KEYS}
+        if isinstance(value, (list, tuple)):
+            return [self.scrub_spotify(item) for item in value]
+        return value
+
+    def encode(self, record: tuple):
+        kind, at, data = record
+        if kind == 'update':
+            update = self.scrub_update(data)
+            return None if update is None else {'t': round(at, 3), 'update': update}
+        user_id, endpoint, args, kwargs, latency, result, error = data
+        line = {
+            't': round(at, 3), 'spotify': endpoint,
+            'user': self.pseudonym(user_id) if user_id else None,
+            'args': self.scrub_spotify(list(args)), 'kwargs': self.scrub_spotify(kwargs),
+            'latency': round(latency, 4),
+        }
+        if error is None:
+            line['result'] = self.scrub_spotify(result)
+        elif isinstance(error, spotipy.SpotifyException):
+            line['error'] = {'http_status': error.http_status, 'code': error.code, 'msg': str(error.msg)}
+        else:
+            line['error'] = {'type': type(error).__name__}
+        return line
+
+    def _run(self) -> None:
+        written = 0
+        with gzip.open(self.path, 'at', encoding='utf-8') as f:
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    break
+                try:
+                    line = self.encode(record)
+                    if line is not None:
+                        f.write(json.dumps(line, ensure_ascii=False, separators=(',', ':'), default=str) + '\n')
+                        written += 1
+                        if written % TRAFFIC_FLUSH_EVERY == 0:
+                            f.flush()
+                except Exception as e:
+                    logger.error("Error recording traffic: %s", e)
+
+traffic_recorder = TrafficRecorder()
+
+async def record_update(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if isinstance(update, Update):
+        traffic_recorder.update(update.to_dict())
+
+async def sp_call(func, *args, **kwargs):
+    """Chạy lời gọi spotipy (đồng bộ) trong thread riêng để không chặn event loop.
+
+    Mỗi endpoint có thời gian chờ riêng và bộ ngắt mạch riêng; khi endpoint đang lỗi,
+    lời gọi thất bại ngay bằng SpotifyUnavailable thay vì giữ người dùng chờ.
+    """
+    endpoint = getattr(func, '__name__', 'spotify')
+    breaker = spotify_breaker(endpoint)
+    if not breaker.allow():
+        raise SpotifyUnavailable(endpoint, breaker.retry_after())
+
+    timeout = SPOTIFY_TIMEOUTS.get(endpoint, SPOTIFY_DEFAULT_TIMEOUT)
+    if traffic_recorder.enabled:
+        func = traffic_recorder.wrap(func, endpoint)
+    try:
+        result = await asyncio.wait_for(asyncio.to_thread(func, *args, **kwargs), timeout)
+    except asyncio.TimeoutError:
+        breaker.record_failure()
+        logger.error("Spotify %s timed out after %ss", endpoint, timeout)
+        raise SpotifyUnavailable(endpoint, breaker.retry_after()) from None
+    except asyncio.CancelledError:
+        breaker.release()
+        raise
+    except Exception as e:
+        if is_spotify_outage(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    breaker.record_success()
+    return result
+
+def spotify_error_text(error: Exception, default: str) -> str:
+    """Thông báo lỗi cho người dùng: báo rõ khi Spotify đang gặp sự cố thay vì lỗi chung chung."""
+    if isinstance(error, SpotifyUnavailable):
+        wait = max(5, math.ceil(error.retry_after))
+        return f"*⚠️ Spotify đang phản hồi chậm hoặc gặp sự cố.* Vui lòng thử lại sau khoảng {wait} giây."
+    if is_spotify_outage(error):
+        return "*⚠️ Spotify đang gặp sự cố tạm thời.* Vui lòng thử lại sau ít phút."
+    return default
+
+def spotify_client(token: str) -> spotipy.Spotify:
+    """Client spotipy cho token người dùng, với thời gian chờ và số lần thử lại giới hạn."""
+    return spotipy.Spotify(auth=token, requests_session=spotify_http, requests_timeout=SPOTIFY_REQUEST_TIMEOUT)
+
+class TokenBucket:
+    """Token bucket bất đồng bộ dùng để chia sẻ ngân sách gọi API."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._refill_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._refill_at) * self.rate)
+        self._refill_at = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        self._refill()
+        if self._tokens < tokens:
+            return False
+        self._tokens -= tokens
+        return True
+
+    async def acquire(self, tokens: float = 1) -> None:
+        while not self.try_acquire(tokens):
+            await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+spotify_budget = TokenBucket(SPOTIFY_BACKGROUND_RATE, SPOTIFY_BACKGROUND_BURST)
+
+class OutboundMessage:
+    """Một lời gọi Bot API đang chờ gửi trong hàng đợi."""
+    __slots__ = ('priority', 'seq', 'chat_id', 'method', 'kwargs', 'future', 'merge_key', 'attempts')
+
+    def __init__(self, priority: int, seq: int, chat_id: int, method: str, kwargs: dict, merge_key=None):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.future = asyncio.get_running_loop().create_future()
+        self.merge_key = merge_key
+        self.attempts = 0
+
+    def __lt__(self, other: 'OutboundMessage') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class OutboundSender:
+    """Hàng đợi trung tâm cho mọi tin nhắn gửi đi.
+
+    Dùng token bucket toàn cục (~30 tin/giây) và giới hạn theo từng chat (1 tin/giây,
+    nhóm 20 tin/phút), ưu tiên phản hồi tương tác hơn thông báo, tự thử lại khi gặp
+    RetryAfter (429) và gộp các thông báo đang chờ gửi tới cùng một chat.
+    """
+
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, burst: float = OUTBOUND_GLOBAL_BURST,
+                 chat_interval: float = OUTBOUND_CHAT_INTERVAL, group_interval: float = OUTBOUND_GROUP_INTERVAL):
+        self.global_rate = global_rate
+        self.burst = burst
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self._bot = None
+        self._task = None
+        self._heap = []
+        self._seq = 0
+        self._merge_index = {}  # (chat_id, merge_key) -> OutboundMessage
+        self._notice_index = {}  # chat_id -> thông báo đang chờ có thể gộp
+        self._chat_next = {}  # chat_id -> thời điểm sớm nhất được gửi tiếp
+        self._tokens = burst
+        self._refill_at = time.monotonic()
+        self._paused_until = 0.0
+        self._inflight = set()
+        self._slots = asyncio.Semaphore(OUTBOUND_MAX_INFLIGHT)
+        self._wakeup = asyncio.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self, bot) -> None:
+        self._bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def flush(self, timeout: float) -> bool:
+        """Chờ gửi hết hàng đợi, trả về False nếu quá thời hạn."""
+        deadline = time.monotonic() + timeout
+        while self._heap or self._inflight:
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    def pending(self) -> int:
+        return len(self._heap) + len(self._inflight)
+
+    def _push(self, msg: OutboundMessage) -> None:
+        heapq.heappush(self._heap, msg)
+        self._wakeup.set()
+
+    def submit(self, chat_id: int, method: str, priority: int = PRIORITY_INTERACTIVE,
+               merge_key=None, **kwargs) -> asyncio.Future:
+        """Đưa một lời gọi Bot API vào hàng đợi.
+
+        Nếu đã có tin nhắn đang chờ với cùng merge_key cho chat này thì tin nhắn mới thay
+        thế nội dung tin cũ và dùng chung future.
+        """
+        if merge_key is not None:
+            pending = self._merge_index.get((chat_id, merge_key))
+            if pending is not None:
+                pending.kwargs = kwargs
+                return pending.future
+
+        self._seq += 1
+        msg = OutboundMessage(priority, self._seq, chat_id, method, kwargs, merge_key)
+        if merge_key is not None:
+            self._merge_index[(chat_id, merge_key)] = msg
+        self._push(msg)
+        return msg.future
+
+    async def send(self, chat_id: int, method: str = 'send_message', priority: int = PRIORITY_INTERACTIVE,
+                   merge_key=None, **kwargs):
+        if not self.running:
+            # Hàng đợi chưa chạy (ví dụ khi chạy thử), gửi trực tiếp
+            return await getattr(self._bot, method)(chat_id=chat_id, **kwargs)
+        return await self.submit(chat_id, method, priority, merge_key, **kwargs)
+
+    def notify(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        """Gửi thông báo do bot khởi tạo, gộp với thông báo khác đang chờ cho cùng chat."""
+        pending = self._notice_index.get(chat_id)
+        if pending is not None and pending.kwargs.get('parse_mode') == kwargs.get('parse_mode') \
+                and not (pending.kwargs.get('reply_markup') and kwargs.get('reply_markup')):
+            if text not in pending.kwargs['text']:
+                pending.kwargs['text'] += "\n\n" + text
+            if kwargs.get('reply_markup'):
+                pending.kwargs['reply_markup'] = kwargs['reply_markup']
+            return pending.future
+
+        self._seq += 1
+        msg = OutboundMessage(PRIORITY_NOTIFICATION, self._seq, chat_id, 'send_message', dict(kwargs, text=text))
+        self._notice_index[chat_id] = msg
+        self._push(msg)
+        return msg.future
+
+    def _chat_interval(self, chat_id: int) -> float:
+        return self.group_interval if chat_id < 0 else self.chat_interval
+
+    def _pop_ready(self, now: float):
+        """Lấy tin nhắn ưu tiên cao nhất có thể gửi ngay; nếu không có, trả về thời gian cần chờ."""
+        if now < self._paused_until:
+            return None, self._paused_until - now
+        self._tokens = min(self.burst, self._tokens + (now - self._refill_at) * self.global_rate)
+        self._refill_at = now
+        if self._tokens < 1:
+            return None, (1 - self._tokens) / self.global_rate
+
+        deferred = []
+        chosen = None
+        wait = OUTBOUND_IDLE_WAIT
+        while self._heap and len(deferred) < OUTBOUND_SCAN_LIMIT:
+            msg = heapq.heappop(self._heap)
+            ready_at = self._chat_next.get(msg.chat_id, 0.0)
+            if ready_at <= now:
+                chosen = msg
+                break
+            deferred.append(msg)
+            wait = min(wait, ready_at - now)
+        for msg in deferred:
+            heapq.heappush(self._heap, msg)
+        if chosen is None:
+            return None, wait
+
+        self._tokens -= 1
+        self._chat_next[chosen.chat_id] = now + self._chat_interval(chosen.chat_id)
+        if chosen.merge_key is not None:
+            self._merge_index.pop((chosen.chat_id, chosen.merge_key), None)
+        if self._notice_index.get(chosen.chat_id) is chosen:
+            del self._notice_index[chosen.chat_id]
+        if len(self._chat_next) > OUTBOUND_CHAT_STATE_LIMIT:
+            self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+        return chosen, 0.0
+
+    async def _run(self) -> None:
+        while True:
+            msg, wait = self._pop_ready(time.monotonic())
+            if msg is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._slots.acquire()
+            task = asyncio.create_task(self._deliver(msg))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _deliver(self, msg: OutboundMessage) -> None:
+        try:
+            result = await getattr(self._bot, msg.method)(chat_id=msg.chat_id, **msg.kwargs)
+            if not msg.future.done():
+                msg.future.set_result(result)
+        except RetryAfter as e:
+            # Telegram yêu cầu chờ: hoãn chat này rồi gửi lại
+            msg.attempts += 1
+            delay = retry_after_seconds(e)
+            self._chat_next[msg.chat_id] = max(self._chat_next.get(msg.chat_id, 0.0), time.monotonic() + delay)
+            if delay >= OUTBOUND_GLOBAL_PAUSE_THRESHOLD:
+                # Thời gian chờ dài thường là giới hạn toàn cục, tạm dừng cả hàng đợi
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            if msg.attempts > OUTBOUND_MAX_RETRIES:
+                if not msg.future.done():
+                    msg.future.set_exception(e)
+            else:
+                logger.warning("Telegram rate limit, retry after %ss", delay)
+                self._push(msg)
+        except BadRequest as e:
+            if not msg.future.done():
+                msg.future.set_exception(e)
+        except (TimedOut, NetworkError) as e:
+            msg.attempts += 1
+            if msg.attempts > OUTBOUND_MAX_RETRIES:
+                if not msg.future.done():
+                    msg.future.set_exception(e)
+            else:
+                self._push(msg)
+        except Exception as e:
+            if not msg.future.done():
+                msg.future.set_exception(e)
+        finally:
+            self._slots.release()
+
+class SharedTelegramRequest(HTTPXRequest):
+    """Pool kết nối tới Bot API dùng chung cho mọi bot trong tiến trình; chỉ đóng khi bot cuối cùng tắt."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._users = 0
+
+    async def initialize(self) -> None:
+        self._users += 1
+        await super().initialize()
+
+    async def shutdown(self) -> None:
+        self._users -= 1
+        if self._users <= 0:
+            await super().shutdown()
+
+telegram_http = SharedTelegramRequest(connection_pool_size=TELEGRAM_POOL_SIZE)
+
+class Tenant:
+    """Một bot Telegram trong tiến trình: token, ứng dụng Spotify và hàng đợi gửi tin nhắn riêng.
+
+    Cache, tác vụ nền và pool HTTP dùng chung cho mọi bot. Phiên và dữ liệu của người dùng
+    được tách bằng khóa có gắn tên bot (xem scoped), nên cùng một tài khoản Telegram dùng
+    hai bot sẽ có hai phiên độc lập. Hàng đợi gửi tách theo bot vì giới hạn của Telegram
+    tính theo từng token.
+    """
+
+    def __init__(self, name: str, token: str, client_id: str, client_secret: str, redirect_uri: str):
+        self.name = name
+        self.token = token
+        self.oauth = SpotifyOAuth(client_id, client_secret, redirect_uri, scope=SPOTIFY_SCOPE,
+                                  requests_session=spotify_http)
+        self.outbound = OutboundSender()
+        self.application = None
+
+    def scoped(self, key):
+        """Khóa user_id/chat_id riêng của bot này; bot mặc định giữ nguyên khóa cũ."""
+        return key if self.name == DEFAULT_TENANT else f"{self.name}:{key}"
+
+    async def enter(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Handler nhóm đầu tiên: đánh dấu update đang xử lý thuộc bot này."""
+        current_tenant.set(self)
+
+    async def start(self) -> None:
+        """Chạy một bot phụ cùng event loop với bot mặc định (bot mặc định do run_polling quản lý)."""
+        await self.application.initialize()
+        self.outbound.start(self.application.bot)
+        await self.application.updater.start_polling()
+        await self.application.start()
+        logger.info("Started tenant %s", self.name)
+
+    async def stop(self) -> None:
+        if self.application is None:
+            return
+        if self.application.updater.running:
+            await self.application.updater.stop()
+        if self.application.running:
+            await self.application.stop()
+
+    async def shutdown(self) -> None:
+        """Đóng bot phụ sau khi hàng đợi gửi của nó đã xả xong."""
+        if self.application is not None:
+            await self.application.shutdown()
+
+def load_tenants() -> dict:
+    tenants = {DEFAULT_TENANT: Tenant(DEFAULT_TENANT, TELEGRAM_TOKEN, SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET,
+                                      SPOTIFY_REDIRECT_URI)}
+    for name in TENANT_NAMES:
+        if ':' in name or name in tenants:
+            raise ValueError(f"Invalid tenant name: {name}")
+        prefix = name.upper() + '_'
+        token = os.getenv(prefix + "TELEGRAM_TOKEN")
+        if not token:
+            raise ValueError(f"Missing {prefix}TELEGRAM_TOKEN for tenant {name}")
+        tenants[name] = Tenant(name, token, os.getenv(prefix + "SPOTIFY_CLIENT_ID"),
+                               os.getenv(prefix + "SPOTIFY_CLIENT_SECRET"),
+                               os.getenv(prefix + "SPOTIFY_REDIRECT_URI", SPOTIFY_REDIRECT_URI))
+    return tenants
+
+tenants = load_tenants()
+default_tenant = tenants[DEFAULT_TENANT]
+# Bot của update đang xử lý; tác vụ tạo từ handler sao chép ngữ cảnh nên cũng biết bot của mình
+current_tenant = contextvars.ContextVar('current_tenant', default=default_tenant)
+
+def extra_tenants() -> list:
+    return [tenant for tenant in tenants.values() if tenant is not default_tenant]
+
+def tenant_of(key) -> Tenant:
+    """Bot sở hữu một khóa user_id/chat_id (khóa không có tên bot thuộc bot mặc định)."""
+    name, sep, _ = str(key).partition(':')
+    return tenants.get(name, default_tenant) if sep else default_tenant
+
+def telegram_id(key) -> int:
+    """id Telegram (dùng làm chat_id khi nhắn riêng) từ khóa user_id đã gắn tên bot."""
+    return int(str(key).rpartition(':')[2])
+
+def user_key(update: Update) -> str:
+    return current_tenant.get().scoped(str(update.effective_user.id))
+
+def chat_key(update: Update):
+    return current_tenant.get().scoped(update.effective_chat.id)
+
+async def reply(update: Update, text: str, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+    """Trả lời người dùng thông qua hàng đợi gửi tin nhắn; với nút bấm inline thì sửa tin nhắn chứa nút."""
+    if update.callback_query is not None:
+        return await edit_view(update, text, priority, **kwargs)
+    outbound = current_tenant.get().outbound
+    if not outbound.running:
+        return await update.message.reply_text(text, **kwargs)
+    return await outbound.send(update.effective_chat.id, text=text, priority=priority, **kwargs)
+
+async def edit_view(update: Update, text: str, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+    """Sửa tin nhắn chứa nút vừa bấm; các lần bấm liên tiếp đang chờ gửi được gộp thành một lần sửa."""
+    message = update.callback_query.message
+    outbound = current_tenant.get().outbound
+    if not isinstance(message, Message):
+        # Tin nhắn quá 48 giờ (InaccessibleMessage) không sửa được nữa: gửi màn hình thành tin nhắn mới.
+        # Callback đã được trả lời trong view_callback.
+        if not outbound.running:
+            return await update.get_bot().send_message(update.effective_chat.id, text, **kwargs)
+        return await outbound.send(update.effective_chat.id, text=text, priority=priority, **kwargs)
+    # Giữ bàn phím hiện tại khi nội dung mới không kèm bàn phím (ví dụ thông báo lỗi) để người dùng bấm lại
+    kwargs.setdefault('reply_markup', message.reply_markup)
+    try:
+        if not outbound.running:
+            return await message.edit_text(text, **kwargs)
+        return await outbound.send(
+            message.chat_id, 'edit_message_text', priority, ('view', message.message_id),
+            text=text, message_id=message.message_id, **kwargs
+        )
+    except BadRequest as e:
+        if 'not modified' in str(e).lower():
+            return None  # Bấm lại nút đang chọn, nội dung không đổi
+        raise
+
+def _log_notice_error(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Error sending notification: %s", future.exception())
+
+async def reply_photo(update: Update, photo, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+    """Gửi ảnh cho người dùng thông qua hàng đợi gửi tin nhắn."""
+    outbound = current_tenant.get().outbound
+    if not outbound.running:
+        return await update.message.reply_photo(photo, **kwargs)
+    return await outbound.send(update.effective_chat.id, 'send_photo', priority=priority, photo=photo, **kwargs)
+
+async def reply_document(update: Update, document, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+    """Gửi file cho người dùng thông qua hàng đợi gửi tin nhắn."""
+    outbound = current_tenant.get().outbound
+    if not outbound.running:
+        return await update.message.reply_document(document, **kwargs)
+    return await outbound.send(update.effective_chat.id, 'send_document', priority=priority, document=document, **kwargs)
+
+async def notify(update: Update, text: str, **kwargs) -> None:
+    """Gửi thông báo do bot khởi tạo; không chờ gửi xong và có thể được gộp với thông báo khác."""
+    outbound = current_tenant.get().outbound
+    if not outbound.running:
+        await update.message.reply_text(text, **kwargs)
+        return
+    outbound.notify(update.effective_chat.id, text, **kwargs).add_done_callback(_log_notice_error)
+
 def get_user_amount(user_id: str) -> int:
     """Lấy số lượng kết quả đã cài đặt của người dùng"""
-    init_user_data(user_id)
-    return user_data[user_id].get('amount', DEFAULT_AMOUNT)
+    return get_session(user_id).amount
 
 def escape_markdown(text: str) -> str:
     """Escape các ký tự đặc biệt trong Markdown."""
@@ -92,8 +1322,14 @@ def escape_markdown(text: str) -> str:
         text = text.replace(char, f'\\{char}')
     return text
 
+def _send_email(msg: MIMEMultipart) -> None:
+    with smtplib.SMTP(EMAIL_HOST, EMAIL_PORT) as server:
+        server.starttls()
+        server.login(EMAIL_HOST_USER, EMAIL_HOST_PASSWORD)
+        server.send_message(msg)
+
 async def send_email_notification(to_email: str, subject: str, message: str) -> bool:
-    """Gửi thông báo qua email"""
+    """Gửi thông báo qua email (smtplib chạy trong thread để không chặn event loop)"""
     try:
         msg = MIMEMultipart()
         msg['From'] = EMAIL_HOST_USER
@@ -101,296 +1337,2456 @@ async def send_email_notification(to_email: str, subject: str, message: str) ->
         msg['Subject'] = subject
         msg.attach(MIMEText(message, 'plain', 'utf-8'))
         
-        with smtplib.SMTP(EMAIL_HOST, EMAIL_PORT) as server:
-            server.starttls()
-            server.login(EMAIL_HOST_USER, EMAIL_HOST_PASSWORD)
-            server.send_message(msg)
+        await asyncio.to_thread(_send_email, msg)
         return True
     except Exception as e:
-        logger.error(f"Lỗi gửi email: {e}")
+        logger.error("Lỗi gửi email: %s", e)
         return False
 
-async def get_current_track(update: Update, sp: spotipy.Spotify) -> None:
-    """Lấy thông tin bài hát đang phát."""
-    try:
-        current_track = sp.current_user_playing_track()
-        if current_track is not None and current_track['is_playing']:
-            track = current_track['item']
-            artist = escape_markdown(track['artists'][0]['name'])
-            track_name = escape_markdown(track['name'])
-            album = escape_markdown(track['album']['name'])
-            duration = track['duration_ms'] // 1000
-            progress = current_track['progress_ms'] // 1000
-            
-            # Thêm thông tin chi tiết
-            album_type = track['album']['album_type'].capitalize()
-            release_date = track['album']['release_date']
-            track_number = track['track_number']
-            total_tracks = track['album']['total_tracks']
-            popularity = track['popularity']
-            
-            # Tạo thanh tiến trình
-            progress_bar_length = 20
-            progress_ratio = progress / duration
-            filled = int(progress_bar_length * progress_ratio)
-            progress_bar = '▓' * filled + '░' * (progress_bar_length - filled)
-            
-            response = (
-                f"🎵 *Đang phát:* {track_name}\n"
-                f"👤 *Nghệ sĩ:* {artist}\n"
-                f"💿 *Album:* {album}\n"
-                f"📀 *Loại album:* {album_type}\n"
-                f"📅 *Ngày phát hành:* {release_date}\n"
-                f"🔢 *Track:* {track_number}/{total_tracks}\n"
-                f"🌟 *Độ phổ biến:* {popularity}/100\n\n"
-                f"⏳ *Thời gian:* {progress//60}:{progress%60:02d}/{duration//60}:{duration%60:02d}\n"
-                f"`{progress_bar}` {int(progress_ratio * 100)}%"
-            )
-            
-            # Thêm preview URL nếu có
-            if track.get('preview_url'):
-                response += f"\n\n🎧 [Nghe thử 30s]({track['preview_url']})"
-            
-            # Thêm link Spotify
-            response += f"\n🔗 [Mở trên Spotify]({track['external_urls']['spotify']})"
-            
-        else:
-            response = "🔇 *Không có bài hát nào đang phát*"
-        
-        await update.message.reply_text(response, parse_mode='Markdown', disable_web_page_preview=True)
-    except Exception as e:
-        logger.error(f"Error in get_current_track: {e}")
-        await update.message.reply_text(
-            "❌ *Có lỗi xảy ra khi lấy thông tin bài hát.*",
-            parse_mode='Markdown'
-        )
+class TrackRecord:
+    """Bản ghi bài hát gọn nhẹ thay cho JSON đầy đủ của spotipy."""
+    __slots__ = ('id', 'name', 'artist_ids', 'album_id', 'duration_ms', 'popularity')
 
-async def get_stats(update: Update, sp: spotipy.Spotify) -> None:
-    """Lấy thống kê chi tiết về tài khoản Spotify."""
-    try:
-        # Lấy thông tin người dùng
-        user_info = sp.current_user()
-        followed_artists = sp.current_user_followed_artists()
-        playlists = sp.current_user_playlists()
-        saved_tracks = sp.current_user_saved_tracks()
-        top_artists = sp.current_user_top_artists(limit=3, time_range='short_term')
-        recently_played = sp.current_user_recently_played(limit=1)
-        
-        # Tính toán thống kê
-        total_playlists = playlists['total']
-        total_saved = saved_tracks['total']
-        total_following = followed_artists['artists']['total']
-        
-        # Tạo phản hồi
-        response = [
-            "📊 *Thống kê tài khoản Spotify của bạn:*\n",
-            f"👤 *Tên người dùng:* {escape_markdown(user_info['display_name'])}",
-            f"🌍 *Quốc gia:* {user_info.get('country', 'N/A')}",
-            f"📧 *Email:* {user_info.get('email', 'N/A')}",
-            f"🎵 *Gói dịch vụ:* {user_info['product'].capitalize()}",
-            f"👥 *Đang theo dõi:* {total_following} nghệ sĩ",
-            f"📋 *Playlist:* {total_playlists}",
-            f"❤️ *Bài hát đã lưu:* {total_saved}"
-        ]
+    def __init__(self, id: str, name: str, artist_ids: tuple, album_id: str, duration_ms: int, popularity: int):
+        self.id = id
+        self.name = name
+        self.artist_ids = artist_ids
+        self.album_id = album_id
+        self.duration_ms = duration_ms
+        self.popularity = popularity
 
-        # Thêm nghệ sĩ yêu thích
-        if top_artists['items']:
-            response.append("\n🌟 *Top nghệ sĩ gần đây:*")
-            for i, artist in enumerate(top_artists['items'], 1):
-                response.append(f"{i}. {escape_markdown(artist['name'])}")
+    @property
+    def url(self) -> str:
+        return f"https://open.spotify.com/track/{self.id}"
 
-        # Thêm bài hát gần đây nhất
-        if recently_played['items']:
-            last_played = recently_played['items'][0]['track']
-            response.append(
-                f"\n🎵 *Bài hát nghe gần đây nhất:*\n"
-                f"{escape_markdown(last_played['name'])} - {escape_markdown(last_played['artists'][0]['name'])}"
-            )
+class CatalogCache:
+    """Cache danh mục dùng chung cho cả tiến trình, khóa theo Spotify id.
 
-        # Thêm liên kết hồ sơ
-        if user_info.get('external_urls', {}).get('spotify'):
-            response.append(f"\n🔗 [Xem hồ sơ trên Spotify]({user_info['external_urls']['spotify']})")
+    Mỗi bài hát chỉ được giữ một lần dù xuất hiện trong dữ liệu của nhiều người dùng.
+    Tên nghệ sĩ/album được lưu riêng và intern để các chuỗi trùng nhau dùng chung bộ nhớ.
+    Khi vượt giới hạn, các mục cũ nhất bị loại bỏ trước.
+    """
 
-        await update.message.reply_text(
-            '\n'.join(response),
-            parse_mode='Markdown',
-            disable_web_page_preview=True
-        )
+    def __init__(self, max_tracks: int = CATALOG_MAX_TRACKS):
+        self.max_tracks = max_tracks
+        self.tracks = {}  # track id -> TrackRecord
+        self.artists = {}  # artist id -> tên
+        self.albums = {}  # album id -> tên
 
-    except Exception as e:
-        logger.error(f"Error in get_stats: {e}")
-        await update.message.reply_text(
-            "❌ *Có lỗi xảy ra khi lấy thống kê.*",
-            parse_mode='Markdown'
-        )
+    def snapshot_state(self) -> tuple:
+        return self.tracks, self.artists, self.albums
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = str(update.effective_user.id)
-    init_user_data(user_id)
-    
-    if user_data[user_id].get('token'):
-        await show_main_menu(update, context)
-    else:
-        auth_url = sp_oauth.get_authorize_url(state=user_id)
-        keyboard = [[InlineKeyboardButton("🔑 Xác thực Spotify", url=auth_url)]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        message = (
-            "*Chào mừng bạn đến với Spotify Bot!*\n\n"
-            "Để bắt đầu, hãy làm theo các bước sau:\n"
-            "1. Nhấn nút bên dưới để xác thực với Spotify\n"
-            "2. Sau khi xác thực thành công, copy token nhận được\n"
-            "3. Quay lại đây và sử dụng lệnh /set\\_token để nhập token"
-        )
-        
-        await update.message.reply_text(
-            message,
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
+    def restore_state(self, state: tuple) -> None:
+        self.tracks, self.artists, self.albums = state
+
+    def add_track(self, track: dict) -> TrackRecord:
+        """Chuyển JSON bài hát của spotipy thành TrackRecord và lưu vào cache."""
+        artist_ids = []
+        for artist in track['artists']:
+            artist_id = artist.get('id') or artist['name']
+            self._put(self.artists, sys.intern(artist_id), sys.intern(artist['name']))
+            artist_ids.append(sys.intern(artist_id))
+        album = track.get('album') or {}
+        album_id = album.get('id')
+        if album_id:
+            album_id = sys.intern(album_id)
+            self._put(self.albums, album_id, sys.intern(album['name']))
+
+        track_id = track.get('id') or track['uri']
+        record = TrackRecord(
+            sys.intern(track_id), sys.intern(track['name']), tuple(artist_ids), album_id,
+            track.get('duration_ms', 0), track.get('popularity', 0)
         )
+        # Xóa rồi thêm lại để bài hát vừa dùng nằm cuối thứ tự loại bỏ
+        self.tracks.pop(record.id, None)
+        self.tracks[record.id] = record
+        if len(self.tracks) > self.max_tracks:
+            del self.tracks[next(iter(self.tracks))]
+        return record
 
-async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = str(update.effective_user.id)
-    init_user_data(user_id)
-    
-    current_amount = get_user_amount(user_id)
-    settings_text = (
-        "*⚙️ Cài đặt hiện tại:*\n\n"
-        f"📊 *Số lượng hiển thị:* {current_amount}\n"
-        f"🔒 *Trạng thái:* {'*Đã đăng nhập*' if user_data[user_id].get('token') else '*Chưa đăng nhập*'}\n\n"
-        "*Các lệnh cài đặt:*\n"
-        "• `/set_amount <số>` - Điều chỉnh số lượng hiển thị\n"
-        "• `/logout` - Đăng xuất\n"
+    def add_artist(self, artist: dict) -> str:
+        artist_id = sys.intern(artist['id'])
+        self._put(self.artists, artist_id, sys.intern(artist['name']))
+        return artist_id
+
+    def add_tracks(self, tracks) -> list:
+        return [self.add_track(track) for track in tracks if track]
+
+    def _put(self, table: dict, key: str, value: str) -> None:
+        if table.get(key) != value:
+            table.pop(key, None)
+            table[key] = value
+            if len(table) > self.max_tracks:
+                del table[next(iter(table))]
+
+    def get(self, track_id: str):
+        return self.tracks.get(track_id)
+
+    def artist_name(self, artist_id: str) -> str:
+        return self.artists.get(artist_id, '')
+
+    def artist_names(self, record: TrackRecord) -> list:
+        return [self.artist_name(artist_id) for artist_id in record.artist_ids]
+
+    def album_name(self, album_id: str) -> str:
+        return self.albums.get(album_id, '')
+
+catalog = CatalogCache()
+
+class AudioFeatureCache:
+    """Cache vĩnh viễn audio features theo track id, dùng chung cho mọi người dùng.
+
+    Audio features của một bài hát không bao giờ thay đổi nên được lưu mãi trong SQLite,
+    với một lớp LRU nhỏ trong bộ nhớ phía trước. Các id còn thiếu được gom lại và lấy theo
+    lô 100 id mỗi lời gọi bằng client credentials, không tốn token của người dùng.
+    Bài hát không có audio features cũng được ghi lại (toàn NULL) để không hỏi lại.
+    """
+
+    def __init__(self, path: str = AUDIO_FEATURES_DB_PATH, memory_size: int = AUDIO_FEATURES_MEMORY_SIZE):
+        self.path = path
+        self.memory_size = memory_size
+        self._memory = OrderedDict()  # track_id -> tuple giá trị theo AUDIO_FEATURE_FIELDS hoặc None
+        self._pending = {}  # track_id -> Future của lô đang tải
+        self._disabled_until = 0
+        self._db = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS audio_features (track_id TEXT PRIMARY KEY, "
+                + ", ".join(f"{field} REAL" for field in AUDIO_FEATURE_FIELDS) + ")"
+            )
+        return self._db
+
+    def _remember(self, track_id: str, values) -> None:
+        self._memory[track_id] = values
+        self._memory.move_to_end(track_id)
+        if len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _load(self, track_ids: list) -> None:
+        """Nạp từ đĩa các id chưa có trong bộ nhớ."""
+        for start in range(0, len(track_ids), AUDIO_FEATURES_BATCH_SIZE):
+            chunk = track_ids[start:start + AUDIO_FEATURES_BATCH_SIZE]
+            rows = self._connection().execute(
+                f"SELECT * FROM audio_features WHERE track_id IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            for track_id, *values in rows:
+                self._remember(track_id, None if values[0] is None else tuple(values))
+
+    def _store(self, items: list) -> None:
+        db = self._connection()
+        with db:
+            db.executemany(
+                f"INSERT OR REPLACE INTO audio_features VALUES ({', '.join('?' * (len(AUDIO_FEATURE_FIELDS) + 1))})",
+                [(track_id, *(values or (None,) * len(AUDIO_FEATURE_FIELDS))) for track_id, values in items]
+            )
+
+    async def _fetch(self, track_ids: list) -> None:
+        try:
+            result = await sp_call(app_sp.audio_features, track_ids)
+        except spotipy.SpotifyException as e:
+            if e.http_status in (403, 404, 410):
+                # Endpoint đã bị Spotify ngừng cấp cho ứng dụng này: tắt một thời gian thay vì gọi lại liên tục
+                self._disabled_until = time.time() + AUDIO_FEATURES_RETRY_AFTER
+                logger.error("Audio features unavailable (HTTP %s), disabled for now", e.http_status)
+                return
+            raise
+        items = []
+        for track_id, features in zip(track_ids, result or []):
+            values = tuple(features.get(field) for field in AUDIO_FEATURE_FIELDS) if features else None
+            items.append((track_id, values))
+            self._remember(track_id, values)
+        self._store(items)
+
+    async def get_many(self, track_ids) -> dict:
+        """Trả về {track_id: dict features} cho các bài có dữ liệu; tối đa một lời gọi cho mỗi 100 id thiếu."""
+        track_ids = list(dict.fromkeys(track_ids))
+        self._load([track_id for track_id in track_ids if track_id not in self._memory])
+
+        missing = [track_id for track_id in track_ids
+                   if track_id not in self._memory and track_id not in self._pending]
+        if missing and time.time() >= self._disabled_until:
+            for start in range(0, len(missing), AUDIO_FEATURES_BATCH_SIZE):
+                chunk = missing[start:start + AUDIO_FEATURES_BATCH_SIZE]
+                future = asyncio.ensure_future(self._fetch(chunk))
+                for track_id in chunk:
+                    self._pending[track_id] = future
+                future.add_done_callback(lambda _, chunk=chunk: [self._pending.pop(t, None) for t in chunk])
+
+        # Chờ cả các lô do yêu cầu khác khởi tạo để không tải trùng
+        waiting = {self._pending[track_id] for track_id in track_ids if track_id in self._pending}
+        if waiting:
+            results = await asyncio.gather(*waiting, return_exceptions=True)
+            for error in results:
+                if isinstance(error, Exception):
+                    logger.error("Error fetching audio features: %s", error)
+
+        features = {}
+        for track_id in track_ids:
+            values = self._memory.get(track_id)
+            if values is not None:
+                features[track_id] = dict(zip(AUDIO_FEATURE_FIELDS, values))
+        return features
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+audio_features = AudioFeatureCache()
+
+def describe_mood(features: list) -> str:
+    """Tóm tắt tâm trạng/năng lượng/nhịp độ của một danh sách bài hát."""
+    if not features:
+        return ""
+
+    def average(field: str):
+        values = [f[field] for f in features if f.get(field) is not None]
+        return sum(values) / len(values) if values else None
+
+    energy, valence, danceability = average('energy'), average('valence'), average('danceability')
+    tempos = sorted(f['tempo'] for f in features if f.get('tempo'))
+    parts = []
+    if valence is not None:
+        mood = "vui tươi 😄" if valence >= 0.65 else "trầm buồn 🌧" if valence < 0.35 else "cân bằng 🙂"
+        parts.append(f"Tâm trạng: {mood} ({valence:.0%})")
+    if energy is not None:
+        parts.append(f"Năng lượng: {energy:.0%}")
+    if danceability is not None:
+        parts.append(f"Độ nhảy: {danceability:.0%}")
+    if tempos:
+        parts.append(f"Nhịp độ: ~{tempos[len(tempos) // 2]:.0f} BPM")
+    if not parts:
+        return ""
+    return f"\n*🎚 Không khí ({len(features)} bài):* " + " • ".join(parts)
+
+async def mood_summary(track_ids) -> str:
+    """Dòng tóm tắt audio features cho một view; trả về chuỗi rỗng nếu không có dữ liệu."""
+    try:
+        features = await audio_features.get_many(track_ids)
+        return describe_mood(list(features.values()))
+    except Exception as e:
+        logger.error("Error building mood summary: %s", e)
+        return ""
+
+def format_track_line(i: int, record: TrackRecord, with_stars: bool = True) -> str:
+    track_name = escape_markdown(record.name)
+    artist_name = escape_markdown(catalog.artist_name(record.artist_ids[0]) if record.artist_ids else '')
+    if not with_stars:
+        return f"{i}. *{track_name}* - {artist_name}"
+    stars = '⭐' * ((record.popularity + 19) // 20)  # Convert popularity to 1-5 stars
+    return f"{i}. *{track_name}* - {artist_name} {stars}"
+
+def format_current_track(current_track) -> str:
+    """Tạo nội dung tin nhắn cho bài hát đang phát."""
+    if current_track is None or not current_track.get('is_playing') or not current_track.get('item'):
+        return "🔇 *Không có bài hát nào đang phát*"
+
+    track = current_track['item']
+    artist = escape_markdown(track['artists'][0]['name'])
+    track_name = escape_markdown(track['name'])
+    album = escape_markdown(track['album']['name'])
+    duration = track['duration_ms'] // 1000
+    progress = current_track['progress_ms'] // 1000
+    
+    # Thêm thông tin chi tiết
+    album_type = track['album']['album_type'].capitalize()
+    release_date = track['album']['release_date']
+    track_number = track['track_number']
+    total_tracks = track['album']['total_tracks']
+    popularity = track['popularity']
+    
+    # Tạo thanh tiến trình
+    progress_bar_length = 20
+    progress_ratio = progress / duration if duration else 0
+    filled = int(progress_bar_length * progress_ratio)
+    progress_bar = '▓' * filled + '░' * (progress_bar_length - filled)
+    
+    response = (
+        f"🎵 *Đang phát:* {track_name}\n"
+        f"👤 *Nghệ sĩ:* {artist}\n"
+        f"💿 *Album:* {album}\n"
+        f"📀 *Loại album:* {album_type}\n"
+        f"📅 *Ngày phát hành:* {release_date}\n"
+        f"🔢 *Track:* {track_number}/{total_tracks}\n"
+        f"🌟 *Độ phổ biến:* {popularity}/100\n\n"
+        f"⏳ *Thời gian:* {progress//60}:{progress%60:02d}/{duration//60}:{duration%60:02d}\n"
+        f"`{progress_bar}` {int(progress_ratio * 100)}%"
+    )
+    
+    # Thêm preview URL nếu có
+    if track.get('preview_url'):
+        response += f"\n\n🎧 [Nghe thử 30s]({track['preview_url']})"
+    
+    # Thêm link Spotify
+    response += f"\n🔗 [Mở trên Spotify]({track['external_urls']['spotify']})"
+    return response
+
+class AlbumArtCache:
+    """Cache ảnh bìa album trên đĩa, đánh địa chỉ theo nội dung (sha256 của ảnh đã tải).
+
+    Nhiều URL trỏ tới cùng một ảnh chỉ được lưu một lần; chỉ mục URL -> mã băm (tối đa
+    ART_INDEX_LIMIT URL) được lưu trong index.json để giữ lại qua các lần khởi động.
+    """
+
+    def __init__(self, directory: str = ART_CACHE_DIR):
+        self.directory = directory
+        self._index_path = os.path.join(directory, 'index.json')
+        self._index = None
+        self._pending = {}  # url -> Future đang tải
+        self._save_lock = None  # Tạo khi đã có event loop
+        self._dirty = False
+
+    def _load_index(self) -> OrderedDict:
+        if self._index is None:
+            try:
+                with open(self._index_path, encoding='utf-8') as f:
+                    self._index = OrderedDict(json.load(f))
+            except (OSError, ValueError):
+                self._index = OrderedDict()
+        return self._index
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest + '.jpg')
+
+    def _download(self, url: str) -> str:
+        response = requests.get(url, timeout=ART_DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        data = resize_cover(response.content)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    def _write_index(self, snapshot: dict) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self._index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self._index_path)
+
+    async def _save_index(self) -> None:
+        """Ghi chỉ mục từ bản sao chụp trên event loop, mỗi lúc chỉ một luồng ghi.
+
+        Các lần hụt cache trong lúc đang ghi được gộp vào một lần ghi tiếp theo.
+        """
+        self._dirty = True
+        if self._save_lock is None:
+            self._save_lock = asyncio.Lock()
+        async with self._save_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            await asyncio.to_thread(self._write_index, dict(self._index))
+
+    async def get(self, url: str) -> bytes:
+        """Trả về ảnh bìa (đã thu nhỏ) cho URL, chỉ tải về nếu chưa có trên đĩa."""
+        index = self._load_index()
+        digest = index.get(url)
+        if digest is not None:
+            index.move_to_end(url)
+        if digest is None or not os.path.exists(self._path(digest)):
+            future = self._pending.get(url)
+            if future is None:
+                future = asyncio.ensure_future(asyncio.to_thread(self._download, url))
+                self._pending[url] = future
+                future.add_done_callback(lambda _: self._pending.pop(url, None))
+            digest = await asyncio.shield(future)
+            index[url] = digest
+            index.move_to_end(url)
+            while len(index) > ART_INDEX_LIMIT:
+                index.popitem(last=False)
+            try:
+                await self._save_index()
+            except OSError as e:
+                # Chỉ mục chỉ để tăng tốc lần sau, ảnh vừa tải vẫn dùng được
+                logger.error("Error saving album art index: %s", e)
+        return await asyncio.to_thread(read_file, self._path(digest))
+
+def read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+def resize_cover(data: bytes) -> bytes:
+    """Thu nhỏ ảnh bìa về CARD_COVER_SIZE; giữ nguyên nếu không có Pillow."""
+    if Image is None:
+        return data
+    with Image.open(io.BytesIO(data)) as cover:
+        cover = cover.convert('RGB')
+        cover.thumbnail((CARD_COVER_SIZE, CARD_COVER_SIZE))
+        output = io.BytesIO()
+        cover.save(output, format='JPEG', quality=90)
+        return output.getvalue()
+
+def load_card_font(size: int):
+    try:
+        return ImageFont.truetype(CARD_FONT, size)
+    except OSError:
+        return ImageFont.load_default()
+
+def render_card(cover: bytes, title: str, artist: str, album: str) -> bytes:
+    """Vẽ thẻ "đang phát" từ ảnh bìa. Chạy trong process pool nên chỉ nhận và trả về bytes."""
+    if Image is None:
+        return cover
+    with Image.open(io.BytesIO(cover)) as art:
+        art = art.convert('RGB').resize((CARD_COVER_SIZE, CARD_COVER_SIZE))
+        # Màu nền lấy từ màu trung bình của ảnh bìa, làm tối để chữ trắng dễ đọc
+        average = art.resize((1, 1)).getpixel((0, 0))
+        background = tuple(int(channel * 0.35) for channel in average)
+        card = Image.new('RGB', (CARD_COVER_SIZE, CARD_COVER_SIZE + CARD_TEXT_HEIGHT), background)
+        card.paste(art, (0, 0))
+
+    draw = ImageDraw.Draw(card)
+    lines = [
+        (title, load_card_font(34), (255, 255, 255)),
+        (artist, load_card_font(26), (220, 220, 220)),
+        (album, load_card_font(22), (170, 170, 170)),
+    ]
+    y = CARD_COVER_SIZE + 20
+    for text, font, color in lines:
+        while text and draw.textlength(text, font=font) > CARD_COVER_SIZE - 48:
+            text = text[:-2] + '…'
+        draw.text((24, y), text, font=font, fill=color)
+        y += getattr(font, 'size', 10) + 14
+
+    output = io.BytesIO()
+    card.save(output, format='JPEG', quality=88)
+    return output.getvalue()
+
+class NowPlayingCards:
+    """Tạo và gửi thẻ ảnh "đang phát".
+
+    Thẻ đã vẽ được giữ trong LRU bộ nhớ có giới hạn, còn file_id Telegram trả về sau
+    lần tải lên đầu tiên được dùng lại để mỗi thẻ chỉ phải upload một lần.
+    """
+
+    def __init__(self, art_cache: AlbumArtCache, max_cards: int = CARD_CACHE_SIZE):
+        self.art_cache = art_cache
+        self.max_cards = max_cards
+        self._cards = OrderedDict()  # track_id -> bytes
+        self._file_ids = OrderedDict()  # track_id -> Telegram file_id
+        self._pool = None
+
+    def snapshot_state(self) -> OrderedDict:
+        # Chỉ giữ file_id Telegram; thẻ đã vẽ thì vẽ lại khi cần
+        return self._file_ids
+
+    def restore_state(self, state: OrderedDict) -> None:
+        self._file_ids = state
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=CARD_RENDER_WORKERS)
+        return self._pool
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def render(self, track: dict) -> bytes:
+        track_id = track['id']
+        card = self._cards.get(track_id)
+        if card is not None:
+            self._cards.move_to_end(track_id)
+            return card
+
+        cover = await self.art_cache.get(track['album']['images'][0]['url'])
+        loop = asyncio.get_running_loop()
+        card = await loop.run_in_executor(
+            self._executor(), render_card, cover, track['name'],
+            ', '.join(artist['name'] for artist in track['artists']), track['album']['name']
+        )
+        self._cards[track_id] = card
+        while len(self._cards) > self.max_cards:
+            self._cards.popitem(last=False)
+        return card
+
+    async def send(self, update: Update, track: dict, caption: str) -> None:
+        track_id = track['id']
+        file_id = self._file_ids.get(track_id)
+        if file_id is not None:
+            try:
+                await reply_photo(update, file_id, caption=caption, parse_mode='Markdown')
+                return
+            except BadRequest:
+                # file_id không còn hợp lệ, tải lại ảnh
+                del self._file_ids[track_id]
+
+        message = await reply_photo(update, await self.render(track), caption=caption, parse_mode='Markdown')
+        if message is not None and message.photo:
+            self._file_ids[track_id] = message.photo[-1].file_id
+            while len(self._file_ids) > CARD_FILE_ID_LIMIT:
+                self._file_ids.popitem(last=False)
+
+now_playing_cards = NowPlayingCards(AlbumArtCache())
+
+async def get_current_track(update: Update, sp: spotipy.Spotify, cached: bool = False) -> None:
+    """Lấy thông tin bài hát đang phát."""
+    user_id = user_key(update)
+    try:
+        current_track = view_cache.get(user_id, 'current') if cached else None
+        if current_track is None:
+            current_track = prefetcher.take(user_id, 'current')
+        if current_track is None:
+            current_track = await sp_call(sp.current_user_playing_track)
+        view_cache.put(user_id, 'current', current_track)
+        response = format_current_track(current_track)
+        track = (current_track or {}).get('item')
+        if track and track.get('type', 'track') == 'track':
+            catalog.add_track(track)
+        # Tin nhắn văn bản không sửa được thành ảnh nên màn hình inline chỉ hiện dạng văn bản
+        if update.callback_query is None and current_track and current_track.get('is_playing') \
+                and track and track['album'].get('images'):
+            try:
+                await now_playing_cards.send(update, track, response)
+                return
+            except Exception as e:
+                # Không tạo được thẻ ảnh thì vẫn gửi thông tin dạng văn bản
+                logger.error("Error sending now playing card: %s", e)
+        await reply(update, response, parse_mode='Markdown', disable_web_page_preview=True,
+                    reply_markup=view_keyboard('current'))
+    except Exception as e:
+        logger.error("Error in get_current_track: %s", e)
+        await reply(
+            update,
+            spotify_error_text(e, "❌ *Có lỗi xảy ra khi lấy thông tin bài hát.*"),
+            parse_mode='Markdown'
+        )
+
+class LiveSubscription:
+    """Một tin nhắn "đang phát" được cập nhật trực tiếp cho một người dùng."""
+    __slots__ = ('user_id', 'chat_id', 'message_id', 'next_poll', 'last_edit',
+                 'last_text', 'track_id', 'expires_at')
+
+    def __init__(self, user_id: str, chat_id: int, message_id: int, now: float):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.next_poll = now
+        self.last_edit = 0.0
+        self.last_text = None
+        self.track_id = None
+        self.expires_at = now + LIVE_MAX_DURATION
+
+class LiveNowPlayingScheduler:
+    """Bộ lập lịch trung tâm poll bài hát đang phát cho mọi người dùng đăng ký chế độ live.
+
+    Các lượt poll được xếp trong một heap theo thời điểm đến hạn, mỗi tick chỉ xử lý
+    tối đa LIVE_BATCH_SIZE người dùng. Các lần sửa tin nhắn đi qua hàng đợi gửi chung
+    với độ ưu tiên thấp nhất, lần sửa mới thay thế lần sửa cũ chưa kịp gửi.
+    """
+
+    def __init__(self):
+        self.subscriptions = {}
+        self._heap = []
+        self._seq = 0
+        self._task = None
+        self._semaphore = asyncio.Semaphore(LIVE_MAX_CONCURRENCY)
+
+    def subscribe(self, user_id: str, chat_id: int, message_id: int) -> None:
+        sub = LiveSubscription(user_id, chat_id, message_id, time.monotonic())
+        self.subscriptions[user_id] = sub
+        self._schedule(sub, 0)
+
+    def unsubscribe(self, user_id: str) -> bool:
+        return self.subscriptions.pop(user_id, None) is not None
+
+    def _schedule(self, sub: LiveSubscription, delay: float) -> None:
+        sub.next_poll = time.monotonic() + delay
+        self._seq += 1
+        heapq.heappush(self._heap, (sub.next_poll, self._seq, sub))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _due(self) -> list:
+        now = time.monotonic()
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < LIVE_BATCH_SIZE:
+            next_poll, _, sub = heapq.heappop(self._heap)
+            # Bỏ qua các mục đã hủy đăng ký hoặc đã được lên lịch lại
+            if self.subscriptions.get(sub.user_id) is sub and sub.next_poll == next_poll:
+                due.append(sub)
+        return due
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                due = self._due()
+                if due:
+                    await asyncio.gather(*(self._poll(sub) for sub in due))
+            except Exception as e:
+                logger.error("Error in live scheduler: %s", e)
+            await asyncio.sleep(LIVE_TICK_SECONDS)
+
+    def _edit(self, sub: LiveSubscription, text: str) -> asyncio.Future:
+        future = tenant_of(sub.user_id).outbound.submit(
+            sub.chat_id, 'edit_message_text', PRIORITY_LIVE, ('live', sub.message_id),
+            text=text, message_id=sub.message_id, parse_mode='Markdown', disable_web_page_preview=True
+        )
+        future.add_done_callback(lambda f: self._on_edit_done(sub, f))
+        return future
+
+    def _on_edit_done(self, sub: LiveSubscription, future: asyncio.Future) -> None:
+        if future.cancelled():
+            return
+        error = future.exception()
+        if isinstance(error, BadRequest) and 'not modified' not in str(error).lower():
+            # Tin nhắn đã bị xóa hoặc không thể sửa nữa
+            if self.subscriptions.get(sub.user_id) is sub:
+                self.unsubscribe(sub.user_id)
+
+    async def _finish(self, sub: LiveSubscription, text: str) -> None:
+        self.unsubscribe(sub.user_id)
+        self._edit(sub, text)
+
+    async def _poll(self, sub: LiveSubscription) -> None:
+        if time.monotonic() >= sub.expires_at:
+            await self._finish(sub, (sub.last_text or "") + "\n\n⏹ _Chế độ live đã kết thúc._")
+            return
+        # Đọc phiên bằng peek để poll nền không giữ phiên luôn "hoạt động"; token sắp hết hạn được làm mới
+        token = await background_token(sub.user_id)
+        if not token:
+            session = sessions.peek(sub.user_id)
+            if session is None or not session.token:
+                await self._finish(sub, "⏹ *Chế độ live đã dừng do bạn đã đăng xuất.*")
+            else:
+                await self._finish(sub, "⏹ *Chế độ live đã dừng do phiên đăng nhập hết hạn.*")
+            return
+
+        try:
+            async with self._semaphore:
+                sp = spotify_client(token)
+                current_track = await sp_call(sp.current_user_playing_track)
+        except spotipy.SpotifyException as e:
+            if e.http_status == 401:
+                await self._finish(sub, "⏹ *Chế độ live đã dừng do phiên đăng nhập hết hạn.*")
+            else:
+                self._schedule(sub, LIVE_PAUSED_INTERVAL)
+            return
+        except Exception as e:
+            logger.error("Error polling live track: %s", e)
+            self._schedule(sub, LIVE_PAUSED_INTERVAL)
+            return
+
+        interval = live_poll_interval(current_track)
+        text = "🔴 *LIVE*\n" + format_current_track(current_track)
+        track_id = ((current_track or {}).get('item') or {}).get('id')
+        track_changed = track_id != sub.track_id
+
+        now = time.monotonic()
+        if text != sub.last_text:
+            if not track_changed and now - sub.last_edit < LIVE_EDIT_INTERVAL:
+                # Chưa đủ khoảng cách giữa hai lần sửa, poll lại khi được phép sửa
+                interval = min(interval, LIVE_EDIT_INTERVAL - (now - sub.last_edit))
+            else:
+                self._edit(sub, text)
+                sub.last_text = text
+                sub.track_id = track_id
+                sub.last_edit = now
+
+        if self.subscriptions.get(sub.user_id) is sub:
+            self._schedule(sub, interval)
+
+def live_poll_interval(current_track) -> float:
+    """Tính khoảng thời gian đến lần poll tiếp theo dựa trên thời gian còn lại của bài hát."""
+    if current_track is None or not current_track.get('is_playing') or not current_track.get('item'):
+        return LIVE_PAUSED_INTERVAL
+    duration = current_track['item']['duration_ms'] / 1000
+    remaining = duration - current_track['progress_ms'] / 1000
+    # Mỗi ô của thanh tiến trình tương ứng 1/20 thời lượng bài hát
+    step = max(LIVE_MIN_INTERVAL, duration / 20)
+    return max(1.0, min(remaining + 1, step, LIVE_MAX_INTERVAL))
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+live_scheduler = LiveNowPlayingScheduler()
+
+async def live_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Gửi tin nhắn bài hát đang phát và tự động cập nhật tại chỗ."""
+    user_id = user_key(update)
+    session = get_session(user_id)
+
+    if not session.token:
+        await reply(
+            update,
+            "*Bạn chưa đăng nhập. Vui lòng sử dụng /start để bắt đầu quá trình xác thực.*",
+            parse_mode='Markdown'
+        )
+        return
+
+    message = await reply(
+        update,
+        "🔴 *LIVE*\n⏳ _Đang tải bài hát..._",
+        parse_mode='Markdown'
+    )
+    live_scheduler.subscribe(user_id, message.chat_id, message.message_id)
+
+async def live_stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = user_key(update)
+    if live_scheduler.unsubscribe(user_id):
+        await reply(update, "*⏹ Đã tắt chế độ live.*", parse_mode='Markdown')
+    else:
+        await reply(update, "*❗ Chế độ live chưa được bật.*", parse_mode='Markdown')
+
+class SearchCache:
+    """Cache LRU cho kết quả tìm kiếm, có thể trả lời truy vấn dài hơn từ kết quả của tiền tố.
+
+    Khi kết quả của một tiền tố đã đầy đủ (tổng số kết quả không vượt quá giới hạn),
+    mọi truy vấn bắt đầu bằng tiền tố đó được lọc cục bộ mà không cần gọi Spotify.
+    """
+
+    def __init__(self, max_entries: int = SEARCH_CACHE_SIZE, ttl: float = SEARCH_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # query -> (thời điểm lưu, danh sách track, đầy đủ hay không)
+
+    def snapshot_state(self) -> OrderedDict:
+        return self._entries
+
+    def restore_state(self, state: OrderedDict) -> None:
+        self._entries = state
+
+    def _get_fresh(self, query: str):
+        entry = self._entries.get(query)
+        if entry is None:
+            return None
+        if time.time() - entry[0] > self.ttl:
+            del self._entries[query]
+            return None
+        self._entries.move_to_end(query)
+        return entry
+
+    def get(self, query: str):
+        entry = self._get_fresh(query)
+        if entry is not None:
+            return entry[1]
+        # Tìm tiền tố dài nhất có kết quả đầy đủ
+        for end in range(len(query) - 1, 0, -1):
+            entry = self._get_fresh(query[:end])
+            if entry is not None and entry[2]:
+                words = query.split()
+                return [track for track in entry[1] if all(word in track_search_text(track) for word in words)]
+        return None
+
+    def put(self, query: str, tracks: list, complete: bool) -> None:
+        self._entries[query] = (time.time(), tracks, complete)
+        self._entries.move_to_end(query)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+def normalize_query(query: str) -> str:
+    return ' '.join(query.lower().split())
+
+def track_search_text(track: dict) -> str:
+    artists = ' '.join(artist['name'] for artist in track['artists'])
+    return f"{track['name']} {artists} {track['album']['name']}".lower()
+
+search_cache = SearchCache()
+pending_searches = {}  # query -> Future của lời gọi Spotify đang chạy
+inline_tasks = {}  # user_id -> Task của truy vấn inline gần nhất
+running_exports = set()  # user_id đang có /export chạy
+
+async def search_tracks(query: str) -> list:
+    """Tìm bài hát bằng token của ứng dụng, dùng cache và gộp các lời gọi trùng nhau."""
+    tracks = search_cache.get(query)
+    if tracks is not None:
+        return tracks
+
+    future = pending_searches.get(query)
+    if future is None:
+        future = asyncio.ensure_future(sp_call(app_sp.search, q=query, type='track', limit=SEARCH_LIMIT))
+        pending_searches[query] = future
+        future.add_done_callback(lambda f: store_search_result(query, f))
+    # shield để truy vấn bị hủy không hủy lời gọi mà người khác đang chờ; kết quả vẫn được lưu cache
+    results = await asyncio.shield(future)
+    return results['tracks']['items']
+
+def store_search_result(query: str, future: asyncio.Future) -> None:
+    pending_searches.pop(query, None)
+    if future.cancelled() or future.exception() is not None:
+        return
+    results = future.result()['tracks']
+    search_cache.put(query, results['items'], results['total'] <= len(results['items']))
+
+def build_inline_results(tracks: list) -> list:
+    results = []
+    for track in tracks[:SEARCH_LIMIT]:
+        track_name = track['name']
+        artist_name = ', '.join(artist['name'] for artist in track['artists'])
+        images = track['album'].get('images') or []
+        results.append(InlineQueryResultArticle(
+            id=track['id'],
+            title=track_name,
+            description=f"{artist_name} • {track['album']['name']}",
+            thumbnail_url=images[-1]['url'] if images else None,
+            input_message_content=InputTextMessageContent(
+                f"🎵 *{escape_markdown(track_name)}* - {escape_markdown(artist_name)}\n"
+                f"🔗 [Mở trên Spotify]({track['external_urls']['spotify']})",
+                parse_mode='Markdown'
+            )
+        ))
+    return results
+
+async def answer_inline_query(update: Update, query: str) -> None:
+    tracks = await search_tracks(query) if query else []
+    try:
+        await update.inline_query.answer(build_inline_results(tracks), cache_time=INLINE_CACHE_TIME)
+    except BadRequest as e:
+        # Truy vấn đã quá cũ (người dùng gõ tiếp hoặc hết 10 giây)
+        logger.info("Inline query expired: %s", e)
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Xử lý `@bot <từ khóa>`: trả lời ngay nếu có cache, nếu không thì chờ người dùng ngừng gõ."""
+    user_id = user_key(update)
+    query = normalize_query(update.inline_query.query)
+
+    previous = inline_tasks.pop(user_id, None)
+    if previous is not None:
+        previous.cancel()
+
+    if not query or search_cache.get(query) is not None:
+        await answer_inline_query(update, query)
+        return
+
+    async def debounced() -> None:
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        await answer_inline_query(update, query)
+
+    task = asyncio.create_task(debounced())
+    inline_tasks[user_id] = task
+    try:
+        await task
+    except asyncio.CancelledError:
+        # Truy vấn đã bị thay thế bởi truy vấn mới hơn
+        pass
+    except Exception as e:
+        logger.error("Error in inline_query: %s", e)
+    finally:
+        if inline_tasks.get(user_id) is task:
+            del inline_tasks[user_id]
+
+async def get_stats(update: Update, sp: spotipy.Spotify, cached: bool = False) -> None:
+    """Lấy thống kê chi tiết về tài khoản Spotify."""
+    user_id = user_key(update)
+    try:
+        results = view_cache.get(user_id, 'stats') if cached else None
+        if results is None:
+            # Các endpoint được gọi song song; endpoint nào lỗi/treo chỉ làm thiếu phần tương ứng
+            results = await asyncio.gather(
+                sp_call(sp.current_user),
+                sp_call(sp.current_user_followed_artists),
+                sp_call(sp.current_user_playlists),
+                sp_call(sp.current_user_saved_tracks),
+                sp_call(sp.current_user_top_artists, limit=3, time_range='short_term'),
+                sp_call(sp.current_user_recently_played, limit=1),
+                return_exceptions=True
+            )
+            if not any(isinstance(result, Exception) for result in results):
+                view_cache.put(user_id, 'stats', results)
+        user_info, followed_artists, playlists, saved_tracks, top_artists, recently_played = results
+        if isinstance(user_info, Exception):
+            raise user_info
+        unavailable = "_tạm thời không lấy được_"
+
+        # Tính toán thống kê
+        total_playlists = unavailable if isinstance(playlists, Exception) else playlists['total']
+        total_saved = unavailable if isinstance(saved_tracks, Exception) else saved_tracks['total']
+        total_following = unavailable if isinstance(followed_artists, Exception) \
+            else f"{followed_artists['artists']['total']} nghệ sĩ"
+        
+        # Tạo phản hồi
+        response = [
+            "📊 *Thống kê tài khoản Spotify của bạn:*\n",
+            f"👤 *Tên người dùng:* {escape_markdown(user_info['display_name'])}",
+            f"🌍 *Quốc gia:* {user_info.get('country', 'N/A')}",
+            f"📧 *Email:* {user_info.get('email', 'N/A')}",
+            f"🎵 *Gói dịch vụ:* {user_info['product'].capitalize()}",
+            f"👥 *Đang theo dõi:* {total_following}",
+            f"📋 *Playlist:* {total_playlists}",
+            f"❤️ *Bài hát đã lưu:* {total_saved}"
+        ]
+
+        # Thêm nghệ sĩ yêu thích
+        if not isinstance(top_artists, Exception) and top_artists['items']:
+            response.append("\n🌟 *Top nghệ sĩ gần đây:*")
+            for i, artist in enumerate(top_artists['items'], 1):
+                response.append(f"{i}. {escape_markdown(artist['name'])}")
+
+        # Thêm bài hát gần đây nhất
+        if not isinstance(recently_played, Exception) and recently_played['items']:
+            last_played = recently_played['items'][0]['track']
+            response.append(
+                f"\n🎵 *Bài hát nghe gần đây nhất:*\n"
+                f"{escape_markdown(last_played['name'])} - {escape_markdown(last_played['artists'][0]['name'])}"
+            )
+
+        # Thêm liên kết hồ sơ
+        if user_info.get('external_urls', {}).get('spotify'):
+            response.append(f"\n🔗 [Xem hồ sơ trên Spotify]({user_info['external_urls']['spotify']})")
+
+        await reply(
+            update,
+            '\n'.join(response),
+            parse_mode='Markdown',
+            disable_web_page_preview=True,
+            reply_markup=view_keyboard('stats')
+        )
+
+    except Exception as e:
+        logger.error("Error in get_stats: %s", e)
+        await reply(
+            update,
+            spotify_error_text(e, "❌ *Có lỗi xảy ra khi lấy thống kê.*"),
+            parse_mode='Markdown'
+        )
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = user_key(update)
+    session = get_session(user_id)
+    
+    if session.token:
+        await show_main_menu(update, context)
+    else:
+        auth_url = authorize_url(user_id)
+        keyboard = [[InlineKeyboardButton("🔑 Xác thực Spotify", url=auth_url)]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        if oauth_callback.running:
+            message = (
+                "*Chào mừng bạn đến với Spotify Bot!*\n\n"
+                "Nhấn nút bên dưới để xác thực với Spotify. "
+                "Sau khi bạn đồng ý, bot sẽ tự động đăng nhập và báo lại tại đây."
+            )
+        else:
+            message = (
+                "*Chào mừng bạn đến với Spotify Bot!*\n\n"
+                "Để bắt đầu, hãy làm theo các bước sau:\n"
+                "1. Nhấn nút bên dưới để xác thực với Spotify\n"
+                "2. Sau khi xác thực thành công, copy token nhận được\n"
+                "3. Quay lại đây và sử dụng lệnh /set\\_token để nhập token"
+            )
+        
+        await reply(
+            update,
+            message,
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
+
+async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = user_key(update)
+    session = get_session(user_id)
+    
+    current_amount = get_user_amount(user_id)
+    settings_text = (
+        "*⚙️ Cài đặt hiện tại:*\n\n"
+        f"📊 *Số lượng hiển thị:* {current_amount}\n"
+        f"🔒 *Trạng thái:* {'*Đã đăng nhập*' if session.token else '*Chưa đăng nhập*'}\n\n"
+        "*Các lệnh cài đặt:*\n"
+        "• `/set_amount <số>` - Điều chỉnh số lượng hiển thị\n"
+        "• `/logout` - Đăng xuất\n"
         "• `/start` - Đăng nhập lại"
     )
     
-    await update.message.reply_text(
+    await reply(
+        update,
         settings_text,
         parse_mode='Markdown'
     )
 
-async def show_help(update: Update) -> None:
-    user_id = str(update.effective_user.id)
-    amount = get_user_amount(user_id)
-    
-    help_text = f"""
-*🤖 Hướng dẫn sử dụng Spotify Bot:*
+async def show_help(update: Update) -> None:
+    user_id = user_key(update)
+    amount = get_user_amount(user_id)
+    
+    help_text = f"""
+*🤖 Hướng dẫn sử dụng Spotify Bot:*
+
+• Sử dụng các nút trên bàn phím tùy chỉnh để chọn chức năng
+• Số lượng hiển thị hiện tại: *{amount}* mục
+
+*Các lệnh cơ bản:*
+• `/start` - Bắt đầu bot và xác thực với Spotify
+• `/menu` - Hiển thị menu chính
+• `/set_token` - Nhập token sau khi xác thực Spotify
+• `/logout` - Đăng xuất khỏi tài khoản Spotify
+
+*Cài đặt tùy chỉnh:*
+• `/set_amount <số>` - Điều chỉnh số lượng hiển thị (1-{MAX_AMOUNT})
+• `/settings` - Xem cài đặt hiện tại
+
+*Lưu ý:*
+• Số lượng tối đa có thể hiển thị là {MAX_AMOUNT} mục
+• Nếu gặp lỗi, hãy thử đăng xuất và đăng nhập lại
+"""
+    await reply(update, help_text, parse_mode='Markdown')
+
+async def get_top_tracks(update: Update, sp: spotipy.Spotify, amount: int = None,
+                         time_range: str = 'short_term') -> None:
+    user_id = user_key(update)
+    amount = amount or get_user_amount(user_id)
+    
+    try:
+        if time_range == 'short_term' and top_lists.peek(user_id, 'tracks', time_range) is not None:
+            prefetcher.take(user_id, 'top')  # Chỉ để đo tỉ lệ trúng; dữ liệu lấy từ top_lists
+        ids, previous = await top_lists.get(sp, user_id, 'tracks', time_range)
+        records = [catalog.get(track_id) for track_id in ids[:amount]]
+        response = [f"*🏆 Top {amount} bài hát của bạn ({TOP_RANGE_LABELS[time_range]}):*\n"]
+        
+        if not records:
+            response = ["*❗ Không có dữ liệu về top bài hát.*"]
+        else:
+            markers = rank_markers(ids, previous)
+            for i, record in enumerate(records, 1):
+                response.append(format_track_line(i, record) + markers[i - 1])
+            summary = await mood_summary(record.id for record in records)
+            if summary:
+                response.append(summary)
+        
+        await reply(update, '\n'.join(response), parse_mode='Markdown',
+                    reply_markup=view_keyboard('top', amount, time_range))
+    except Exception as e:
+        logger.error("Error in get_top_tracks: %s", e)
+        await reply(
+            update,
+            spotify_error_text(e, "*❌ Có lỗi xảy ra khi lấy danh sách top bài hát.*"),
+            parse_mode='Markdown'
+        )
+
+class TopListCache:
+    """Cache top bài hát/nghệ sĩ theo (người dùng, loại, khoảng thời gian).
+
+    Mỗi mục chỉ lưu tuple id (chuỗi đã intern trong catalog) cùng ảnh chụp xếp hạng trước đó,
+    nên mũi tên tăng/giảm hạng được tính cục bộ mà không cần thêm lời gọi API.
+    """
+
+    def __init__(self):
+        self._entries = {}  # (user_id, kind, time_range) -> (fetched_at, ids, previous_ids)
+
+    def snapshot_state(self) -> dict:
+        return self._entries
+
+    def restore_state(self, state: dict) -> None:
+        self._entries = state
+
+    def peek(self, user_id: str, kind: str, time_range: str):
+        entry = self._entries.get((user_id, kind, time_range))
+        if entry is None or time.time() - entry[0] >= TOP_RANGE_TTL[time_range]:
+            return None
+        return entry
+
+    async def get(self, sp: spotipy.Spotify, user_id: str, kind: str, time_range: str) -> tuple:
+        """Trả về (ids, previous_ids); chỉ gọi Spotify khi mục trong cache đã hết hạn."""
+        entry = self.peek(user_id, kind, time_range)
+        # Bản ghi có thể đã bị loại khỏi catalog, khi đó lấy lại từ Spotify
+        table = catalog.tracks if kind == 'tracks' else catalog.artists
+        if entry is not None and all(item_id in table for item_id in entry[1]):
+            return entry[1], entry[2]
+
+        if kind == 'tracks':
+            result = await sp_call(sp.current_user_top_tracks, limit=TOP_FETCH_LIMIT, time_range=time_range)
+            ids = tuple(record.id for record in catalog.add_tracks(result['items']))
+            discovery.submit(user_id, time_range, ids)
+        else:
+            result = await sp_call(sp.current_user_top_artists, limit=TOP_FETCH_LIMIT, time_range=time_range)
+            ids = tuple(catalog.add_artist(artist) for artist in result['items'])
+
+        old = self._entries.get((user_id, kind, time_range))
+        if old is None:
+            previous = None
+        elif old[1] != ids:
+            previous = old[1]
+        else:
+            previous = old[2]
+        self._entries[(user_id, kind, time_range)] = (int(time.time()), ids, previous)
+        return ids, previous
+
+    def latest(self, user_id: str, kind: str, time_range: str):
+        """Danh sách id gần nhất đã lưu, kể cả khi đã quá TTL."""
+        entry = self._entries.get((user_id, kind, time_range))
+        return entry[1] if entry else None
+
+    def forget(self, user_id: str) -> None:
+        for key in [key for key in self._entries if key[0] == user_id]:
+            del self._entries[key]
+
+top_lists = TopListCache()
+
+def rank_markers(ids: tuple, previous) -> list:
+    """Tính ký hiệu thay đổi thứ hạng (↑/↓/🆕) so với ảnh chụp trước."""
+    if previous is None:
+        return [''] * len(ids)
+    old_ranks = {item_id: rank for rank, item_id in enumerate(previous)}
+    markers = []
+    for rank, item_id in enumerate(ids):
+        old = old_ranks.get(item_id)
+        if old is None:
+            markers.append(' 🆕')
+        elif old > rank:
+            markers.append(f" ↑{old - rank}")
+        elif old < rank:
+            markers.append(f" ↓{rank - old}")
+        else:
+            markers.append('')
+    return markers
+
+async def get_top_all(update: Update, sp: spotipy.Spotify) -> None:
+    """Top bài hát và nghệ sĩ cho cả ba khoảng thời gian, kèm thay đổi thứ hạng."""
+    user_id = user_key(update)
+    amount = min(get_user_amount(user_id), TOP_ALL_LIMIT)
+
+    try:
+        keys = [(kind, time_range) for kind in ('tracks', 'artists') for time_range in TOP_RANGE_TTL]
+        results = await asyncio.gather(*(top_lists.get(sp, user_id, kind, time_range) for kind, time_range in keys))
+
+        response = [f"*📈 Top {amount} theo từng khoảng thời gian:*"]
+        for (kind, time_range), (ids, previous) in zip(keys, results):
+            title = "🏆 Bài hát" if kind == 'tracks' else "🌟 Nghệ sĩ"
+            response.append(f"\n*{title} - {TOP_RANGE_LABELS[time_range]}:*")
+            if not ids:
+                response.append("_Chưa có dữ liệu._")
+                continue
+            markers = rank_markers(ids, previous)
+            for i, item_id in enumerate(ids[:amount], 1):
+                if kind == 'tracks':
+                    line = format_track_line(i, catalog.get(item_id), with_stars=False)
+                else:
+                    line = f"{i}. {escape_markdown(catalog.artist_name(item_id))}"
+                response.append(line + markers[i - 1])
+
+        await reply(update, '\n'.join(response), parse_mode='Markdown')
+    except Exception as e:
+        logger.error("Error in get_top_all: %s", e)
+        await reply(
+            update,
+            spotify_error_text(e, "*❌ Có lỗi xảy ra khi lấy bảng xếp hạng.*"),
+            parse_mode='Markdown'
+        )
+
+async def top_all_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    sp = await get_user_spotify(update, context)
+    if sp is not None:
+        await get_top_all(update, sp)
+
+async def get_playlists(update: Update, sp: spotipy.Spotify, amount: int = None) -> None:
+    user_id = user_key(update)
+    amount = amount or get_user_amount(user_id)
+    
+    try:
+        # Chỉ dùng chỉ mục khi còn mới; nếu không chỉ cần một lần gọi cho amount playlist đầu tiên
+        index = playlist_index.fresh(user_id)
+        if index is not None:
+            playlists = list(index.playlists.values())[:amount]
+        else:
+            result = await sp_call(sp.current_user_playlists, limit=amount)
+            playlists = [(item['name'], item['snapshot_id'], item['tracks']['total'])
+                         for item in result['items'] if item]
+        response = [f"*📋 {amount} playlist gần đây của bạn:*\n"]
+        
+        if not playlists:
+            response = ["*❗ Bạn chưa có playlist nào.*"]
+        else:
+            for i, (name, _, tracks_count) in enumerate(playlists, 1):
+                playlist_name = escape_markdown(name)
+                response.append(f"{i}. *{playlist_name}* ({tracks_count} bài hát)")
+        
+        await reply(update, '\n'.join(response), parse_mode='Markdown', reply_markup=view_keyboard('playlists', amount))
+    except Exception as e:
+        logger.error("Error in get_playlists: %s", e)
+        await reply(
+            update,
+            spotify_error_text(e, "*❌ Có lỗi xảy ra khi lấy danh sách playlist.*"),
+            parse_mode='Markdown'
+        )
+
+class PlaylistTrackCache:
+    """Cache danh sách bài hát của playlist theo snapshot_id.
+
+    Playlist chưa thay đổi (cùng snapshot_id) được dùng lại mà không tải lại bài hát.
+    Chỉ lưu tuple id, chi tiết bài hát nằm trong catalog.
+    """
+
+    def __init__(self, max_playlists: int = PLAYLIST_CACHE_SIZE):
+        self.max_playlists = max_playlists
+        self._entries = {}  # playlist_id -> (snapshot_id, track ids)
+
+    def snapshot_state(self) -> dict:
+        return self._entries
+
+    def restore_state(self, state: dict) -> None:
+        self._entries = state
+
+    def get(self, playlist_id: str, snapshot_id: str):
+        entry = self._entries.get(playlist_id)
+        if entry is None or entry[0] != snapshot_id:
+            return None
+        # Các bản ghi có thể đã bị loại khỏi catalog
+        if not all(track_id in catalog.tracks for track_id in entry[1]):
+            return None
+        return entry[1]
+
+    def put(self, playlist_id: str, snapshot_id: str, track_ids: tuple) -> None:
+        self._entries.pop(playlist_id, None)
+        self._entries[playlist_id] = (snapshot_id, track_ids)
+        if len(self._entries) > self.max_playlists:
+            del self._entries[next(iter(self._entries))]
+
+playlist_tracks = PlaylistTrackCache()
+
+class UserPlaylistIndex:
+    """Chỉ mục playlist của một người dùng: id -> (tên, snapshot_id, số bài).
+
+    `seen` và `seen_tracks` là mốc ở lần xem thay đổi gần nhất, dùng để tính
+    "thay đổi từ lần trước" hoàn toàn cục bộ.
+    """
+    __slots__ = ('playlists', 'synced_at', 'seen', 'seen_tracks')
+
+    def __init__(self, playlists: dict, synced_at: int, seen=None, seen_tracks=None):
+        self.playlists = playlists
+        self.synced_at = synced_at
+        self.seen = seen  # playlist_id -> (tên, snapshot_id), None nếu chưa có mốc
+        self.seen_tracks = seen_tracks if seen_tracks is not None else {}  # playlist_id -> track ids
+
+class PlaylistIndex:
+    """Chỉ mục playlist_id -> snapshot_id cho từng người dùng.
+
+    Danh sách playlist được đồng bộ theo TTL; bài hát chỉ được tải lại cho những
+    playlist có snapshot_id khác với bản đã cache.
+    """
+
+    def __init__(self):
+        self._users = {}  # user_id -> UserPlaylistIndex
+
+    def snapshot_state(self) -> dict:
+        return self._users
+
+    def restore_state(self, state: dict) -> None:
+        self._users = state
+
+    def get(self, user_id: str):
+        return self._users.get(user_id)
+
+    def forget(self, user_id: str) -> None:
+        self._users.pop(user_id, None)
+
+    def fresh(self, user_id: str, max_age: float = PLAYLIST_INDEX_TTL):
+        """Chỉ mục của người dùng nếu đã đồng bộ trong max_age giây, ngược lại None."""
+        index = self._users.get(user_id)
+        if index is not None and time.time() - index.synced_at < max_age:
+            return index
+        return None
+
+    async def sync(self, sp: spotipy.Spotify, user_id: str, semaphore: asyncio.Semaphore,
+                   max_age: float = PLAYLIST_INDEX_TTL) -> UserPlaylistIndex:
+        fresh = self.fresh(user_id, max_age)
+        if fresh is not None:
+            return fresh
+        index = self._users.get(user_id)
+
+        playlists = {}
+        async for items in iter_pages(semaphore, sp.current_user_playlists, PLAYLIST_PAGE_SIZE):
+            for item in items:
+                if item:
+                    playlists[item['id']] = (item['name'], item['snapshot_id'], item['tracks']['total'])
+        if index is None:
+            index = UserPlaylistIndex(playlists, int(time.time()))
+            self._users[user_id] = index
+        else:
+            index.playlists = playlists
+            index.synced_at = int(time.time())
+        return index
+
+playlist_index = PlaylistIndex()
+
+
+async def limited_call(semaphore: asyncio.Semaphore, func, *args, **kwargs):
+    async with semaphore:
+        return await sp_call(func, *args, **kwargs)
+
+async def iter_pages(semaphore: asyncio.Semaphore, func, page_size: int, *args, **kwargs):
+    """Lấy mọi trang của một endpoint phân trang: trang đầu cho biết tổng số, các trang
+    còn lại được tải song song (giới hạn bởi semaphore) và trả về ngay khi từng trang xong."""
+    first = await limited_call(semaphore, func, *args, limit=page_size, offset=0, **kwargs)
+    total = first['total']
+    yield first['items']
+    del first
+    tasks = [
+        asyncio.ensure_future(limited_call(semaphore, func, *args, limit=page_size, offset=offset, **kwargs))
+        for offset in range(page_size, total, page_size)
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            page = await task
+            yield page['items']
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def fetch_playlist_track_ids(sp: spotipy.Spotify, semaphore: asyncio.Semaphore,
+                                   playlist_id: str, snapshot_id: str) -> tuple:
+    """Lấy id các bài hát của playlist, dùng cache nếu snapshot_id không đổi."""
+    track_ids = playlist_tracks.get(playlist_id, snapshot_id)
+    if track_ids is not None:
+        return track_ids
+
+    ids = []
+    async for items in iter_pages(semaphore, sp.playlist_items, PLAYLIST_ITEMS_PAGE_SIZE, playlist_id,
+                                  fields=PLAYLIST_ITEM_FIELDS, additional_types=('track',)):
+        for item in items:
+            track = item.get('track')
+            # Bỏ qua tập podcast và bài hát đã bị xóa
+            if track and track.get('type', 'track') == 'track' and (track.get('id') or track.get('uri')):
+                ids.append(catalog.add_track(track).id)
+    track_ids = tuple(ids)
+    playlist_tracks.put(playlist_id, snapshot_id, track_ids)
+    return track_ids
+
+def format_duration(ms: int) -> str:
+    minutes = ms // 60000
+    if minutes >= 60:
+        return f"{minutes // 60} giờ {minutes % 60} phút"
+    return f"{minutes} phút"
+
+def analyze_playlists(names: list, track_lists: list) -> list:
+    """Tạo báo cáo: bài trùng, playlist trùng nhau, tổng thời lượng, nghệ sĩ xuất hiện nhiều nhất."""
+    appearances = {}  # track id -> danh sách vị trí playlist chứa bài
+    total_tracks = 0
+    total_ms = 0
+    artist_counts = Counter()
+    for index, track_ids in enumerate(track_lists):
+        total_tracks += len(track_ids)
+        for track_id in track_ids:
+            appearances.setdefault(track_id, []).append(index)
+            record = catalog.get(track_id)
+            # Bài đã bị đẩy khỏi catalog chỉ được đếm, không tính thời lượng/nghệ sĩ
+            if record is not None:
+                total_ms += record.duration_ms
+                artist_counts.update(record.artist_ids)
+
+    duplicates = []
+    pair_counts = Counter()
+    for track_id, indexes in appearances.items():
+        distinct = sorted(set(indexes))
+        if len(distinct) > 1:
+            duplicates.append((len(distinct), track_id))
+            for a in range(len(distinct)):
+                for b in range(a + 1, len(distinct)):
+                    pair_counts[(distinct[a], distinct[b])] += 1
+    duplicates.sort(reverse=True)
+
+    response = [
+        "*🔬 Phân tích playlist của bạn:*\n",
+        f"📋 *Số playlist:* {len(names)}",
+        f"🎵 *Tổng số bài:* {total_tracks} ({len(appearances)} bài khác nhau)",
+        f"⏱ *Tổng thời lượng:* {format_duration(total_ms)}",
+        f"🔁 *Bài hát có trong nhiều playlist:* {len(duplicates)}",
+    ]
+    shown = [(count, catalog.get(track_id)) for count, track_id in duplicates]
+    shown = [(count, record) for count, record in shown if record is not None][:PLAYLIST_REPORT_LIMIT]
+    for i, (count, record) in enumerate(shown, 1):
+        response.append(f"{format_track_line(i, record, with_stars=False)} ({count} playlist)")
+
+    if pair_counts:
+        response.append("\n🔗 *Các playlist trùng nhau nhiều nhất:*")
+        for i, ((a, b), shared) in enumerate(pair_counts.most_common(PLAYLIST_REPORT_LIMIT), 1):
+            response.append(
+                f"{i}. {escape_markdown(names[a])} ↔ {escape_markdown(names[b])}: {shared} bài chung"
+            )
+
+    if artist_counts:
+        response.append("\n🎤 *Nghệ sĩ xuất hiện nhiều nhất:*")
+        for i, (artist_id, count) in enumerate(artist_counts.most_common(PLAYLIST_REPORT_LIMIT), 1):
+            response.append(f"{i}. {escape_markdown(catalog.artist_name(artist_id))} ({count} bài)")
+    return response
+
+async def playlist_analyze_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Tải toàn bộ bài hát trong mọi playlist của người dùng và phân tích."""
+    sp = await get_user_spotify(update, context)
+    if sp is None:
+        return
+
+    await reply(update, "*⏳ Đang phân tích playlist, vui lòng chờ...*", parse_mode='Markdown')
+    try:
+        semaphore = asyncio.Semaphore(PLAYLIST_FETCH_CONCURRENCY)
+        index = await playlist_index.sync(sp, user_key(update), semaphore)
+        if not index.playlists:
+            await reply(update, "*❗ Bạn chưa có playlist nào.*", parse_mode='Markdown')
+            return
+        track_lists = await asyncio.gather(*(
+            fetch_playlist_track_ids(sp, semaphore, playlist_id, snapshot_id)
+            for playlist_id, (_, snapshot_id, _) in index.playlists.items()
+        ))
+        names = [name for name, _, _ in index.playlists.values()]
+        await reply(update, '\n'.join(analyze_playlists(names, track_lists)), parse_mode='Markdown')
+    except Exception as e:
+        logger.error("Error in playlist_analyze_command: %s", e)
+        await reply(
+            update,
+            spotify_error_text(e, "*❌ Có lỗi xảy ra khi phân tích playlist.*"),
+            parse_mode='Markdown'
+        )
+
+def describe_playlist_changes(index: UserPlaylistIndex, new_tracks: dict) -> list:
+    """So sánh chỉ mục hiện tại với mốc lần trước; new_tracks chứa id bài hát của các playlist đã đổi."""
+    response = ["*🆕 Thay đổi playlist từ lần xem trước:*\n"]
+    added = [pid for pid in index.playlists if pid not in index.seen]
+    removed = [pid for pid in index.seen if pid not in index.playlists]
+    modified = [pid for pid in index.playlists if pid in index.seen and index.seen[pid][1] != index.playlists[pid][1]]
+
+    if not (added or removed or modified):
+        return ["*✅ Không có playlist nào thay đổi từ lần xem trước.*"]
+    for pid in added:
+        name, _, total = index.playlists[pid]
+        response.append(f"➕ *{escape_markdown(name)}* (mới, {total} bài hát)")
+    for pid in removed:
+        response.append(f"➖ *{escape_markdown(index.seen[pid][0])}* (đã xóa hoặc bỏ theo dõi)")
+    for pid in modified:
+        name = index.playlists[pid][0]
+        old_ids = index.seen_tracks.get(pid)
+        if old_ids is None:
+            response.append(f"✏️ *{escape_markdown(name)}* đã thay đổi")
+            continue
+        old_set, new_set = set(old_ids), set(new_tracks[pid])
+        added_ids = [track_id for track_id in new_tracks[pid] if track_id not in old_set]
+        removed_count = sum(1 for track_id in old_ids if track_id not in new_set)
+        response.append(f"✏️ *{escape_markdown(name)}*: +{len(added_ids)} / -{removed_count} bài hát")
+        # Bài đã bị đẩy khỏi catalog thì bỏ qua khi liệt kê
+        records = [record for record in map(catalog.get, added_ids) if record is not None]
+        for record in records[:PLAYLIST_REPORT_LIMIT]:
+            response.append(f"    • {escape_markdown(record.name)}")
+    return response
+
+async def playlist_changes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Hiển thị playlist đã thêm/xóa/thay đổi kể từ lần xem trước; chỉ tải bài hát của playlist đã đổi."""
+    sp = await get_user_spotify(update, context)
+    if sp is None:
+        return
+
+    user_id = user_key(update)
+    try:
+        semaphore = asyncio.Semaphore(PLAYLIST_FETCH_CONCURRENCY)
+        index = await playlist_index.sync(sp, user_id, semaphore, max_age=PLAYLIST_CHANGES_MAX_AGE)
+        if index.seen is None:
+            # Lần đầu: chỉ lưu mốc, dùng danh sách bài hát đã cache nếu có
+            index.seen = {pid: (name, snapshot_id) for pid, (name, snapshot_id, _) in index.playlists.items()}
+            for pid, (_, snapshot_id, _) in index.playlists.items():
+                track_ids = playlist_tracks.get(pid, snapshot_id)
+                if track_ids is not None:
+                    index.seen_tracks[pid] = track_ids
+            await reply(
+                update,
+                f"*📌 Đã lưu mốc cho {len(index.playlists)} playlist.* Lần sau dùng /playlist\\_changes "
+                "để xem những gì đã thay đổi.",
+                parse_mode='Markdown'
+            )
+            return
+
+        changed = [
+            (pid, snapshot_id) for pid, (_, snapshot_id, _) in index.playlists.items()
+            if pid in index.seen and index.seen[pid][1] != snapshot_id
+        ]
+        track_lists = await asyncio.gather(*(
+            fetch_playlist_track_ids(sp, semaphore, pid, snapshot_id) for pid, snapshot_id in changed
+        ))
+        new_tracks = {pid: track_ids for (pid, _), track_ids in zip(changed, track_lists)}
+        response = describe_playlist_changes(index, new_tracks)
+
+        # Cập nhật mốc
+        index.seen = {pid: (name, snapshot_id) for pid, (name, snapshot_id, _) in index.playlists.items()}
+        index.seen_tracks = {pid: ids for pid, ids in index.seen_tracks.items() if pid in index.playlists}
+        index.seen_tracks.update(new_tracks)
+        await reply(update, '\n'.join(response), parse_mode='Markdown')
+    except Exception as e:
+        logger.error("Error in playlist_changes_command: %s", e)
+        await reply(
+            update,
+            spotify_error_text(e, "*❌ Có lỗi xảy ra khi kiểm tra thay đổi playlist.*"),
+            parse_mode='Markdown'
+        )
+
+async def stream_pages(func, page_size: int, *args, **kwargs):
+    """Lấy lần lượt từng trang (tải trước đúng một trang) để bộ nhớ không tăng theo kích thước thư viện."""
+    offset = 0
+    page = await sp_call(func, *args, limit=page_size, offset=offset, **kwargs)
+    while page and page['items']:
+        has_next = page.get('next') is not None
+        offset += page_size
+        upcoming = asyncio.ensure_future(sp_call(func, *args, limit=page_size, offset=offset, **kwargs)) \
+            if has_next else None
+        try:
+            yield page['items']
+        except BaseException:
+            if upcoming is not None:
+                upcoming.cancel()
+            raise
+        page = await upcoming if upcoming is not None else None
+
+def export_row(section: str, playlist: str, track: dict, timestamp: str) -> dict:
+    return {
+        'section': section,
+        'playlist': playlist,
+        'track_id': track.get('id') or track.get('uri', ''),
+        'name': track.get('name', ''),
+        'artists': ', '.join(artist['name'] for artist in track.get('artists', [])),
+        'album': (track.get('album') or {}).get('name', ''),
+        'duration_ms': track.get('duration_ms', 0),
+        'timestamp': timestamp or '',
+    }
+
+async def write_export(sp: spotipy.Spotify, path: str, fmt: str) -> int:
+    """Ghi bài hát đã thích, playlist kèm bài hát và lượt nghe gần đây vào file gzip; trả về số dòng.
+
+    Mỗi trang được ghi xuống ngay rồi bỏ đi, nên bộ nhớ đỉnh không phụ thuộc số bài hát.
+    """
+    rows = 0
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            def write(row):
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+        async for items in stream_pages(sp.current_user_saved_tracks, EXPORT_PAGE_SIZE):
+            for item in items:
+                if item.get('track'):
+                    write(export_row('liked', '', item['track'], item.get('added_at')))
+                    rows += 1
+
+        async for playlists in stream_pages(sp.current_user_playlists, EXPORT_PAGE_SIZE):
+            for playlist in playlists:
+                if not playlist:
+                    continue  # Spotify trả None cho một số playlist đã xóa hoặc không còn truy cập được
+                async for items in stream_pages(sp.playlist_items, EXPORT_PLAYLIST_PAGE_SIZE, playlist['id'],
+                                                fields=EXPORT_ITEM_FIELDS, additional_types=('track',)):
+                    for item in items:
+                        track = item.get('track')
+                        if track and track.get('type', 'track') == 'track':
+                            write(export_row('playlist', playlist['name'], track, item.get('added_at')))
+                            rows += 1
+
+        recent = await sp_call(sp.current_user_recently_played, limit=50)
+        for item in recent['items']:
+            write(export_row('recent', '', item['track'], item.get('played_at')))
+            rows += 1
+    return rows
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Xuất thư viện dưới dạng CSV (mặc định) hoặc JSON lines: `/export csv` hoặc `/export json`."""
+    fmt = (context.args[0].lower() if context.args else 'csv')
+    if fmt not in ('csv', 'json'):
+        await reply(update, "*❗ Định dạng không hợp lệ.* Dùng `/export csv` hoặc `/export json`.", parse_mode='Markdown')
+        return
+
+    sp = await get_user_spotify(update, context)
+    if sp is None:
+        return
+
+    user_id = user_key(update)
+    if user_id in running_exports:
+        await reply(update, "*⏳ Bản xuất trước của bạn vẫn đang được tạo.*", parse_mode='Markdown')
+        return
+
+    running_exports.add(user_id)
+    extension = 'csv' if fmt == 'csv' else 'jsonl'
+    fd, path = tempfile.mkstemp(suffix=f".{extension}.gz")
+    os.close(fd)
+    try:
+        await reply(update, "*⏳ Đang xuất thư viện của bạn, việc này có thể mất vài phút...*", parse_mode='Markdown')
+        rows = await write_export(sp, path, fmt)
+        # Truyền Path để mỗi lần gửi lại (khi bị giới hạn tốc độ) đều đọc file từ đầu
+        await reply_document(
+            update, Path(path),
+            filename=f"spotify_library_{datetime.now():%Y%m%d}.{extension}.gz",
+            caption=f"📦 Thư viện Spotify của bạn: {rows} dòng"
+        )
+    except Exception as e:
+        logger.error("Error in export_command: %s", e)
+        await reply(
+            update,
+            spotify_error_text(e, "*❌ Có lỗi xảy ra khi xuất thư viện.*"),
+            parse_mode='Markdown'
+        )
+    finally:
+        running_exports.discard(user_id)
+        os.remove(path)
+
+class ReleaseWatcher:
+    """Theo dõi bản phát hành mới của các nghệ sĩ mà người dùng đăng ký đang theo dõi.
+
+    Tập nghệ sĩ được gộp cho toàn bộ người dùng (artist_id -> tập người theo dõi), mỗi
+    nghệ sĩ chỉ được poll một lần mỗi chu kỳ bất kể có bao nhiêu người theo dõi, nên chi
+    phí tăng theo số nghệ sĩ khác nhau chứ không theo người dùng × nghệ sĩ. Thông báo
+    được gửi tới từng người theo dõi qua hàng đợi gửi tin nhắn.
+    """
+
+    def __init__(self):
+        self.followers = {}  # artist_id -> set(user_id)
+        self.user_artists = {}  # user_id -> frozenset(artist_id)
+        self.refreshed_at = {}  # user_id -> thời điểm lấy danh sách theo dõi gần nhất
+        self.known = {}  # artist_id -> frozenset(album_id) đã thấy
+        self.failed_at = {}  # user_id -> lần lấy danh sách theo dõi thất bại gần nhất
+        self._artists = deque()  # Vòng poll các nghệ sĩ
+        self._queued = set()  # artist_id đang nằm trong _artists (kể cả mục chờ bị bỏ)
+        self._task = None
+
+    def snapshot_state(self) -> tuple:
+        return self.user_artists, self.refreshed_at, self.known
+
+    def restore_state(self, state: tuple) -> None:
+        user_artists, self.refreshed_at, self.known = state
+        for user_id, artist_ids in user_artists.items():
+            self._set_user_artists(user_id, artist_ids)
+
+    def start(self) -> None:
+        for user_id in sessions.flagged(FLAG_RELEASE_WATCH):
+            self.refreshed_at.setdefault(user_id, 0)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def enable(self, user_id: str) -> None:
+        self.refreshed_at[user_id] = 0  # Lấy danh sách theo dõi ở tick kế tiếp
+
+    def disable(self, user_id: str) -> None:
+        self.refreshed_at.pop(user_id, None)
+        self.failed_at.pop(user_id, None)
+        self._set_user_artists(user_id, frozenset())
+        self.user_artists.pop(user_id, None)
+
+    def _set_user_artists(self, user_id: str, artist_ids: frozenset) -> None:
+        old = self.user_artists.get(user_id, frozenset())
+        for artist_id in old - artist_ids:
+            users = self.followers.get(artist_id)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self.followers[artist_id]
+                    self.known.pop(artist_id, None)
+        for artist_id in artist_ids - old:
+            if artist_id not in self.followers:
+                self.followers[artist_id] = set()
+                # Nghệ sĩ vừa bỏ theo dõi rồi theo dõi lại vẫn còn trong vòng poll, không thêm lần nữa
+                if artist_id not in self._queued:
+                    self._queued.add(artist_id)
+                    self._artists.append(artist_id)
+            self.followers[artist_id].add(user_id)
+        self.user_artists[user_id] = artist_ids
+
+    async def refresh_user(self, user_id: str) -> None:
+        """Cập nhật danh sách nghệ sĩ người dùng đang theo dõi (phân trang bằng con trỏ `after`).
+
+        Chỉ ghi nhận refreshed_at khi lấy xong; lần thất bại được thử lại sau RELEASE_RETRY_INTERVAL.
+        """
+        self.failed_at[user_id] = time.time()
+        token = await background_token(user_id)
+        if token is None:
+            return
+        sp = spotify_client(token)
+        artist_ids = set()
+        after = None
+        while True:
+            await spotify_budget.acquire()
+            result = (await sp_call(sp.current_user_followed_artists, limit=50, after=after))['artists']
+            artist_ids.update(sys.intern(artist['id']) for artist in result['items'])
+            after = (result.get('cursors') or {}).get('after')
+            if not after or not result.get('next'):
+                break
+        if user_id not in self.refreshed_at:
+            return  # Người dùng đã tắt theo dõi trong lúc lấy danh sách
+        self._set_user_artists(user_id, frozenset(artist_ids))
+        self.refreshed_at[user_id] = time.time()
+        self.failed_at.pop(user_id, None)
+
+    async def poll_artist(self, artist_id: str) -> None:
+        albums = []
+        for group in RELEASE_GROUPS:
+            await spotify_budget.acquire()
+            result = await sp_call(app_sp.artist_albums, artist_id, include_groups=group, limit=RELEASE_PAGE_SIZE)
+            albums.extend(album for album in result['items'] if album)
+        album_ids = frozenset(album['id'] for album in albums)
+        known = self.known.get(artist_id)
+        self.known[artist_id] = album_ids
+        if known is None:
+            # Lần poll đầu chỉ ghi nhận, không thông báo các bản phát hành cũ
+            return
+
+        cutoff = (datetime.utcnow() - timedelta(days=RELEASE_MAX_AGE_DAYS)).strftime('%Y-%m-%d')
+        for album in albums:
+            if album['id'] in known or album.get('release_date', '') < cutoff:
+                continue
+            artist_name = escape_markdown(album['artists'][0]['name']) if album.get('artists') else ''
+            text = (
+                f"🆕 *{artist_name}* vừa phát hành {album['album_type']} "
+                f"*{escape_markdown(album['name'])}* ({album['release_date']})\n"
+                f"🔗 [Nghe trên Spotify]({album['external_urls']['spotify']})"
+            )
+            for user_id in self.followers.get(artist_id, ()):
+                tenant_of(user_id).outbound.notify(
+                    telegram_id(user_id), text, parse_mode='Markdown', disable_web_page_preview=True
+                ).add_done_callback(_log_notice_error)
+
+    async def _safe(self, coro) -> None:
+        try:
+            await coro
+        except Exception as e:
+            logger.error("Error in release watcher: %s", e)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(RELEASE_TICK_SECONDS)
+            now = time.time()
+            stale = [user_id for user_id, refreshed in self.refreshed_at.items()
+                     if now - refreshed >= RELEASE_FOLLOW_REFRESH
+                     and now - self.failed_at.get(user_id, 0) >= RELEASE_RETRY_INTERVAL][:RELEASE_USERS_PER_TICK]
+            # Chia đều các nghệ sĩ trên cả chu kỳ poll
+            batch_size = min(len(self._artists),
+                             max(1, math.ceil(len(self._artists) * RELEASE_TICK_SECONDS / RELEASE_POLL_INTERVAL)))
+            batch = []
+            for _ in range(batch_size):
+                artist_id = self._artists.popleft()
+                if artist_id in self.followers:
+                    batch.append(artist_id)
+                    self._artists.append(artist_id)
+                else:
+                    self._queued.discard(artist_id)
+            await asyncio.gather(
+                *(self._safe(self.refresh_user(user_id)) for user_id in stale),
+                *(self._safe(self.poll_artist(artist_id)) for artist_id in batch)
+            )
+
+release_watcher = ReleaseWatcher()
+
+async def release_watch_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Bật/tắt thông báo bản phát hành mới của các nghệ sĩ đang theo dõi."""
+    user_id = user_key(update)
+    session = get_session(user_id)
+    if not session.token:
+        await reply(
+            update,
+            "*Bạn chưa đăng nhập. Vui lòng sử dụng /start để bắt đầu quá trình xác thực.*",
+            parse_mode='Markdown'
+        )
+        return
+
+    if session.has_flag(FLAG_RELEASE_WATCH):
+        session.flags &= ~FLAG_RELEASE_WATCH
+        release_watcher.disable(user_id)
+        await reply(update, "*🔕 Đã tắt thông báo bản phát hành mới.*", parse_mode='Markdown')
+    else:
+        session.flags |= FLAG_RELEASE_WATCH
+        release_watcher.enable(user_id)
+        await reply(
+            update,
+            "*🔔 Đã bật thông báo bản phát hành mới* của các nghệ sĩ bạn đang theo dõi trên Spotify.",
+            parse_mode='Markdown'
+        )
+
+def render_digest(payload: dict) -> tuple:
+    """Tạo nội dung bản tin tuần (Markdown cho Telegram, văn bản thường cho email); chạy trong process pool."""
+    top = payload['top']
+    new = payload['new']
+    lines = [f"*📬 Bản tin âm nhạc tuần {payload['week']}*\n"]
+    plain = [f"Xin chào {payload['name']},", "", f"Bản tin âm nhạc tuần {payload['week']} của bạn:", ""]
+
+    lines.append(f"⏱ Thời gian nghe: *~{payload['minutes']} phút* ({payload['plays']} lượt nghe gần nhất)")
+    plain.append(f"Thời gian nghe: ~{payload['minutes']} phút ({payload['plays']} lượt nghe gần nhất)")
+
+    if top:
+        lines.append("\n*🏆 Top bài hát tuần này:*")
+        plain.extend(["", "Top bài hát tuần này:"])
+        for i, (name, artist) in enumerate(top, 1):
+            lines.append(f"{i}. *{escape_markdown(name)}* - {escape_markdown(artist)}")
+            plain.append(f"{i}. {name} - {artist}")
+    if new:
+        lines.append("\n*💚 Yêu thích mới:*")
+        plain.extend(["", "Yêu thích mới:"])
+        for name, artist in new:
+            lines.append(f"• *{escape_markdown(name)}* - {escape_markdown(artist)}")
+            plain.append(f"- {name} - {artist}")
+
+    lines.append("\n_Dùng /digest để tắt bản tin tuần._")
+    plain.extend(["", "Trân trọng,", "Spotify Bot"])
+    return '\n'.join(lines), '\n'.join(plain)
+
+class WeeklyDigest:
+    """Job tạo bản tin tuần cho mọi người dùng đã đăng ký, chạy vào giờ thấp điểm.
+
+    Lời gọi Spotify được rải đều trong khung giờ và luôn đi qua spotify_budget; nội dung
+    được tạo trong process pool. Mỗi người dùng xong được ghi thêm một dòng vào file
+    checkpoint (JSON lines) nên khi bot khởi động lại giữa chừng, job chạy tiếp phần còn
+    lại thay vì làm lại từ đầu. Người dùng bị lỗi được thử lại ở các lần kiểm tra sau
+    (tối đa DIGEST_MAX_ATTEMPTS lần); job chỉ được đánh dấu xong khi không còn ai cần thử lại.
+    """
+
+    def __init__(self, path: str = DIGEST_CHECKPOINT_PATH):
+        self.path = path
+        self._task = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def load_checkpoint(self) -> dict:
+        """Đọc checkpoint: {'week', 'started_at', 'done': {user_id: số lời gọi},
+        'attempts': {user_id: số lần thất bại}, 'finished'}."""
+        state = {'week': None, 'started_at': None, 'done': {}, 'attempts': Counter(), 'finished': False}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # Dòng cuối bị ghi dở khi bot dừng đột ngột
+                    if 'week' in entry:
+                        state.update(week=entry['week'], started_at=entry['started_at'])
+                    elif 'user_id' in entry:
+                        state['done'][entry['user_id']] = entry['calls']
+                    elif 'failed_user' in entry:
+                        state['attempts'][entry['failed_user']] += 1
+                    elif entry.get('finished'):
+                        state['finished'] = True
+        except FileNotFoundError:
+            pass
+        return state
+
+    def _append(self, entry: dict) -> None:
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def due_week(self, now: datetime, state: dict):
+        """Tuần cần chạy (dạng 2024-W08) hoặc None. Job dở dang luôn được chạy tiếp ngay."""
+        week = now.strftime('%G-W%V')
+        if state['week'] == week:
+            return None if state['finished'] else week
+        if now.weekday() == DIGEST_WEEKDAY and DIGEST_START_HOUR <= now.hour < DIGEST_START_HOUR + DIGEST_WINDOW_HOURS:
+            return week
+        return None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                state = self.load_checkpoint()
+                week = self.due_week(datetime.now(), state)
+                if week is not None:
+                    await self.run(week, state)
+            except Exception as e:
+                logger.error("Error in weekly digest job: %s", e)
+            await asyncio.sleep(DIGEST_CHECK_INTERVAL)
+
+    async def run(self, week: str, state: dict) -> None:
+        if state['week'] != week:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            state = {'week': week, 'started_at': time.time(), 'done': {}, 'attempts': Counter(), 'finished': False}
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'week': week, 'started_at': state['started_at']}) + '\n')
+
+        done = state['done']
+        attempts = state['attempts']
+        pending = [user_id for user_id in sessions.flagged(FLAG_WEEKLY_DIGEST)
+                   if user_id not in done and attempts[user_id] < DIGEST_MAX_ATTEMPTS]
+        if done:
+            logger.info("Resuming weekly digest %s: %s done, %s remaining", week, len(done), len(pending))
+
+        # Rải người dùng đều trên phần còn lại của khung giờ; quá khung giờ thì chỉ còn giới hạn của spotify_budget
+        now = datetime.now()
+        spacing = 0.0
+        if now.weekday() == DIGEST_WEEKDAY:
+            window_end = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(
+                hours=DIGEST_START_HOUR + DIGEST_WINDOW_HOURS)
+            spacing = max(0.0, (window_end - now).total_seconds()) / max(len(pending), 1)
+
+        failed = {}  # user_id -> số lời gọi đã dùng trong lần chạy này
+        pool = ProcessPoolExecutor(max_workers=DIGEST_RENDER_WORKERS)
+        try:
+            for i, user_id in enumerate(pending):
+                started = time.monotonic()
+                calls, ok = await self.process_user(pool, user_id, week)
+                if ok:
+                    done[user_id] = calls
+                    self._append({'user_id': user_id, 'calls': calls})
+                else:
+                    failed[user_id] = calls
+                    attempts[user_id] += 1
+                    self._append({'failed_user': user_id, 'calls': calls})
+                if i + 1 < len(pending):
+                    await asyncio.sleep(max(0.0, spacing - (time.monotonic() - started)))
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        retry = [user_id for user_id in failed if attempts[user_id] < DIGEST_MAX_ATTEMPTS]
+        if retry:
+            # Chưa ghi 'finished': lần kiểm tra sau sẽ chạy tiếp với những người dùng này
+            logger.info("Weekly digest %s: %s users failed, retrying in %ss", week, len(retry), DIGEST_CHECK_INTERVAL)
+            return
+        self._append({'finished': True})
+        runtime = time.time() - state['started_at']
+        total_calls = sum(done.values()) + sum(failed.values())
+        logger.info(
+            "Weekly digest %s finished: %s users, %s failed, runtime %.0fs, %s Spotify calls (%.1f/user, max %s)",
+            week, len(done), len(failed), runtime, total_calls, total_calls / max(len(done) + len(failed), 1),
+            max([*done.values(), *failed.values()], default=0)
+        )
+
+    async def process_user(self, pool: ProcessPoolExecutor, user_id: str, week: str) -> tuple:
+        """Lấy dữ liệu, tạo và gửi bản tin cho một người dùng.
+
+        Trả về (số lời gọi Spotify đã dùng, thành công hay không). Người dùng đã đăng xuất
+        được coi là xong vì không có gì để gửi.
+        """
+        calls = 0
+
+        async def call(func, *args, **kwargs):
+            nonlocal calls
+            await spotify_budget.acquire()
+            calls += 1
+            return await sp_call(func, *args, **kwargs)
+
+        try:
+            session = sessions.peek(user_id)
+            if session is None or not session.token:
+                return calls, True
+            if token_expired(session):
+                # Làm mới trên phiên đọc bằng peek, không nạp phiên vào bộ nhớ
+                if not session.refresh_token:
+                    return calls, False
+                await spotify_budget.acquire()
+                calls += 1
+                if not await refresh_token(user_id, session):
+                    return calls, False
+            sp = spotify_client(session.token)
+
+            top = await call(sp.current_user_top_tracks, limit=DIGEST_TOP_LIMIT, time_range='short_term')
+            saved = await call(sp.current_user_saved_tracks, limit=50)
+            recent = await call(sp.current_user_recently_played, limit=50)
+
+            week_ago = (datetime.utcnow() - timedelta(days=7)).strftime('%Y-%m-%dT%H:%M:%S')
+            plays = [item for item in recent['items'] if item['played_at'] >= week_ago]
+            payload = {
+                'week': week,
+                'name': str(user_id),
+                'top': [(record.name, ', '.join(catalog.artist_names(record)))
+                        for record in catalog.add_tracks(top['items'])],
+                'new': [(record.name, ', '.join(catalog.artist_names(record)))
+                        for record in catalog.add_tracks(
+                            item['track'] for item in saved['items'] if item['added_at'] >= week_ago
+                        )][:DIGEST_NEW_LIMIT],
+                'minutes': sum(item['track']['duration_ms'] for item in plays) // 60000,
+                'plays': len(plays),
+            }
+
+            email = None
+            if session.has_flag(FLAG_DIGEST_EMAIL) and EMAIL_HOST_USER:
+                profile = await call(sp.current_user)
+                email = profile.get('email')
+                payload['name'] = profile.get('display_name') or payload['name']
+
+            loop = asyncio.get_running_loop()
+            text, plain = await loop.run_in_executor(pool, render_digest, payload)
+            tenant_of(user_id).outbound.submit(
+                telegram_id(user_id), 'send_message', PRIORITY_NOTIFICATION,
+                text=text, parse_mode='Markdown', disable_web_page_preview=True
+            ).add_done_callback(_log_notice_error)
+            if email:
+                await send_email_notification(email, f"Spotify Bot - Bản tin tuần {week}", plain)
+        except Exception as e:
+            logger.error("Error building weekly digest for %s: %s", user_id, e)
+            return calls, False
+        return calls, True
+
+weekly_digest = WeeklyDigest()
+
+async def digest_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Bật/tắt bản tin tuần; `/digest email` bật/tắt gửi thêm qua email."""
+    user_id = user_key(update)
+    session = get_session(user_id)
+    if not session.token:
+        await reply(
+            update,
+            "*Bạn chưa đăng nhập. Vui lòng sử dụng /start để bắt đầu quá trình xác thực.*",
+            parse_mode='Markdown'
+        )
+        return
+
+    if context.args and context.args[0].lower() == 'email':
+        if session.has_flag(FLAG_DIGEST_EMAIL):
+            session.flags &= ~FLAG_DIGEST_EMAIL
+            await reply(update, "*📭 Bản tin tuần sẽ không gửi qua email nữa.*", parse_mode='Markdown')
+        else:
+            session.flags |= FLAG_WEEKLY_DIGEST | FLAG_DIGEST_EMAIL
+            await reply(
+                update,
+                "*📧 Bản tin tuần sẽ được gửi qua Telegram và email* của tài khoản Spotify.",
+                parse_mode='Markdown'
+            )
+        return
+
+    if session.has_flag(FLAG_WEEKLY_DIGEST):
+        session.flags &= ~(FLAG_WEEKLY_DIGEST | FLAG_DIGEST_EMAIL)
+        await reply(update, "*🔕 Đã tắt bản tin tuần.*", parse_mode='Markdown')
+    else:
+        session.flags |= FLAG_WEEKLY_DIGEST
+        await reply(
+            update,
+            "*📬 Đã bật bản tin tuần:* top bài hát, bài yêu thích mới và thời gian nghe, gửi vào sáng thứ Hai.\n"
+            "Dùng `/digest email` để nhận thêm qua email.",
+            parse_mode='Markdown'
+        )
+
+class GroupBoard:
+    """Bảng xếp hạng cho nhóm chat, tính hoàn toàn từ top list đã cache của từng thành viên.
+
+    Top list của thành viên được làm mới trong nền (theo ngân sách gọi Spotify), nên
+    /group_top chỉ tổng hợp dữ liệu trong bộ nhớ.
+    """
+
+    def __init__(self):
+        self.members = {}  # chat_id -> {user_id: tên hiển thị}
+        self.failed_at = {}  # user_id -> thời điểm làm mới thất bại gần nhất
+        self._task = None
+
+    def snapshot_state(self) -> dict:
+        return self.members
+
+    def restore_state(self, state: dict) -> None:
+        self.members = state
+
+    def join(self, chat_id: int, user_id: str, name: str) -> bool:
+        members = self.members.setdefault(chat_id, {})
+        is_new = user_id not in members
+        members[user_id] = name
+        return is_new
+
+    def leave(self, chat_id: int, user_id: str) -> bool:
+        members = self.members.get(chat_id, {})
+        removed = members.pop(user_id, None) is not None
+        if not members:
+            self.members.pop(chat_id, None)
+        return removed
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def refresh_member(self, user_id: str) -> None:
+        """Lấy top list còn thiếu của thành viên; token hết hạn được làm mới trước khi gọi.
+
+        Thành viên không làm mới được token (hoặc gọi lỗi) bị bỏ qua trong GROUP_RETRY_INTERVAL.
+        """
+        self.failed_at[user_id] = time.time()
+        token = await background_token(user_id)
+        if token is None:
+            return
+        sp = spotify_client(token)
+        for kind in ('artists', 'tracks'):
+            if top_lists.peek(user_id, kind, GROUP_TIME_RANGE) is None:
+                await spotify_budget.acquire()
+                await top_lists.get(sp, user_id, kind, GROUP_TIME_RANGE)
+        self.failed_at.pop(user_id, None)
+
+    async def _run(self) -> None:
+        while True:
+            now = time.time()
+            user_ids = {user_id for members in self.members.values() for user_id in members}
+            self.failed_at = {user_id: at for user_id, at in self.failed_at.items() if user_id in user_ids}
+            stale = [
+                user_id for user_id in user_ids
+                if now - self.failed_at.get(user_id, 0) >= GROUP_RETRY_INTERVAL
+                and (top_lists.peek(user_id, 'artists', GROUP_TIME_RANGE) is None
+                     or top_lists.peek(user_id, 'tracks', GROUP_TIME_RANGE) is None)
+            ][:GROUP_REFRESH_PER_TICK]
+            for user_id in stale:
+                try:
+                    await self.refresh_member(user_id)
+                except Exception as e:
+                    logger.error("Error refreshing group member %s: %s", user_id, e)
+            await asyncio.sleep(GROUP_REFRESH_TICK)
+
+def rank_vector(ids: tuple) -> dict:
+    """Vector thưa: id -> trọng số giảm dần theo thứ hạng, đã chuẩn hóa độ dài 1."""
+    weights = {item_id: TOP_FETCH_LIMIT - rank for rank, item_id in enumerate(ids)}
+    norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+    return {item_id: weight / norm for item_id, weight in weights.items()} if norm else {}
+
+def pairwise_similarity(vectors: dict) -> list:
+    """Độ tương đồng cosine cho mọi cặp thành viên.
+
+    Dùng chỉ mục đảo (nghệ sĩ -> thành viên) nên chỉ các cặp có nghệ sĩ chung mới được
+    cộng dồn, thay vì nhân từng cặp vector.
+    """
+    postings = {}
+    for user_id, vector in vectors.items():
+        for item_id, weight in vector.items():
+            postings.setdefault(item_id, []).append((user_id, weight))
+    scores = Counter()
+    for entries in postings.values():
+        for a in range(len(entries)):
+            user_a, weight_a = entries[a]
+            for b in range(a + 1, len(entries)):
+                user_b, weight_b = entries[b]
+                pair = (user_a, user_b) if user_a < user_b else (user_b, user_a)
+                scores[pair] += weight_a * weight_b
+    return scores.most_common()
+
+def build_group_board(members: dict) -> list:
+    artist_scores = Counter()
+    track_scores = Counter()
+    vectors = {}
+    missing = []
+    for user_id, name in members.items():
+        artists = top_lists.latest(user_id, 'artists', GROUP_TIME_RANGE)
+        tracks = top_lists.latest(user_id, 'tracks', GROUP_TIME_RANGE)
+        if artists is None or tracks is None:
+            missing.append(name)
+            continue
+        for rank, artist_id in enumerate(artists):
+            artist_scores[artist_id] += TOP_FETCH_LIMIT - rank
+        for rank, track_id in enumerate(tracks):
+            track_scores[track_id] += TOP_FETCH_LIMIT - rank
+        vectors[user_id] = rank_vector(artists)
+
+    response = [f"*👥 Bảng xếp hạng nhóm ({len(vectors)} thành viên):*"]
+    if artist_scores:
+        response.append("\n🌟 *Top nghệ sĩ:*")
+        for i, (artist_id, _) in enumerate(artist_scores.most_common(GROUP_BOARD_LIMIT), 1):
+            response.append(f"{i}. {escape_markdown(catalog.artist_name(artist_id))}")
+    if track_scores:
+        response.append("\n🏆 *Top bài hát:*")
+        for i, (track_id, _) in enumerate(track_scores.most_common(GROUP_BOARD_LIMIT), 1):
+            record = catalog.get(track_id)
+            if record is not None:
+                response.append(format_track_line(i, record, with_stars=False))
+
+    pairs = pairwise_similarity(vectors)
+    if pairs:
+        response.append("\n🤝 *Độ hợp gu âm nhạc:*")
+        for (user_a, user_b), score in pairs[:GROUP_PAIR_LIMIT]:
+            response.append(
+                f"• {escape_markdown(members[user_a])} & {escape_markdown(members[user_b])}: {round(score * 100)}%"
+            )
+    if missing:
+        response.append(f"\n⏳ _Đang cập nhật dữ liệu của: {escape_markdown(', '.join(missing))}_")
+    return response
+
+group_board = GroupBoard()
+
+async def group_join_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Tham gia bảng xếp hạng của nhóm hiện tại."""
+    if update.effective_chat.type == 'private':
+        await reply(update, "*❗ Lệnh này chỉ dùng trong nhóm chat.*", parse_mode='Markdown')
+        return
+    user_id = user_key(update)
+    if not get_session(user_id).token:
+        await reply(
+            update,
+            "*❗ Bạn cần liên kết Spotify trước: nhắn /start cho bot trong chat riêng.*",
+            parse_mode='Markdown'
+        )
+        return
+    group_board.join(chat_key(update), user_id, update.effective_user.first_name)
+    await reply(
+        update,
+        f"*✅ {escape_markdown(update.effective_user.first_name)} đã tham gia bảng xếp hạng nhóm.*",
+        parse_mode='Markdown'
+    )
+
+async def group_leave_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if group_board.leave(chat_key(update), user_key(update)):
+        await reply(update, "*👋 Đã rời bảng xếp hạng nhóm.*", parse_mode='Markdown')
+    else:
+        await reply(update, "*❗ Bạn chưa tham gia bảng xếp hạng nhóm.*", parse_mode='Markdown')
+
+async def group_top_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Hiển thị bảng xếp hạng nhóm; người gọi đã liên kết Spotify được tự động thêm vào nhóm."""
+    if update.effective_chat.type == 'private':
+        await reply(update, "*❗ Lệnh này chỉ dùng trong nhóm chat.*", parse_mode='Markdown')
+        return
+    chat_id = chat_key(update)
+    user_id = user_key(update)
+    if get_session(user_id).token and group_board.join(chat_id, user_id, update.effective_user.first_name):
+        # Thành viên mới: lấy ngay dữ liệu của họ thay vì chờ vòng làm mới
+        try:
+            await group_board.refresh_member(user_id)
+        except Exception as e:
+            logger.error("Error refreshing group member %s: %s", user_id, e)
+
+    members = group_board.members.get(chat_id)
+    if not members:
+        await reply(
+            update,
+            "*❗ Chưa có thành viên nào tham gia.* Dùng /group\\_join sau khi đã liên kết Spotify với bot.",
+            parse_mode='Markdown'
+        )
+        return
+    await reply(update, '\n'.join(build_group_board(members)), parse_mode='Markdown')
+
+class DiscoveryIndex:
+    """Chỉ mục đồng xuất hiện item-item từ thư viện (top tracks + bài đã thích) của người dùng bot.
+
+    Ma trận thưa được lưu dạng dict lồng nhau: track -> {track: số người dùng có cả hai}.
+    Khi thư viện của một người dùng thay đổi, chỉ các cặp của người đó được trừ đi và
+    cộng lại; các cập nhật được gom lại và áp dụng trong nền.
+    """
+
+    def __init__(self, items_per_user: int = DISCOVER_ITEMS_PER_USER):
+        self.items_per_user = items_per_user
+        self.cooccurrence = {}  # track_id -> {track_id: count}
+        self.frequency = Counter()  # track_id -> số người dùng có bài này
+        self.libraries = {}  # user_id -> tuple(track_id)
+        self._sources = {}  # user_id -> {nguồn: tuple(track_id)}
+        self._pending = {}  # user_id -> thư viện mới chờ áp dụng
+        self._task = None
+
+    def snapshot_state(self) -> tuple:
+        return self.cooccurrence, self.frequency, self.libraries, self._sources, self._pending
+
+    def restore_state(self, state: tuple) -> None:
+        self.cooccurrence, self.frequency, self.libraries, self._sources, self._pending = state
+
+    def submit(self, user_id: str, source: str, track_ids) -> None:
+        """Ghi nhận danh sách bài hát của người dùng từ một nguồn (top, liked...)."""
+        sources = self._sources.setdefault(user_id, {})
+        sources[source] = tuple(track_ids)
+        merged = tuple(dict.fromkeys(track_id for ids in sources.values() for track_id in ids))
+        library = merged[:self.items_per_user]
+        if library != self.libraries.get(user_id):
+            self._pending[user_id] = library
+
+    def _bump(self, a: str, b: str, delta: int) -> None:
+        row = self.cooccurrence.setdefault(a, {})
+        count = row.get(b, 0) + delta
+        if count > 0:
+            row[b] = count
+        else:
+            row.pop(b, None)
+
+    def _update_pairs(self, library: tuple, delta: int) -> None:
+        """Cộng (delta=1) hoặc trừ (delta=-1) mọi cặp bài hát trong một thư viện."""
+        for i, a in enumerate(library):
+            self.frequency[a] += delta
+            for b in library[i + 1:]:
+                self._bump(a, b, delta)
+                self._bump(b, a, delta)
+        for a in library:
+            if self.frequency[a] <= 0:
+                del self.frequency[a]
+                self.cooccurrence.pop(a, None)
+
+    def knows(self, user_id: str) -> bool:
+        return user_id in self.libraries or user_id in self._pending
+
+    def forget(self, user_id: str) -> None:
+        """Xóa dữ liệu của người dùng khỏi chỉ mục (khi đăng xuất)."""
+        self._sources.pop(user_id, None)
+        self._pending.pop(user_id, None)
+        old = self.libraries.pop(user_id, None)
+        if old:
+            self._update_pairs(old, -1)
+
+    def apply(self, user_id: str) -> None:
+        library = self._pending.pop(user_id, None)
+        if library is None:
+            return
+        old = self.libraries.get(user_id)
+        if old:
+            self._update_pairs(old, -1)
+        self._update_pairs(library, 1)
+        self.libraries[user_id] = library
+
+    async def apply_pending(self) -> int:
+        """Áp dụng các thư viện đang chờ, nhường event loop sau mỗi người dùng.
+
+        Một người dùng tối đa khoảng 2 * C(items_per_user, 2) lần cập nhật cặp (vài ms), nên
+        event loop không bị chặn lâu hơn thế; mỗi người dùng vẫn được áp dụng trọn vẹn một lần.
+        """
+        applied = 0
+        for user_id in list(self._pending):
+            self.apply(user_id)
+            applied += 1
+            await asyncio.sleep(0)
+        return applied
+
+    def recommend(self, user_id: str, limit: int) -> list:
+        """Gợi ý bài hát theo độ tương đồng cosine giữa các bài trong thư viện người dùng."""
+        self.apply(user_id)
+        library = self.libraries.get(user_id, ())
+        owned = set(library)
+        scores = Counter()
+        for a in library:
+            freq_a = self.frequency.get(a, 1)
+            for b, count in self.cooccurrence.get(a, {}).items():
+                if b not in owned:
+                    scores[b] += count / math.sqrt(freq_a * self.frequency[b])
+        return [track_id for track_id, _ in scores.most_common(limit)]
 
-• Sử dụng các nút trên bàn phím tùy chỉnh để chọn chức năng
-• Số lượng hiển thị hiện tại: *{amount}* mục
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
 
-*Các lệnh cơ bản:*
-• `/start` - Bắt đầu bot và xác thực với Spotify
-• `/menu` - Hiển thị menu chính
-• `/set_token` - Nhập token sau khi xác thực Spotify
-• `/logout` - Đăng xuất khỏi tài khoản Spotify
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
 
-*Cài đặt tùy chỉnh:*
-• `/set_amount <số>` - Điều chỉnh số lượng hiển thị (1-{MAX_AMOUNT})
-• `/settings` - Xem cài đặt hiện tại
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(DISCOVER_APPLY_INTERVAL)
+            try:
+                await self.apply_pending()
+            except Exception as e:
+                logger.error("Error updating discovery index: %s", e)
 
-*Lưu ý:*
-• Số lượng tối đa có thể hiển thị là {MAX_AMOUNT} mục
-• Nếu gặp lỗi, hãy thử đăng xuất và đăng nhập lại
-"""
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+discovery = DiscoveryIndex()
 
-async def get_top_tracks(update: Update, sp: spotipy.Spotify) -> None:
-    user_id = str(update.effective_user.id)
+async def get_discover(update: Update, sp: spotipy.Spotify) -> None:
+    """Gợi ý bài hát dựa trên những gì người dùng khác có gu tương tự đang nghe."""
+    user_id = user_key(update)
     amount = get_user_amount(user_id)
-    
-    try:
-        top_tracks = sp.current_user_top_tracks(limit=amount, time_range='short_term')
-        response = [f"*🏆 Top {amount} bài hát của bạn trong thời gian gần đây:*\n"]
-        
-        if not top_tracks['items']:
-            response = ["*❗ Không có dữ liệu về top bài hát.*"]
-        else:
-            for i, track in enumerate(top_tracks['items'], 1):
-                track_name = escape_markdown(track['name'])
-                artist_name = escape_markdown(track['artists'][0]['name'])
-                popularity = track['popularity']
-                stars = '⭐' * ((popularity + 19) // 20)  # Convert popularity to 1-5 stars
-                response.append(f"{i}. *{track_name}* - {artist_name} {stars}")
-        
-        await update.message.reply_text('\n'.join(response), parse_mode='Markdown')
-    except Exception as e:
-        logger.error(f"Error in get_top_tracks: {e}")
-        await update.message.reply_text(
-            "*❌ Có lỗi xảy ra khi lấy danh sách top bài hát.*",
-            parse_mode='Markdown'
-        )
 
-async def get_playlists(update: Update, sp: spotipy.Spotify) -> None:
-    user_id = str(update.effective_user.id)
-    amount = get_user_amount(user_id)
-    
     try:
-        playlists = sp.current_user_playlists(limit=amount)
-        response = [f"*📋 {amount} playlist gần đây của bạn:*\n"]
-        
-        if not playlists['items']:
-            response = ["*❗ Bạn chưa có playlist nào.*"]
+        if not discovery.knows(user_id):
+            # Chưa có dữ liệu của người dùng: lấy top tracks và bài đã thích ngay
+            await top_lists.get(sp, user_id, 'tracks', 'medium_term')
+            liked = await sp_call(sp.current_user_saved_tracks, limit=50)
+            discovery.submit(user_id, 'liked', [record.id for record in catalog.add_tracks(
+                item['track'] for item in liked['items'])])
+
+        track_ids = [track_id for track_id in discovery.recommend(user_id, amount * 2) if catalog.get(track_id)]
+        if not track_ids:
+            response = ["*❗ Chưa đủ dữ liệu để gợi ý. Hãy thử lại sau khi có thêm người dùng.*"]
         else:
-            for i, playlist in enumerate(playlists['items'], 1):
-                playlist_name = escape_markdown(playlist['name'])
-                tracks_count = playlist['tracks']['total']
-                response.append(f"{i}. *{playlist_name}* ({tracks_count} bài hát)")
-        
-        await update.message.reply_text('\n'.join(response), parse_mode='Markdown')
+            response = [f"*🧭 {min(amount, len(track_ids))} bài hát gợi ý cho bạn:*\n"]
+            for i, track_id in enumerate(track_ids[:amount], 1):
+                record = catalog.get(track_id)
+                response.append(f"{format_track_line(i, record, with_stars=False)} - [Nghe]({record.url})")
+
+        await reply(update, '\n'.join(response), parse_mode='Markdown', disable_web_page_preview=True)
     except Exception as e:
-        logger.error(f"Error in get_playlists: {e}")
-        await update.message.reply_text(
-            "*❌ Có lỗi xảy ra khi lấy danh sách playlist.*",
+        logger.error("Error in get_discover: %s", e)
+        await reply(
+            update,
+            spotify_error_text(e, "*❌ Có lỗi xảy ra khi tạo gợi ý.*"),
             parse_mode='Markdown'
         )
 
-async def get_liked_songs(update: Update, sp: spotipy.Spotify) -> None:
-    user_id = str(update.effective_user.id)
-    amount = get_user_amount(user_id)
+async def discover_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    sp = await get_user_spotify(update, context)
+    if sp is not None:
+        await get_discover(update, sp)
+
+async def get_liked_songs(update: Update, sp: spotipy.Spotify, amount: int = None, cached: bool = False) -> None:
+    user_id = user_key(update)
+    amount = amount or get_user_amount(user_id)
     
     try:
-        liked_songs = sp.current_user_saved_tracks(limit=amount)
+        liked_songs = (view_cache.get(user_id, 'liked') if cached else None) or prefetcher.take(user_id, 'liked') \
+            or await sp_call(sp.current_user_saved_tracks, limit=VIEW_FETCH_LIMIT)
+        view_cache.put(user_id, 'liked', liked_songs)
+        # Gửi toàn bộ bài đã tải cho gợi ý và tìm kiếm, chỉ cắt theo amount khi hiển thị
+        fetched = catalog.add_tracks(item['track'] for item in liked_songs['items'])
+        discovery.submit(user_id, 'liked', [record.id for record in fetched])
+        library_search.add(user_id, fetched)
+        records = fetched[:amount]
         response = [f"*❤️ {amount} bài hát yêu thích gần đây của bạn:*\n"]
         
-        if not liked_songs['items']:
+        if not records:
             response = ["*❗ Bạn chưa có bài hát yêu thích nào.*"]
         else:
-            for i, item in enumerate(liked_songs['items'], 1):
-                track = item['track']
-                track_name = escape_markdown(track['name'])
-                artist_name = escape_markdown(track['artists'][0]['name'])
+            for i, record in enumerate(records, 1):
                 # Thêm thông tin thêm như độ phổ biến
-                popularity = track['popularity']
-                stars = '⭐' * ((popularity + 19) // 20)  # Convert popularity to 1-5 stars
-                response.append(f"{i}. *{track_name}* - {artist_name} {stars}")
+                response.append(format_track_line(i, record))
+            summary = await mood_summary(record.id for record in records)
+            if summary:
+                response.append(summary)
         
-        await update.message.reply_text('\n'.join(response), parse_mode='Markdown')
+        await reply(update, '\n'.join(response), parse_mode='Markdown', reply_markup=view_keyboard('liked', amount))
     except Exception as e:
-        logger.error(f"Error in get_liked_songs: {e}")
-        await update.message.reply_text(
-            "*❌ Có lỗi xảy ra khi lấy danh sách bài hát yêu thích.*",
+        logger.error("Error in get_liked_songs: %s", e)
+        await reply(
+            update,
+            spotify_error_text(e, "*❌ Có lỗi xảy ra khi lấy danh sách bài hát yêu thích.*"),
             parse_mode='Markdown'
         )
 
-async def get_recent_activity(update: Update, sp: spotipy.Spotify) -> None:
-    user_id = str(update.effective_user.id)
-    amount = get_user_amount(user_id)
+async def get_recent_activity(update: Update, sp: spotipy.Spotify, amount: int = None,
+                              cached: bool = False) -> None:
+    user_id = user_key(update)
+    amount = amount or get_user_amount(user_id)
     
     try:
-        recently_played = sp.current_user_recently_played(limit=amount)
+        recently_played = (view_cache.get(user_id, 'recent') if cached else None) or \
+            prefetcher.take(user_id, 'recent') or \
+            await sp_call(sp.current_user_recently_played, limit=VIEW_FETCH_LIMIT)
+        view_cache.put(user_id, 'recent', recently_played)
+        plays = [(catalog.add_track(item['track']), item['played_at']) for item in recently_played['items'][:amount]]
         response = [f"*🔄 {amount} hoạt động gần đây:*\n"]
         
-        if not recently_played['items']:
+        if not plays:
             response = ["*❗ Không có hoạt động nghe nhạc gần đây.*"]
         else:
-            for i, item in enumerate(recently_played['items'], 1):
-                track = item['track']
-                track_name = escape_markdown(track['name'])
-                artist_name = escape_markdown(track['artists'][0]['name'])
-                
+            for i, (record, played_at) in enumerate(plays, 1):
                 # Tính thời gian
-                played_at = datetime.strptime(item['played_at'], "%Y-%m-%dT%H:%M:%S.%fZ")
+                played_at = datetime.strptime(played_at, "%Y-%m-%dT%H:%M:%S.%fZ")
                 time_diff = datetime.utcnow() - played_at
                 
                 if time_diff.days > 0:
@@ -400,42 +3796,354 @@ async def get_recent_activity(update: Update, sp: spotipy.Spotify) -> None:
                 else:
                     time_str = f"{time_diff.seconds // 60} phút trước"
                 
-                response.append(f"{i}. *{track_name}* - {artist_name} ({time_str})")
+                response.append(f"{format_track_line(i, record, with_stars=False)} ({time_str})")
         
-        await update.message.reply_text('\n'.join(response), parse_mode='Markdown')
+        await reply(update, '\n'.join(response), parse_mode='Markdown', reply_markup=view_keyboard('recent', amount))
     except Exception as e:
-        logger.error(f"Error in get_recent_activity: {e}")
-        await update.message.reply_text(
-            "*❌ Có lỗi xảy ra khi lấy lịch sử hoạt động.*",
+        logger.error("Error in get_recent_activity: %s", e)
+        await reply(
+            update,
+            spotify_error_text(e, "*❌ Có lỗi xảy ra khi lấy lịch sử hoạt động.*"),
             parse_mode='Markdown'
         )
 
-async def check_token_expiration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    user_id = str(update.effective_user.id)
-    init_user_data(user_id)
-    
-    if not user_data[user_id].get('token') or not user_data[user_id].get('token_expiration'):
-        return False
+def fold_text(text: str) -> str:
+    """Chữ thường, bỏ dấu tiếng Việt (kể cả đ -> d) và các ký tự không phải chữ/số."""
+    text = unicodedata.normalize('NFKD', text.lower().replace('đ', 'd'))
+    return ' '.join(''.join(c if c.isalnum() else ' ' for c in text if not unicodedata.combining(c)).split())
+
+def trigrams(folded: str) -> set:
+    grams = set()
+    for word in folded.split():
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+class UserLibraryIndex:
+    """Chỉ mục ngược trigram -> bài hát cho thư viện của một người dùng."""
+    __slots__ = ('positions', 'records', 'texts', 'postings', 'built_at', 'refreshed_at', 'complete')
+
+    def __init__(self):
+        self.positions = {}  # track_id -> số thứ tự
+        self.records = []  # số thứ tự -> TrackRecord
+        self.texts = []  # số thứ tự -> tên và nghệ sĩ đã bỏ dấu
+        self.postings = {}  # trigram -> list số thứ tự
+        self.built_at = 0
+        self.refreshed_at = 0
+        self.complete = False
+
+    def add(self, records) -> int:
+        """Thêm các bài hát chưa có; trả về số bài mới."""
+        added = 0
+        for record in records:
+            if record is None or record.id in self.positions:
+                continue
+            folded = fold_text(f"{record.name} {' '.join(catalog.artist_names(record))}")
+            position = len(self.records)
+            self.positions[record.id] = position
+            self.records.append(record)
+            self.texts.append(folded)
+            for gram in trigrams(folded):
+                self.postings.setdefault(gram, []).append(position)
+            added += 1
+        return added
+
+    def search(self, query: str, limit: int) -> list:
+        folded = fold_text(query)
+        grams = trigrams(folded)
+        if not grams:
+            return []
+        hits = Counter()
+        for gram in grams:
+            positions = self.postings.get(gram)
+            if positions:
+                hits.update(positions)
+        needed = len(grams) * FIND_MIN_SCORE
+        scored = [
+            # Khớp nguyên cụm được ưu tiên, sau đó đến tên ngắn hơn
+            (count / len(grams) + (folded in self.texts[position]), -len(self.texts[position]), position)
+            for position, count in hits.items() if count >= needed
+        ]
+        return [self.records[position] for *_, position in heapq.nlargest(limit, scored)]
+
+class LibrarySearch:
+    """Chỉ mục tìm kiếm thư viện (bài đã thích và bài trong playlist) của từng người dùng.
+
+    Chỉ mục được lập dần theo từng trang trả về từ Spotify nên /find trả lời được ngay cả khi
+    chưa tải xong. Lần làm mới chỉ tải bài đã thích mới (Spotify trả về bài thêm gần nhất trước)
+    và playlist có snapshot_id thay đổi; định kỳ lập lại toàn bộ để loại bài đã bị bỏ.
+    """
+
+    def __init__(self, max_users: int = LIBRARY_MAX_USERS):
+        self.max_users = max_users
+        self._users = OrderedDict()  # user_id -> UserLibraryIndex
+        self._tasks = {}  # user_id -> Task đang lập hoặc làm mới chỉ mục
+
+    def snapshot_state(self) -> OrderedDict:
+        return self._users
+
+    def restore_state(self, state: OrderedDict) -> None:
+        self._users = state
+
+    def get(self, user_id: str):
+        return self._users.get(user_id)
+
+    def add(self, user_id: str, records) -> None:
+        """Bổ sung bài hát vừa tải ở nơi khác (ví dụ màn hình bài đã thích) vào chỉ mục đã có."""
+        index = self._users.get(user_id)
+        if index is not None:
+            index.add(records)
+
+    def forget(self, user_id: str) -> None:
+        self._users.pop(user_id, None)
+        task = self._tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+
+    def ensure(self, sp: spotipy.Spotify, user_id: str):
+        """Lập hoặc làm mới chỉ mục trong nền nếu cần; trả về task đang chạy, None nếu chỉ mục còn mới."""
+        task = self._tasks.get(user_id)
+        if task is not None:
+            return task
+        index = self._users.get(user_id)
+        now = time.time()
+        if index is not None and index.complete and now - index.refreshed_at < LIBRARY_REFRESH_INTERVAL:
+            self._users.move_to_end(user_id)
+            return None
+        rebuild = index is None or not index.complete or now - index.built_at >= LIBRARY_REBUILD_INTERVAL
+        task = asyncio.create_task(self._sync(sp, user_id, rebuild))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda t: self._finished(user_id, t))
+        return task
+
+    def _finished(self, user_id: str, task: asyncio.Task) -> None:
+        if self._tasks.get(user_id) is task:
+            del self._tasks[user_id]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Error indexing library for %s: %s", user_id, task.exception())
+
+    def _install(self, user_id: str, index: UserLibraryIndex) -> None:
+        self._users[user_id] = index
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    async def _sync(self, sp: spotipy.Spotify, user_id: str, rebuild: bool) -> None:
+        semaphore = asyncio.Semaphore(PLAYLIST_FETCH_CONCURRENCY)
+        index = self._users.get(user_id)
+        if rebuild:
+            fresh = UserLibraryIndex()
+            if index is None or not index.complete:
+                # Chưa có chỉ mục đầy đủ: trả lời luôn từ chỉ mục đang lập
+                self._install(user_id, fresh)
+            async for items in iter_pages(semaphore, sp.current_user_saved_tracks, LIBRARY_PAGE_SIZE):
+                fresh.add(catalog.add_tracks(item['track'] for item in items))
+            await self._add_playlists(sp, user_id, fresh, semaphore)
+            fresh.complete = True
+            fresh.built_at = fresh.refreshed_at = time.time()
+            self._install(user_id, fresh)
+            return
+
+        pages = stream_pages(sp.current_user_saved_tracks, LIBRARY_PAGE_SIZE)
+        try:
+            async for items in pages:
+                records = catalog.add_tracks(item['track'] for item in items)
+                if index.add(records) < len(records):
+                    break  # Đã tới phần thư viện có trong chỉ mục
+        finally:
+            await pages.aclose()
+        await self._add_playlists(sp, user_id, index, semaphore)
+        index.refreshed_at = time.time()
 
-    current_time = datetime.now()
-    expiration_time = user_data[user_id]['token_expiration']
+    async def _add_playlists(self, sp: spotipy.Spotify, user_id: str, index: UserLibraryIndex,
+                             semaphore: asyncio.Semaphore) -> None:
+        """Thêm bài hát trong playlist; playlist không đổi snapshot_id được lấy từ cache."""
+        playlists = await playlist_index.sync(sp, user_id, semaphore)
+        fetches = [
+            fetch_playlist_track_ids(sp, semaphore, playlist_id, snapshot_id)
+            for playlist_id, (_, snapshot_id, _) in playlists.playlists.items()
+        ]
+        for fetch in asyncio.as_completed(fetches):
+            index.add(catalog.get(track_id) for track_id in await fetch)
+
+library_search = LibrarySearch()
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Tìm bài hát trong thư viện của người dùng, không phân biệt dấu và chấp nhận gõ sai: `/find son tung`."""
+    query = ' '.join(context.args or [])
+    if not fold_text(query):
+        await reply(update, "*❗ Vui lòng nhập từ khóa.* Ví dụ: `/find son tung`", parse_mode='Markdown')
+        return
 
+    sp = await get_user_spotify(update, context)
+    if sp is None:
+        return
+
+    user_id = user_key(update)
     try:
-        # Lấy thông tin người dùng để có email
-        sp = spotipy.Spotify(auth=user_data[user_id]['token'])
-        user_info = sp.current_user()
-        user_email = user_info.get('email')
-        user_name = user_info.get('display_name', 'Người dùng')
+        task = library_search.ensure(sp, user_id)
+        index = library_search.get(user_id)
+        if task is not None and (index is None or not index.records):
+            # Lần đầu: chờ các trang đầu tiên của thư viện
+            await asyncio.wait({task}, timeout=FIND_BUILD_WAIT)
+            if task.done():
+                task.result()
+            index = library_search.get(user_id)
 
-        # Kiểm tra token đã hết hạn
-        if current_time >= expiration_time:
-            if await refresh_token(user_id):
-                await send_token_refresh_notification(update, context)
-                
-                # Gửi email thông báo token đã được làm mới
-                if user_email:
-                    email_subject = "Spotify Bot - Phiên đăng nhập đã được làm mới"
-                    email_message = f"""
+        records = index.search(query, FIND_RESULT_LIMIT) if index is not None else []
+        if not records:
+            response = [f"*❗ Không tìm thấy bài hát nào khớp với* \"{escape_markdown(query)}\""]
+        else:
+            response = [f"*🔎 {len(records)} bài hát khớp với* \"{escape_markdown(query)}\"*:*\n"]
+            for i, record in enumerate(records, 1):
+                response.append(f"{format_track_line(i, record, with_stars=False)} - [Nghe]({record.url})")
+        if index is None or not index.complete:
+            indexed = len(index.records) if index is not None else 0
+            response.append(f"\n_⏳ Đang lập chỉ mục thư viện ({indexed} bài), kết quả có thể chưa đầy đủ._")
+
+        await reply(update, '\n'.join(response), parse_mode='Markdown', disable_web_page_preview=True)
+    except Exception as e:
+        logger.error("Error in find_command: %s", e)
+        await reply(
+            update,
+            spotify_error_text(e, "*❌ Có lỗi xảy ra khi tìm trong thư viện.*"),
+            parse_mode='Markdown'
+        )
+
+class NotificationLedger:
+    """Sổ ghi thông báo theo (người dùng, loại thông báo), lưu trong SQLite để giữ qua các lần khởi động lại.
+
+    Mỗi loại có thời gian chờ riêng nên một thông báo không bị gửi lặp lại ở mỗi tin nhắn.
+    Thông báo được giữ lại vài giây trước khi gửi: các thông báo cùng lúc cho một người
+    được gộp thành một tin nhắn Telegram và một email, và thông báo mới hơn thay thế thông
+    báo đã lỗi thời (ví dụ "đã làm mới" thay cho "sắp hết hạn").
+    """
+
+    def __init__(self, path: str = SESSION_DB_PATH, coalesce_seconds: float = NOTICE_COALESCE_SECONDS):
+        self.path = path
+        self.coalesce_seconds = coalesce_seconds
+        self._sent = {}  # (user_id, kind) -> thời điểm gửi gần nhất
+        self._loaded = set()  # user_id đã nạp từ đĩa
+        self._pending = {}  # user_id -> {kind: (chat_id, text, email, kwargs)}
+        self._timers = {}  # user_id -> asyncio.TimerHandle
+        self._flushing = set()  # Task gửi đang chạy
+        self._db = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS notifications ("
+                "user_id TEXT, kind TEXT, sent_at INTEGER, PRIMARY KEY (user_id, kind))"
+            )
+        return self._db
+
+    def _load(self, user_id: str) -> None:
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+        for kind, sent_at in self._connection().execute(
+                "SELECT kind, sent_at FROM notifications WHERE user_id = ?", (user_id,)):
+            self._sent.setdefault((user_id, kind), sent_at)
+
+    def due(self, user_id: str, kind: str) -> bool:
+        """Loại thông báo này đã hết thời gian chờ với người dùng chưa."""
+        self._load(user_id)
+        return time.time() - self._sent.get((user_id, kind), 0) >= NOTICE_COOLDOWNS[kind]
+
+    def reset(self, user_id: str, *kinds) -> None:
+        """Cho phép gửi lại ngay các loại thông báo (ví dụ khi người dùng vừa đăng nhập lại)."""
+        self._load(user_id)
+        for kind in kinds:
+            self._sent.pop((user_id, kind), None)
+        db = self._connection()
+        with db:
+            db.executemany("DELETE FROM notifications WHERE user_id = ? AND kind = ?",
+                           [(user_id, kind) for kind in kinds])
+
+    def post(self, chat_id: int, user_id: str, kind: str, text: str, email: tuple = None, **kwargs) -> bool:
+        """Đưa thông báo vào hàng chờ gộp; trả về False nếu loại này còn trong thời gian chờ.
+
+        `email` là (địa chỉ, tiêu đề, nội dung) nếu cần gửi kèm email.
+        """
+        if not self.due(user_id, kind):
+            return False
+        now = int(time.time())
+        pending = self._pending.setdefault(user_id, {})
+        for superseded in NOTICE_SUPERSEDES.get(kind, ()):
+            if pending.pop(superseded, None) is not None:
+                self._sent[(user_id, superseded)] = now
+        pending[kind] = (chat_id, text, email, kwargs)
+        # Ghi nhận ngay để các tin nhắn đến trong lúc chờ không tạo thông báo trùng
+        self._sent[(user_id, kind)] = now
+        if user_id not in self._timers:
+            self._timers[user_id] = asyncio.get_running_loop().call_later(
+                self.coalesce_seconds, self._start_flush, user_id
+            )
+        return True
+
+    def _start_flush(self, user_id: str) -> None:
+        task = asyncio.ensure_future(self._flush(user_id))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _flush(self, user_id: str) -> None:
+        self._timers.pop(user_id, None)
+        pending = self._pending.pop(user_id, None)
+        if not pending:
+            return
+        kinds = [kind for kind in NOTICE_ORDER if kind in pending]
+        chat_id = pending[kinds[0]][0]
+        kwargs = {}
+        for kind in kinds:
+            kwargs.update(pending[kind][3])
+        text = "\n\n".join(pending[kind][1] for kind in kinds)
+
+        db = self._connection()
+        with db:
+            db.executemany(
+                "INSERT OR REPLACE INTO notifications VALUES (?, ?, ?)",
+                [(user_id, kind, sent_at) for (uid, kind), sent_at in self._sent.items() if uid == user_id]
+            )
+
+        tenant_of(user_id).outbound.notify(chat_id, text, **kwargs).add_done_callback(_log_notice_error)
+        emails = [pending[kind][2] for kind in kinds if pending[kind][2]]
+        if emails:
+            address, subject, _ = emails[0]
+            body = "\n\n".join(message.strip() for _, _, message in emails)
+            await send_email_notification(address, subject, body)
+
+    async def flush(self) -> None:
+        """Gửi ngay mọi thông báo đang chờ gộp (khi tắt bot)."""
+        for user_id, timer in list(self._timers.items()):
+            timer.cancel()
+            await self._flush(user_id)
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
+
+    def prune(self) -> None:
+        """Xóa các bản ghi đã quá mọi thời gian chờ, cả trong bộ nhớ lẫn trên đĩa."""
+        cutoff = int(time.time()) - max(NOTICE_COOLDOWNS.values())
+        self._sent = {key: sent_at for key, sent_at in self._sent.items() if sent_at >= cutoff}
+        self._loaded = {user_id for user_id, _ in self._sent}
+        db = self._connection()
+        with db:
+            db.execute("DELETE FROM notifications WHERE sent_at < ?", (cutoff,))
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+token_notices = NotificationLedger()
+
+# Email đi kèm thông báo phiên đăng nhập: (tiêu đề, nội dung)
+TOKEN_NOTICE_EMAILS = {
+    'refreshed': ("Spotify Bot - Phiên đăng nhập đã được làm mới", """
 Xin chào {user_name},
 
 Phiên đăng nhập Spotify của bạn đã được tự động làm mới thành công.
@@ -445,16 +4153,8 @@ Nếu bạn không thực hiện hành động này, vui lòng đăng xuất nga
 
 Trân trọng,
 Spotify Bot
-"""
-                    await send_email_notification(user_email, email_subject, email_message)
-                return True
-            else:
-                await send_login_notification(update, context)
-                
-                # Gửi email thông báo token hết hạn
-                if user_email:
-                    email_subject = "Spotify Bot - Phiên đăng nhập đã hết hạn"
-                    email_message = f"""
+"""),
+    'expired': ("Spotify Bot - Phiên đăng nhập đã hết hạn", """
 Xin chào {user_name},
 
 Phiên đăng nhập Spotify của bạn đã hết hạn và không thể tự động làm mới.
@@ -470,22 +4170,11 @@ Nếu bạn cần hỗ trợ thêm, vui lòng sử dụng lệnh /help.
 
 Trân trọng,
 Spotify Bot
-"""
-                    await send_email_notification(user_email, email_subject, email_message)
-                return False
-        
-        # Kiểm tra token sắp hết hạn (còn 5 phút)
-        if expiration_time - current_time <= timedelta(minutes=5):
-            await send_token_expiring_soon_notification(update, context)
-            
-            # Gửi email cảnh báo token sắp hết hạn
-            if user_email and not user_data[user_id].get('notification_sent'):
-                time_left = int((expiration_time - current_time).total_seconds() / 60)
-                email_subject = "Spotify Bot - Phiên đăng nhập sắp hết hạn"
-                email_message = f"""
+"""),
+    'expiring': ("Spotify Bot - Phiên đăng nhập sắp hết hạn", """
 Xin chào {user_name},
 
-Phiên đăng nhập Spotify của bạn sẽ hết hạn trong {time_left} phút nữa.
+Phiên đăng nhập Spotify của bạn sẽ hết hạn trong {minutes_left} phút nữa.
 Bot sẽ tự động làm mới phiên đăng nhập của bạn khi cần thiết.
 
 Nếu bạn gặp bất kỳ vấn đề gì trong việc sử dụng bot, vui lòng:
@@ -494,66 +4183,102 @@ Nếu bạn gặp bất kỳ vấn đề gì trong việc sử dụng bot, vui l
 
 Trân trọng,
 Spotify Bot
-"""
-                await send_email_notification(user_email, email_subject, email_message)
-                user_data[user_id]['notification_sent'] = True
+"""),
+}
+
+async def post_token_notice(update: Update, kind: str, text: str, **kwargs) -> None:
+    """Gửi thông báo về phiên đăng nhập qua sổ ghi thông báo, kèm email nếu người dùng có email."""
+    user_id = user_key(update)
+    if not token_notices.due(user_id, kind):
+        return
+
+    email = None
+    session = get_session(user_id)
+    subject, template = TOKEN_NOTICE_EMAILS[kind]
+    if EMAIL_HOST_USER and session.token:
+        try:
+            # Chỉ lấy email khi thực sự có thông báo cần gửi
+            user_info = await sp_call(spotify_client(session.token).current_user)
+            if user_info.get('email'):
+                minutes_left = max(0, session.expires_at - int(time.time())) // 60
+                email = (user_info['email'], subject, template.format(
+                    user_name=user_info.get('display_name') or 'Người dùng', minutes_left=minutes_left))
+        except Exception as e:
+            logger.error("Error fetching email for notice: %s", e)
+
+    token_notices.post(update.effective_chat.id, user_id, kind, text, email=email, **kwargs)
+
+async def check_token_expiration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    user_id = user_key(update)
+    session = get_session(user_id)
+    
+    if not session.token or not session.expires_at:
+        return False
+
+    current_time = int(time.time())
+    expiration_time = session.expires_at
+
+    try:
+        # Kiểm tra token đã hết hạn
+        if current_time >= expiration_time:
+            if await refresh_token(user_id):
+                await send_token_refresh_notification(update, context)
+                return True
+            else:
+                await send_login_notification(update, context)
+                return False
+        
+        # Kiểm tra token sắp hết hạn (còn 5 phút)
+        if expiration_time - current_time <= 5 * 60:
+            await send_token_expiring_soon_notification(update, context)
         
         return True
         
     except Exception as e:
-        logger.error(f"Lỗi kiểm tra token: {e}")
+        logger.error("Lỗi kiểm tra token: %s", e)
         return False
 
 
 async def send_token_refresh_notification(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = (
         "🔄 *Thông báo: Phiên đăng nhập đã được tự động làm mới!*\n\n"
-        "Bạn có thể tiếp tục sử dụng bot bình thường.\n"
-        "Một email xác nhận đã được gửi đến địa chỉ email của bạn."
-    )
-    await update.message.reply_text(message, parse_mode='Markdown')
-
-async def send_token_expiring_soon_notification(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = str(update.effective_user.id)
-    expiration_time = user_data[user_id]['token_expiration']
-    time_left = expiration_time - datetime.now()
-    minutes_left = int(time_left.total_seconds() / 60)
-    
-    message = (
-        f"⏳ *Thông báo: Phiên đăng nhập sắp hết hạn!*\n\n"
-        f"Phiên của bạn sẽ hết hạn trong khoảng {minutes_left} phút nữa.\n"
-        "Bot sẽ tự động làm mới phiên đăng nhập khi cần thiết.\n"
-        "Một email thông báo đã được gửi đến địa chỉ email của bạn."
+        "Bạn có thể tiếp tục sử dụng bot bình thường."
     )
-    
-    await update.message.reply_text(message, parse_mode='Markdown')
+    await post_token_notice(update, 'refreshed', message, parse_mode='Markdown')
 
 # Thêm hàm gửi thông báo đăng nhập lại
 async def send_login_notification(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = str(update.effective_user.id)
-    auth_url = sp_oauth.get_authorize_url(state=user_id)
+    user_id = user_key(update)
+    auth_url = authorize_url(user_id)
     keyboard = [[InlineKeyboardButton("🔑 Xác thực lại Spotify", url=auth_url)]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
+    if oauth_callback.running:
+        steps = (
+            "1. Nhấn nút 'Xác thực lại Spotify' bên dưới\n"
+            "2. Đăng nhập vào tài khoản Spotify của bạn, bot sẽ tự động đăng nhập lại\n\n"
+        )
+    else:
+        steps = (
+            "1. Nhấn nút 'Xác thực lại Spotify' bên dưới\n"
+            "2. Đăng nhập vào tài khoản Spotify của bạn\n"
+            "3. Sao chép token nhận được\n"
+            "4. Quay lại đây và sử dụng lệnh /set\\_token để nhập token mới\n\n"
+        )
     message = (
         "⚠️ *Phiên đăng nhập của bạn đã hết hạn!*\n\n"
         "Để tiếp tục sử dụng bot, bạn cần xác thực lại với Spotify. "
         "Vui lòng làm theo các bước sau:\n\n"
-        "1. Nhấn nút 'Xác thực lại Spotify' bên dưới\n"
-        "2. Đăng nhập vào tài khoản Spotify của bạn\n"
-        "3. Sao chép token nhận được\n"
-        "4. Quay lại đây và sử dụng lệnh /set\\_token để nhập token mới\n\n"
+        f"{steps}"
         "Nếu bạn gặp bất kỳ vấn đề nào, hãy sử dụng lệnh /help để được hỗ trợ."
     )
     
-    await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+    await post_token_notice(update, 'expired', message, reply_markup=reply_markup, parse_mode='Markdown')
 
 # Thêm hàm gửi thông báo token sắp hết hạn
 async def send_token_expiring_soon_notification(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = str(update.effective_user.id)
-    expiration_time = user_data[user_id]['token_expiration']
-    time_left = expiration_time - datetime.now()
-    minutes_left = int(time_left.total_seconds() / 60)
+    user_id = user_key(update)
+    minutes_left = max(0, get_session(user_id).expires_at - int(time.time())) // 60
     
     message = (
         f"⏳ *Thông báo: Phiên đăng nhập của bạn sắp hết hạn!*\n\n"
@@ -563,25 +4288,295 @@ async def send_token_expiring_soon_notification(update: Update, context: Context
         "vui lòng sử dụng lệnh /start để đăng nhập lại."
     )
     
-    await update.message.reply_text(message, parse_mode='Markdown')
+    await post_token_notice(update, 'expiring', message, parse_mode='Markdown')
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = str(update.effective_user.id)
-    message_text = update.message.text
-    init_user_data(user_id)
+async def get_user_spotify(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Kiểm tra đăng nhập và token, trả về client Spotify của người dùng hoặc None"""
+    session = get_session(user_key(update))
 
-    if not user_data[user_id].get('token'):
-        await update.message.reply_text(
+    if not session.token:
+        await reply(
+            update,
             "*Bạn chưa đăng nhập. Vui lòng sử dụng /start để bắt đầu quá trình xác thực.*",
             parse_mode='Markdown'
         )
-        return
+        return None
 
     # Kiểm tra token trước khi xử lý tin nhắn
     if not await check_token_expiration(update, context):
+        return None
+
+    return spotify_client(session.token)
+
+class Prefetcher:
+    """Tải trước các màn hình người dùng nhiều khả năng bấm tiếp theo sau khi hiện menu.
+
+    Tần suất bấm từng nút được đếm theo người dùng; sau /menu, /start hoặc /set_token,
+    PREFETCH_VIEWS màn hình hay dùng nhất được tải nền. Prefetch chỉ chạy khi còn ngân
+    sách trong spotify_budget (không chờ), nên không bao giờ lấn phần của tác vụ khác.
+    Kết quả được giữ ngắn hạn và chỉ dùng một lần; tỉ lệ trúng được ghi log định kỳ.
+    """
+
+    def __init__(self):
+        self.frequency = {}  # user_id -> Counter(view)
+        self._entries = {}  # (user_id, view) -> (thời điểm tải, dữ liệu)
+        self._tasks = {}  # user_id -> Task prefetch đang chạy
+        self.issued = self.hits = self.wasted = self.skipped = 0
+        self._task = None
+
+    def snapshot_state(self) -> dict:
+        return self.frequency
+
+    def restore_state(self, state: dict) -> None:
+        self.frequency = state
+
+    def record(self, user_id: str, view: str) -> None:
+        self.frequency.setdefault(user_id, Counter())[view] += 1
+
+    def likely_views(self, user_id: str) -> list:
+        counts = self.frequency.get(user_id, Counter())
+        # Chưa có lịch sử thì dùng thứ tự mặc định (bài đang phát, top bài hát)
+        ranked = sorted(PREFETCH_TTL, key=lambda view: (-counts[view], PREFETCH_DEFAULT_ORDER.index(view)))
+        return ranked[:PREFETCH_VIEWS]
+
+    def take(self, user_id: str, view: str):
+        """Lấy dữ liệu đã tải trước (chỉ một lần); None nếu không có hoặc đã cũ.
+
+        Chỉ gọi khi người gọi sẽ dùng kết quả, vì mỗi lần trả về dữ liệu được tính là một lần trúng.
+        """
+        entry = self._entries.pop((user_id, view), None)
+        if entry is None:
+            return None
+        if time.time() - entry[0] > PREFETCH_TTL[view]:
+            self.wasted += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def schedule(self, user_id: str) -> None:
+        if not PREFETCH_ENABLED or user_id in self._tasks:
+            return
+        session = sessions.peek(user_id)
+        # Token hết hạn thì bỏ qua: prefetch chỉ dùng ngân sách dư, việc làm mới để cho lần bấm thật
+        if session is None or not session.token or token_expired(session):
+            return
+        task = asyncio.ensure_future(self.prefetch(user_id, session.token, self.likely_views(user_id)))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(user_id, None))
+
+    async def prefetch(self, user_id: str, token: str, views) -> None:
+        sp = spotify_client(token)
+        for view in views:
+            if (user_id, view) in self._entries or (view == 'top' and top_lists.peek(user_id, 'tracks', 'short_term')):
+                continue
+            if not spotify_budget.try_acquire():
+                self.skipped += 1
+                continue
+            try:
+                if view == 'current':
+                    data = await sp_call(sp.current_user_playing_track)
+                elif view == 'top':
+                    # Dữ liệu nằm trong top_lists; ở đây chỉ đánh dấu để đo tỉ lệ trúng
+                    await top_lists.get(sp, user_id, 'tracks', 'short_term')
+                    data = True
+                elif view == 'liked':
+                    data = await sp_call(sp.current_user_saved_tracks, limit=VIEW_FETCH_LIMIT)
+                else:
+                    data = await sp_call(sp.current_user_recently_played, limit=VIEW_FETCH_LIMIT)
+            except Exception as e:
+                logger.error("Error prefetching %s for %s: %s", view, user_id, e)
+                continue
+            self.issued += 1
+            # Không có bài đang phát (None) thì không lưu: handler vẫn phải tự gọi lại
+            if data is not None:
+                self._entries[(user_id, view)] = (time.time(), data)
+
+    async def warm_up(self) -> None:
+        """Khi khởi động: tải trước top bài hát của những người dùng hoạt động gần đây."""
+        started = time.monotonic()
+        user_ids = sessions.recent(time.time() - PREFETCH_WARMUP_WINDOW, PREFETCH_WARMUP_USERS)
+        warmed = 0
+        for user_id in user_ids:
+            session = sessions.peek(user_id)
+            if session is None or not session.token or session.expires_at <= time.time() \
+                    or top_lists.peek(user_id, 'tracks', 'short_term'):
+                continue
+            await spotify_budget.acquire()
+            try:
+                await top_lists.get(spotify_client(session.token), user_id, 'tracks', 'short_term')
+                warmed += 1
+            except Exception as e:
+                logger.error("Error warming cache for %s: %s", user_id, e)
+        logger.info("Warm-up loaded top tracks for %s/%s recent users in %.1fs",
+                    warmed, len(user_ids), time.monotonic() - started)
+
+    def report(self) -> str:
+        hit_rate = self.hits / self.issued if self.issued else 0.0
+        return (f"Prefetch: {self.issued} issued, {self.hits} hits ({hit_rate:.0%}), "
+                f"{self.wasted} expired unused, {self.skipped} skipped for budget")
+
+    def prune(self) -> None:
+        now = time.time()
+        for key in [key for key, (fetched_at, _) in self._entries.items() if now - fetched_at > PREFETCH_TTL[key[1]]]:
+            del self._entries[key]
+            self.wasted += 1
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        for task in list(self._tasks.values()):
+            task.cancel()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        logger.info(self.report())
+
+    async def _run(self) -> None:
+        if PREFETCH_ENABLED:
+            try:
+                await self.warm_up()
+            except Exception as e:
+                logger.error("Error in startup warm-up: %s", e)
+        while True:
+            await asyncio.sleep(PREFETCH_REPORT_INTERVAL)
+            self.prune()
+            if self.issued:
+                logger.info(self.report())
+
+prefetcher = Prefetcher()
+
+class ViewCache:
+    """Dữ liệu thô gần nhất của từng màn hình theo người dùng.
+
+    Khi người dùng bấm nút inline để đổi màn hình hoặc số lượng, màn hình được vẽ lại từ đây
+    nếu dữ liệu còn mới; chỉ nút "Làm mới" mới buộc gọi lại Spotify.
+    """
+
+    def __init__(self):
+        self._entries = {}  # (user_id, view) -> (thời điểm lấy, dữ liệu)
+        self._prune_at = VIEW_CACHE_PRUNE_SIZE
+
+    def get(self, user_id: str, view: str):
+        entry = self._entries.get((user_id, view))
+        if entry is None or time.time() - entry[0] > VIEW_CACHE_TTL[view]:
+            return None
+        return entry[1]
+
+    def put(self, user_id: str, view: str, data) -> None:
+        self._entries[(user_id, view)] = (time.time(), data)
+        if len(self._entries) >= self._prune_at:
+            # Dọn mục hết hạn khi số mục tăng gấp đôi, chi phí trung bình mỗi lần put là O(1)
+            self.prune()
+            self._prune_at = max(VIEW_CACHE_PRUNE_SIZE, 2 * len(self._entries))
+
+    def forget(self, user_id: str) -> None:
+        for key in [key for key in self._entries if key[0] == user_id]:
+            del self._entries[key]
+
+    def prune(self) -> None:
+        now = time.time()
+        for key in [key for key, (fetched_at, _) in self._entries.items() if now - fetched_at > VIEW_CACHE_TTL[key[1]]]:
+            del self._entries[key]
+
+view_cache = ViewCache()
+
+def view_callback_data(view: str, amount: int = 0, time_range: str = 'short_term', refresh: bool = False) -> str:
+    # Dữ liệu callback giới hạn 64 byte: view:<màn hình>:<khoảng thời gian>:<số lượng>[:r]
+    return f"view:{view}:{time_range}:{amount}" + (":r" if refresh else "")
+
+def parse_view_callback(data: str):
+    """Trả về (view, amount, time_range, refresh) hoặc None nếu dữ liệu không hợp lệ."""
+    parts = data.split(':')
+    if len(parts) not in (4, 5) or parts[1] not in VIEW_LABELS or parts[2] not in TOP_RANGE_LABELS \
+            or not parts[3].isdigit():
+        return None
+    amount = min(int(parts[3]), MAX_AMOUNT)
+    return parts[1], amount, parts[2], len(parts) == 5
+
+def view_keyboard(view: str, amount: int = 0, time_range: str = 'short_term') -> InlineKeyboardMarkup:
+    """Bàn phím inline để chuyển màn hình, khoảng thời gian (top) và số lượng ngay trên tin nhắn."""
+    views = [
+        InlineKeyboardButton(f"• {label} •" if key == view else label,
+                             callback_data=view_callback_data(key, amount, time_range))
+        for key, label in VIEW_LABELS.items()
+    ]
+    rows = [views[:3], views[3:]]
+    if view == 'top':
+        rows.append([
+            InlineKeyboardButton(f"• {label} •" if key == time_range else label,
+                                 callback_data=view_callback_data(view, amount, key))
+            for key, label in TOP_RANGE_LABELS.items()
+        ])
+    if view in VIEW_AMOUNT_VIEWS and amount:
+        smaller = [step for step in VIEW_AMOUNT_STEPS if step < amount]
+        larger = [step for step in VIEW_AMOUNT_STEPS if step > amount]
+        row = []
+        if smaller:
+            row.append(InlineKeyboardButton(f"➖ {smaller[-1]}",
+                                            callback_data=view_callback_data(view, smaller[-1], time_range)))
+        if larger:
+            row.append(InlineKeyboardButton(f"➕ {larger[0]}",
+                                            callback_data=view_callback_data(view, larger[0], time_range)))
+        rows.append(row)
+    if view in VIEW_CACHE_TTL:
+        rows.append([InlineKeyboardButton("🔁 Làm mới",
+                                          callback_data=view_callback_data(view, amount, time_range, refresh=True))])
+    return InlineKeyboardMarkup(rows)
+
+async def view_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Xử lý nút inline: vẽ lại màn hình được chọn trên chính tin nhắn chứa nút."""
+    query = update.callback_query
+    parsed = parse_view_callback(query.data)
+    if parsed is None or query.message is None:
+        await query.answer()
+        return
+    if query.message.chat.id != query.from_user.id:
+        # Dữ liệu cá nhân: không cho người khác trong nhóm bấm để thay bằng dữ liệu của họ
+        await query.answer("Chỉ dùng được trong chat riêng với bot.", show_alert=True)
+        return
+    # Trả lời callback ngay để nút ngừng xoay trong khi chờ Spotify
+    await query.answer()
+
+    sp = await get_user_spotify(update, context)
+    if sp is None:
+        return
+
+    view, amount, time_range, refresh = parsed
+    user_id = user_key(update)
+    amount = amount or get_user_amount(user_id)
+    if view in PREFETCH_TTL:
+        prefetcher.record(user_id, view)
+    cached = not refresh
+    if view == 'current':
+        await get_current_track(update, sp, cached=cached)
+    elif view == 'top':
+        await get_top_tracks(update, sp, amount, time_range)
+    elif view == 'liked':
+        await get_liked_songs(update, sp, amount, cached=cached)
+    elif view == 'recent':
+        await get_recent_activity(update, sp, amount, cached=cached)
+    elif view == 'stats':
+        await get_stats(update, sp, cached=cached)
+    else:
+        await get_playlists(update, sp, amount)
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = user_key(update)
+    message_text = update.message.text
+
+    sp = await get_user_spotify(update, context)
+    if sp is None:
         return
 
-    sp = spotipy.Spotify(auth=user_data[user_id]['token'])
+    for view in PREFETCH_TTL:
+        if message_text == COMMANDS[view]:
+            prefetcher.record(user_id, view)
 
     try:
         # Xử lý các lệnh như trước
@@ -602,72 +4597,241 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         elif message_text == COMMANDS["settings"]:
             await show_settings(update, context)
         else:
-            await update.message.reply_text(
+            await reply(
+                update,
                 "*❌ Lệnh không hợp lệ. Vui lòng sử dụng menu hoặc /help để xem danh sách lệnh.*",
                 parse_mode='Markdown'
             )
 
     except spotipy.SpotifyException as e:
-        logger.error(f"Spotify error: {e}")
+        logger.error("Spotify error: %s", e)
         if 'The access token expired' in str(e):
             if await refresh_token(user_id):
-                await update.message.reply_text(
+                await reply(
+                    update,
                     "*🔄 Phiên đăng nhập đã được làm mới. Vui lòng thử lại lệnh của bạn.*",
                     parse_mode='Markdown'
                 )
             else:
                 await send_login_notification(update, context)
         else:
-            await update.message.reply_text(
+            await reply(
+                update,
                 "*❌ Có lỗi xảy ra khi truy cập Spotify. Vui lòng thử lại sau.*",
                 parse_mode='Markdown'
             )
     except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        await update.message.reply_text(
+        logger.error("Unexpected error: %s", e)
+        await reply(
+            update,
             "*❌ Đã xảy ra lỗi không mong muốn. Vui lòng thử lại sau.*",
             parse_mode='Markdown'
         )
 
+def state_signature(payload: str) -> str:
+    return hmac.new(OAUTH_STATE_SECRET, payload.encode(), hashlib.sha256).hexdigest()[:32]
+
+def sign_state(user_id: str) -> str:
+    """state cho liên kết xác thực: user_id kèm hạn dùng và chữ ký, để không ai gắn được tài khoản
+    Spotify của mình vào người dùng khác chỉ bằng cách đoán user_id."""
+    payload = f"{user_id}.{int(time.time()) + OAUTH_STATE_TTL}"
+    return f"{payload}.{state_signature(payload)}"
+
+def verify_state(state: str):
+    """user_id trong state nếu chữ ký đúng và còn hạn, ngược lại None."""
+    payload, _, signature = state.rpartition('.')
+    user_id, _, expires = payload.rpartition('.')
+    if not user_id or not hmac.compare_digest(signature.encode(), state_signature(payload).encode()):
+        return None
+    if not expires.isdigit() or int(expires) < time.time():
+        return None
+    return user_id
+
+def authorize_url(user_id: str) -> str:
+    """Liên kết xác thực Spotify bằng ứng dụng Spotify của bot sở hữu người dùng."""
+    return tenant_of(user_id).oauth.get_authorize_url(state=sign_state(user_id))
+
+def oauth_page(title: str, text: str) -> bytes:
+    return (
+        '<!doctype html><html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width">'
+        f'<title>{title}</title></head><body style="font-family:sans-serif;text-align:center;padding:3em 1em">'
+        f'<h2>{title}</h2><p>{text}</p></body></html>'
+    ).encode()
+
+class OAuthCallbackServer:
+    """Máy chủ HTTP nhỏ (asyncio thuần) nhận chuyển hướng của Spotify sau khi người dùng xác thực.
+
+    Đổi code lấy token bằng httpx bất đồng bộ (không chặn event loop), kích hoạt phiên và nhắn
+    cho người dùng ngay, nên không cần sao chép token rồi gửi /set_token. Mỗi state chỉ đổi code
+    một lần: trình duyệt gửi lại (tải lại trang) thì dùng chung kết quả lần đổi trước.
+    """
+
+    def __init__(self, host: str = OAUTH_CALLBACK_HOST, port: int = OAUTH_CALLBACK_PORT,
+                 accounts_url: str = SPOTIFY_ACCOUNTS_URL):
+        self.host = host
+        self.port = port
+        self.accounts_url = accounts_url
+        self._server = None
+        self._http = None
+        self._logins = {}  # state -> Task đổi code và kích hoạt phiên
+
+    @property
+    def running(self) -> bool:
+        return self._server is not None
+
+    async def start(self) -> None:
+        if not self.port or self._server is not None:
+            return
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self._http = httpx.AsyncClient(timeout=OAUTH_EXCHANGE_TIMEOUT)
+        logger.info("OAuth callback server listening on %s:%s", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._logins:
+            await asyncio.gather(*self._logins.values(), return_exceptions=True)
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def paths(self) -> set:
+        return {urlsplit(tenant.oauth.redirect_uri).path or '/' for tenant in tenants.values()}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, target = await asyncio.wait_for(self._read_request(reader), OAUTH_READ_TIMEOUT)
+            status, title, text = await self.handle(method, target)
+        except (asyncio.TimeoutError, ValueError):
+            status, title, text = 400, "Yêu cầu không hợp lệ", "Không đọc được yêu cầu."
+        except Exception as e:
+            logger.error("Error handling OAuth callback: %s", e)
+            status, title, text = 500, "Lỗi", "Có lỗi xảy ra, vui lòng thử lại."
+        body = oauth_page(title, text)
+        writer.write(
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: text/html; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nCache-Control: no-store\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass  # Trình duyệt đã đóng kết nối
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader) -> tuple:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        for _ in range(OAUTH_MAX_HEADERS):
+            if await reader.readline() in (b'\r\n', b'\n', b''):
+                break
+        if len(request_line) != 3:
+            raise ValueError("Malformed request line")
+        return request_line[0], request_line[1]
+
+    async def handle(self, method: str, target: str) -> tuple:
+        """Xử lý một request tới callback, trả về (mã HTTP, tiêu đề, nội dung trang)."""
+        url = urlsplit(target)
+        if method != 'GET' or url.path not in self.paths():
+            return 404, "Không tìm thấy", "Trang không tồn tại."
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        state = params.get('state', '')
+        user_id = verify_state(state)
+        if user_id is None:
+            return 400, "Liên kết không hợp lệ", \
+                "Liên kết xác thực đã hết hạn hoặc không hợp lệ. Hãy gửi /start cho bot để lấy liên kết mới."
+        if 'error' in params:
+            # Người dùng bấm "Hủy" trên trang của Spotify
+            return 200, "Đã hủy xác thực", "Bạn có thể quay lại Telegram và gửi /start nếu muốn thử lại."
+        if 'code' not in params:
+            return 400, "Yêu cầu không hợp lệ", "Thiếu mã xác thực."
+
+        log_context.set({'user_id': user_id, 'handler': 'oauth_callback'})
+        task = self._logins.get(state)
+        if task is None:
+            if len(self._logins) > OAUTH_LOGIN_PRUNE_SIZE:
+                self._logins = {s: t for s, t in self._logins.items() if verify_state(s) is not None}
+            task = self._logins[state] = asyncio.ensure_future(self._login(user_id, params['code']))
+        try:
+            await asyncio.shield(task)
+        except Exception as e:
+            logger.error("Error exchanging OAuth code: %s", e)
+            return 502, "Đăng nhập thất bại", \
+                "Không đổi được mã xác thực với Spotify. Hãy gửi /start cho bot và thử lại."
+        return 200, "✅ Đã liên kết Spotify", "Bạn có thể đóng trang này và quay lại Telegram."
+
+    async def exchange(self, oauth: SpotifyOAuth, code: str) -> dict:
+        """Đổi authorization code lấy token (access_token, refresh_token, expires_in)."""
+        response = await self._http.post(
+            self.accounts_url + '/api/token',
+            data={'grant_type': 'authorization_code', 'code': code, 'redirect_uri': oauth.redirect_uri},
+            auth=(oauth.client_id, oauth.client_secret),
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def _login(self, user_id: str, code: str) -> None:
+        tenant = tenant_of(user_id)
+        token_info = await self.exchange(tenant.oauth, code)
+        get_session(user_id).set_token_info(token_info)
+        token_notices.reset(user_id, 'expiring', 'expired')
+        tenant.outbound.submit(
+            telegram_id(user_id), 'send_message', PRIORITY_INTERACTIVE,
+            text="*✅ Đã liên kết Spotify thành công!* Bạn có thể sử dụng các chức năng của bot ngay bây giờ.",
+            parse_mode='Markdown', reply_markup=get_main_keyboard()
+        ).add_done_callback(_log_notice_error)
+        logger.info("Activated Spotify session from OAuth callback")
+
+oauth_callback = OAuthCallbackServer()
+
 async def set_token(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
         token_info = json.loads(update.message.text.split(' ', 1)[1])
-        user_id = str(update.effective_user.id)
-        init_user_data(user_id)
-        user_data[user_id]['token'] = token_info['access_token']
-        user_data[user_id]['refresh_token'] = token_info['refresh_token']
-        
-        # Lưu thời gian hết hạn
-        expires_in = token_info.get('expires_in', TOKEN_EXPIRATION_TIME)
-        user_data[user_id]['token_expiration'] = datetime.now() + timedelta(seconds=expires_in)
+        user_id = user_key(update)
+        # Lưu token và thời gian hết hạn
+        get_session(user_id).set_token_info(token_info)
+        token_notices.reset(user_id, 'expiring', 'expired')
         
         # Xóa tin nhắn chứa token để bảo mật
         await update.message.delete()
         
-        await update.message.reply_text(
+        await reply(
+            update,
             "*✅ Token đã được lưu thành công. Bạn có thể sử dụng các chức năng của bot ngay bây giờ.*",
             parse_mode='Markdown'
         )
         await show_main_menu(update, context)
     except Exception as e:
-        logger.error(f"Error setting token: {e}")
-        await update.message.reply_text(
+        logger.error("Error setting token: %s", e)
+        await reply(
+            update,
             "*❌ Có lỗi xảy ra khi lưu token. Vui lòng thử lại.*",
             parse_mode='Markdown'
         )
 
 async def logout_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = str(update.effective_user.id)
-    init_user_data(user_id)
+    user_id = user_key(update)
+    session = get_session(user_id)
     
-    if user_data[user_id].get('token'):
-        user_data[user_id]['token'] = None
-        await update.message.reply_text(
+    if session.token:
+        session.token = None
+        top_lists.forget(user_id)
+        playlist_index.forget(user_id)
+        discovery.forget(user_id)
+        library_search.forget(user_id)
+        view_cache.forget(user_id)
+        session.flags &= ~(FLAG_RELEASE_WATCH | FLAG_WEEKLY_DIGEST | FLAG_DIGEST_EMAIL)
+        release_watcher.disable(user_id)
+        await reply(
+            update,
             "*🚪 Bạn đã đăng xuất thành công. Sử dụng /start để đăng nhập lại.*",
             parse_mode='Markdown'
         )
     else:
-        await update.message.reply_text(
+        await reply(
+            update,
             "*❗ Bạn chưa đăng nhập. Sử dụng /start để bắt đầu.*",
             parse_mode='Markdown'
         )
@@ -676,25 +4840,29 @@ async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await show_main_menu(update, context)
 
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = str(update.effective_user.id)
+    user_id = user_key(update)
     amount = get_user_amount(user_id)
     
-    await update.message.reply_text(
+    await reply(
+        update,
         f"*🎧 Menu Chính - Chọn một tùy chọn:*\n"
         f"Số lượng hiển thị hiện tại: *{amount}* mục",
         reply_markup=get_main_keyboard(),
         parse_mode='Markdown'
     )
+    # Lượt bấm tiếp theo rất dễ đoán: tải trước trong nền
+    prefetcher.schedule(user_id)
 
 async def set_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = str(update.effective_user.id)
-    init_user_data(user_id)
+    user_id = user_key(update)
+    session = get_session(user_id)
     
     try:
         # Kiểm tra xem có đối số không
         if not context.args:
             current_amount = get_user_amount(user_id)
-            await update.message.reply_text(
+            await reply(
+                update,
                 f"*🔢 Cài đặt số lượng hiện tại:* {current_amount}\n"
                 f"Để thay đổi, hãy sử dụng: `/set_amount <số lượng>` (1-{MAX_AMOUNT})",
                 parse_mode='Markdown'
@@ -705,46 +4873,50 @@ async def set_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         
         # Kiểm tra giới hạn
         if amount < 1 or amount > MAX_AMOUNT:
-            await update.message.reply_text(
+            await reply(
+                update,
                 f"*❌ Số lượng phải từ 1 đến {MAX_AMOUNT}.*",
                 parse_mode='Markdown'
             )
             return
         
-        user_data[user_id]['amount'] = amount
-        await update.message.reply_text(
+        session.amount = amount
+        await reply(
+            update,
             f"*✅ Đã cập nhật số lượng hiển thị thành: {amount}*",
             parse_mode='Markdown'
         )
         
     except ValueError:
-        await update.message.reply_text(
+        await reply(
+            update,
             "*❌ Vui lòng nhập một số hợp lệ.*",
             parse_mode='Markdown'
         )
 
 async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = str(update.effective_user.id)
-    init_user_data(user_id)
+    user_id = user_key(update)
+    session = get_session(user_id)
     
     current_amount = get_user_amount(user_id)
     settings_text = (
         "*⚙️ Cài đặt hiện tại:*\n\n"
         f"📊 *Số lượng hiển thị:* {current_amount}\n"
-        f"🔒 *Trạng thái:* {'*Đã đăng nhập*' if user_data[user_id].get('token') else '*Chưa đăng nhập*'}\n\n"
+        f"🔒 *Trạng thái:* {'*Đã đăng nhập*' if session.token else '*Chưa đăng nhập*'}\n\n"
         "*Các lệnh cài đặt:*\n"
         "• `/set_amount <số>` - Điều chỉnh số lượng hiển thị\n"
         "• `/logout` - Đăng xuất\n"
         "• `/start` - Đăng nhập lại"
     )
     
-    await update.message.reply_text(
+    await reply(
+        update,
         settings_text,
         parse_mode='Markdown'
     )
 
 async def show_help(update: Update) -> None:
-    user_id = str(update.effective_user.id)
+    user_id = user_key(update)
     amount = get_user_amount(user_id)
     
     help_text = f"""
@@ -758,6 +4930,21 @@ async def show_help(update: Update) -> None:
 • `/menu` - Hiển thị menu chính
 • `/set_token` - Nhập token sau khi xác thực Spotify
 • `/logout` - Đăng xuất khỏi tài khoản Spotify
+• `/live` - Bài hát đang phát, tự động cập nhật
+• `/live_stop` - Tắt chế độ live
+• `/top_all` - Top bài hát và nghệ sĩ theo 4 tuần, 6 tháng và mọi thời điểm
+• `/playlist_analyze` - Phân tích bài trùng, thời lượng và nghệ sĩ trong mọi playlist
+• `/playlist_changes` - Xem playlist đã thay đổi từ lần xem trước
+• `/release_watch` - Bật/tắt thông báo bản phát hành mới của nghệ sĩ bạn theo dõi
+• `/discover` - Gợi ý bài hát từ những người dùng có gu tương tự
+• `/digest` - Bật/tắt bản tin tuần (`/digest email` để nhận thêm qua email)
+• `/export [csv|json]` - Tải về bài hát đã thích, playlist và lượt nghe gần đây
+• `/find <từ khóa>` - Tìm bài hát trong thư viện của bạn (không cần gõ dấu)
+
+*Trong nhóm chat:*
+• `/group_join` - Tham gia bảng xếp hạng của nhóm
+• `/group_top` - Xem top nghệ sĩ/bài hát của nhóm và độ hợp gu
+• `/group_leave` - Rời bảng xếp hạng nhóm
 
 *Cài đặt tùy chỉnh:*
 • `/set_amount <số>` - Điều chỉnh số lượng hiển thị (1-{MAX_AMOUNT})
@@ -770,7 +4957,7 @@ async def show_help(update: Update) -> None:
 • Số lượng tối đa có thể hiển thị là {MAX_AMOUNT} mục
 • Nếu gặp lỗi, hãy thử đăng xuất và đăng nhập lại
 """
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+    await reply(update, help_text, parse_mode='Markdown')
 
 # Thêm hàm xử lý lệnh /contact
 async def contact_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -810,15 +4997,261 @@ Nếu bạn thấy bot hữu ích, hãy:
 • Telegram: @tanbaycu
 • Discord: tanbaycu
 """
-    await update.message.reply_text(
+    await reply(
+        update,
         contact_info,
         parse_mode='Markdown',
         disable_web_page_preview=True
     )
 
 
-def main() -> None:
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+class StateSnapshot:
+    """Ảnh chụp trạng thái cache trong bộ nhớ (pickle) để tiến trình mới khởi động với cache "ấm".
+
+    Phiên người dùng đã nằm trong SQLite nên không cần chụp; ở đây chỉ lưu các cache và
+    chỉ mục vốn chỉ có trong bộ nhớ. Mỗi thành phần cung cấp snapshot_state/restore_state;
+    thành phần nào khôi phục lỗi thì bị bỏ qua và khởi động lạnh.
+    """
+
+    def __init__(self, path: str = SNAPSHOT_PATH):
+        self.path = path
+
+    def components(self) -> dict:
+        return {
+            'catalog': catalog,
+            'search_cache': search_cache,
+            'top_lists': top_lists,
+            'playlist_tracks': playlist_tracks,
+            'playlist_index': playlist_index,
+            'release_watcher': release_watcher,
+            'group_board': group_board,
+            'discovery': discovery,
+            'library_search': library_search,
+            'now_playing_cards': now_playing_cards,
+            'prefetcher': prefetcher,
+        }
+
+    def save(self) -> None:
+        started = time.perf_counter()
+        state = {name: component.snapshot_state() for name, component in self.components().items()}
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = self.path + '.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'version': SNAPSHOT_VERSION, 'saved_at': time.time(), 'state': state}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.path)
+        logger.info("Saved state snapshot (%s KiB) in %.2fs",
+                    os.path.getsize(self.path) // 1024, time.perf_counter() - started)
+
+    def load(self) -> bool:
+        started = time.perf_counter()
+        try:
+            with open(self.path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.error("Error reading state snapshot: %s", e)
+            return False
+
+        if snapshot.get('version') != SNAPSHOT_VERSION or time.time() - snapshot['saved_at'] > SNAPSHOT_MAX_AGE:
+            logger.info("Ignoring outdated state snapshot")
+            return False
+        for name, component in self.components().items():
+            if name in snapshot['state']:
+                try:
+                    component.restore_state(snapshot['state'][name])
+                except Exception as e:
+                    logger.error("Error restoring %s from snapshot: %s", name, e)
+        logger.info("Warm-loaded state snapshot in %.2fs", time.perf_counter() - started)
+        return True
+
+state_snapshot = StateSnapshot()
+
+def update_handler_name(update: Update) -> str:
+    """Tên ngắn của thao tác trong update (lệnh, nút menu, inline...) dùng cho log."""
+    message = update.message
+    if message is not None and message.text:
+        if message.text.startswith('/'):
+            return message.text.split()[0].split('@')[0]
+        for key, label in COMMANDS.items():
+            if message.text == label:
+                return key
+        return 'message'
+    if update.inline_query is not None:
+        return 'inline'
+    if update.callback_query is not None:
+        return ':'.join((update.callback_query.data or 'callback').split(':')[:2])
+    return 'other'
+
+async def trace_update(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handler nhóm đầu tiên: gắn user_id/handler vào log của update và ghi thời gian xử lý khi xong."""
+    if not isinstance(update, Update):
+        return
+    fields = {
+        'user_id': user_key(update) if update.effective_user else None,
+        'handler': update_handler_name(update),
+    }
+    log_context.set(fields)
+    task = asyncio.current_task()
+    if task is None:
+        return
+    started = time.perf_counter()
+
+    def done(_):
+        latency_ms = round((time.perf_counter() - started) * 1000, 1)
+        # Update chậm luôn được ghi; còn lại chỉ lấy mẫu
+        level = logging.WARNING if latency_ms >= LOG_SLOW_UPDATE_MS else logging.INFO
+        update_logger.log(level, "update handled", extra=dict(fields, latency_ms=latency_ms))
+
+    task.add_done_callback(done)
+
+class ShutdownDrain:
+    """Dừng bot nhẹ nhàng khi nhận SIGTERM/SIGINT.
+
+    Ngừng nhận update mới từ Telegram, chờ các handler đang chạy (và update đã nhận)
+    xử lý xong trong thời hạn SHUTDOWN_DRAIN_TIMEOUT, hủy phần còn lại, rồi mới để
+    Application dừng; post_stop xả hàng đợi và post_shutdown ghi ảnh chụp trạng thái.
+    """
+
+    def __init__(self, timeout: float = SHUTDOWN_DRAIN_TIMEOUT):
+        self.timeout = timeout
+        self.inflight = set()  # Task xử lý update đang chạy
+        self.draining = False
+        self._task = None
+
+    async def track(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Handler nhóm đầu tiên: ghi nhận task đang xử lý update."""
+        task = asyncio.current_task()
+        if task is not None and task not in self.inflight:
+            self.inflight.add(task)
+            task.add_done_callback(self.inflight.discard)
+
+    def install(self, application: Application) -> None:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.request, application)
+            except NotImplementedError:
+                logger.error("Signal handlers are not supported here; stopping will not drain updates")
+                return
+
+    def request(self, application: Application) -> None:
+        if self.draining:
+            # Tín hiệu thứ hai: dừng ngay
+            application.stop_running()
+            return
+        self.draining = True
+        self._task = asyncio.ensure_future(self.drain(application))
+
+    async def drain(self, application: Application) -> None:
+        started = time.monotonic()
+        logger.info("Draining: %s handlers in flight", len(self.inflight))
+        # Bot phụ (xem Tenant) dùng chung event loop nên được xả cùng lúc với bot mặc định
+        applications = [application] + [tenant.application for tenant in extra_tenants() if tenant.application]
+        try:
+            for app in applications:
+                if app.updater is not None and app.updater.running:
+                    await app.updater.stop()
+            deadline = started + self.timeout
+            while (self.inflight or any(not app.update_queue.empty() for app in applications)) \
+                    and time.monotonic() < deadline:
+                if self.inflight:
+                    await asyncio.wait(set(self.inflight), timeout=deadline - time.monotonic(),
+                                       return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    await asyncio.sleep(0.05)
+            for task in list(self.inflight):
+                task.cancel()
+            if self.inflight:
+                logger.error("Cancelled %s handlers after %ss drain deadline", len(self.inflight), self.timeout)
+        except Exception as e:
+            logger.error("Error while draining: %s", e)
+        logger.info("Drained in %.2fs", time.monotonic() - started)
+        application.stop_running()
+
+shutdown_drain = ShutdownDrain()
+
+async def post_init(application: Application) -> None:
+    # Nạp ảnh chụp trước khi các tác vụ nền chạy và trước khi nhận update đầu tiên
+    state_snapshot.load()
+    traffic_recorder.start()
+    shutdown_drain.install(application)
+    try:
+        await oauth_callback.start()
+    except OSError as e:
+        logger.error("Error starting OAuth callback server: %s", e)
+    sessions.start()
+    default_tenant.outbound.start(application.bot)
+    for tenant in extra_tenants():
+        try:
+            await tenant.start()
+        except Exception as e:
+            logger.error("Error starting tenant %s: %s", tenant.name, e)
+    live_scheduler.start()
+    release_watcher.start()
+    group_board.start()
+    discovery.start()
+    weekly_digest.start()
+    token_notices.prune()
+    prefetcher.start()
+
+async def post_stop(application: Application) -> None:
+    """Dừng tác vụ nền và xả hàng đợi gửi khi Bot API còn dùng được.
+
+    run_polling gọi Application.shutdown() (đóng kết nối của bot) trước post_shutdown,
+    nên mọi thứ còn cần gửi tin nhắn phải xong ở đây.
+    """
+    for tenant in extra_tenants():
+        await tenant.stop()
+    await oauth_callback.stop()
+    await live_scheduler.stop()
+    await release_watcher.stop()
+    await group_board.stop()
+    await discovery.stop()
+    await weekly_digest.stop()
+    await prefetcher.stop()
+    now_playing_cards.shutdown()
+    await token_notices.flush()
+    for tenant in tenants.values():
+        await tenant.outbound.flush(OUTBOUND_FLUSH_TIMEOUT)
+        await tenant.outbound.stop()
+    for tenant in extra_tenants():
+        await tenant.shutdown()
+
+async def post_shutdown(application: Application) -> None:
+    await sessions.stop()
+    spotify_http.shutdown()
+    audio_features.close()
+    token_notices.close()
+    traffic_recorder.stop()
+    try:
+        state_snapshot.save()
+    except Exception as e:
+        logger.error("Error saving state snapshot: %s", e)
+
+def build_application(builder=None, tenant: Tenant = None) -> Application:
+    """Tạo Application với đầy đủ handler cho một bot (mặc định: bot chạy bằng TELEGRAM_TOKEN).
+
+    `builder` dùng để thay Bot API thật (ví dụ khi phát lại lưu lượng). Chỉ bot mặc định có
+    post_init/post_stop/post_shutdown: các hook này khởi động và dừng phần dùng chung cùng các bot phụ.
+    """
+    tenant = tenant or default_tenant
+    builder = builder or Application.builder().token(tenant.token).request(telegram_http)
+    if tenant is default_tenant:
+        builder = builder.post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    application = builder.concurrent_updates(MAX_CONCURRENT_UPDATES).build()
+    tenant.application = application
+
+    application.add_handler(TypeHandler(Update, tenant.enter), group=-4)
+    if traffic_recorder.enabled:
+        application.add_handler(TypeHandler(Update, record_update), group=-3)
+    # Gắn ngữ cảnh log và ghi nhận mọi update đang xử lý để có thể dừng nhẹ nhàng
+    application.add_handler(TypeHandler(Update, trace_update), group=-2)
+    application.add_handler(TypeHandler(Update, shutdown_drain.track), group=-1)
 
     # Thêm các handlers
     application.add_handler(CommandHandler("start", start))
@@ -829,10 +5262,32 @@ def main() -> None:
     application.add_handler(CommandHandler("settings", show_settings))
     application.add_handler(CommandHandler("help", show_help))
     application.add_handler(CommandHandler("contact", contact_command))
+    application.add_handler(CommandHandler("live", live_command))
+    application.add_handler(CommandHandler("live_stop", live_stop_command))
+    application.add_handler(CommandHandler("top_all", top_all_command))
+    application.add_handler(CommandHandler("playlist_analyze", playlist_analyze_command))
+    application.add_handler(CommandHandler("playlist_changes", playlist_changes_command))
+    application.add_handler(CommandHandler("release_watch", release_watch_command))
+    application.add_handler(CommandHandler("discover", discover_command))
+    application.add_handler(CommandHandler("digest", digest_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("find", find_command))
+    application.add_handler(CommandHandler("group_top", group_top_command))
+    application.add_handler(CommandHandler("group_join", group_join_command))
+    application.add_handler(CommandHandler("group_leave", group_leave_command))
+    application.add_handler(InlineQueryHandler(inline_query, block=False))
+    application.add_handler(CallbackQueryHandler(view_callback, pattern=r'^view:'))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
+
+def main() -> None:
+    application = build_application()
+    for tenant in extra_tenants():
+        build_application(tenant=tenant)
 
     # Bắt đầu bot
-    application.run_polling()
+    # Tín hiệu dừng do ShutdownDrain xử lý (xem post_init)
+    application.run_polling(stop_signals=None)
 
 if __name__ == "__main__":
     main()